@@ -0,0 +1,433 @@
+"""
+SqliteDBとDBHandlerのベンチマーク。
+
+挿入(1件ずつ/まとめて)、範囲検索、更新、削除と、複数のSysThreadから同時に読み書きする混合負荷を計測し、
+1秒あたりの行数、1操作あたりのレイテンシーのp50/p99、プロセスのピークRSSをJSONで出力する。
+データは固定の値で生成するため、同じ引数であれば同じ処理を計測する。
+
+    python db_bench.py --rows 10000 --output result.json
+    python db_bench.py --baseline result.json --tolerance 0.2
+
+--baselineを指定すると、前回の結果と比べてrows_per_secがtolerance以上低下した項目を表示し、終了コード1で終了する。
+ピークRSSはプロセス全体の最大値のため、各項目の値はそれまでに実行した項目を含めた最大値になる。
+"""
+import argparse
+import json
+import logging
+import os.path
+import platform
+import queue
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# add the parent directory of the current file to the system path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+import sqlalchemy
+from sqlalchemy import Column, Float, Integer, String
+
+from templates.databases import DBHandler, SqliteDB
+from templates.databases.db_interaction import Base
+from templates.threadman.sys_thread import SysThread
+
+SENSORS = 8  # 生成するデータのセンサー数
+OPS = 200  # 1件ずつの操作(insert/範囲検索/更新/削除)の回数
+RANGE_ROWS = 100  # 範囲検索・更新・削除の1操作で対象にする行数
+
+
+class BenchReading(Base):
+    __tablename__ = "bench_readings"
+    id = Column(Integer, primary_key=True)
+    ts = Column(Float, index=True)
+    sensor = Column(String)
+    value = Column(Float)
+
+
+def make_rows(count, start=0):
+    """(時刻, センサー名, 値)のタプルを、時刻の昇順に生成する。"""
+    return [
+        (float(i), f"s{i % SENSORS}", (i * 7919 % 1000) / 10)
+        for i in range(start, start + count)
+    ]
+
+
+def peak_rss_kb():
+    """プロセスのピークRSS(KB)。macOSではru_maxrssがバイト単位のため換算する。"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def percentile(latencies, q):
+    """最近傍順位法でパーセンタイルを返す。"""
+    ordered = sorted(latencies)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(layer, name, rows, latencies, seconds):
+    return {
+        "layer": layer,
+        "benchmark": name,
+        "rows": rows,
+        "ops": len(latencies),
+        "seconds": round(seconds, 4),
+        "rows_per_sec": round(rows / seconds, 1) if seconds > 0 else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def timed(layer, name, operations):
+    """(関数, 行数)のリストを順に実行し、操作ごとのレイテンシーを集計する。"""
+    latencies = []
+    rows = 0
+    start = time.perf_counter()
+    for fn, count in operations:
+        op_start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - op_start)
+        rows += count
+    return summarize(layer, name, rows, latencies, time.perf_counter() - start)
+
+
+class SqliteDBTarget:
+    """SqliteDBに対するベンチマークの各操作。"""
+
+    layer = "SqliteDB"
+
+    def __init__(self, db_file, threads):
+        self.db = SqliteDB(db_file, profile="throughput", pool="thread")
+        self.db.add_table(
+            "readings",
+            [("ts", "FLOAT"), ("sensor", "TEXT"), ("value", "FLOAT")],
+            indexes=["ts"],
+        )
+
+    def insert(self, row):
+        self.db.insert("readings", row)
+
+    def insert_many(self, rows, chunk_size):
+        self.db.insert_many("readings", rows, chunk_size=chunk_size)
+
+    def select_range(self, start, end):
+        return self.db.select(
+            "readings",
+            where_clause="ts >= :start AND ts < :end",
+            params={"start": start, "end": end},
+        )
+
+    def update(self, start, end):
+        self.db.update("readings", "value = value + 1", f"ts >= {start} AND ts < {end}")
+
+    def delete(self, start, end):
+        self.db.delete("readings", f"ts >= {start} AND ts < {end}")
+
+    def close(self):
+        self.db.engine.dispose()
+
+
+class DBHandlerTarget:
+    """DBHandlerに対するベンチマークの各操作。"""
+
+    layer = "DBHandler"
+
+    def __init__(self, db_file, threads):
+        self.db = DBHandler(f"sqlite:///{db_file}", pool_size=threads, max_overflow=0)
+        self.db.add_model(BenchReading)
+
+    @staticmethod
+    def _mapping(row):
+        return {"ts": row[0], "sensor": row[1], "value": row[2]}
+
+    def insert(self, row):
+        self.db.insert(BenchReading(**self._mapping(row)))
+
+    def insert_many(self, rows, chunk_size):
+        self.db.insert_many(
+            map(self._mapping, rows),
+            bulk=True,
+            model=BenchReading,
+            chunk_size=chunk_size,
+        )
+
+    def select_range(self, start, end):
+        return self.db.select(
+            BenchReading, (BenchReading.ts >= start) & (BenchReading.ts < end)
+        )
+
+    def update(self, start, end):
+        self.db.update(
+            BenchReading,
+            (BenchReading.ts >= start) & (BenchReading.ts < end),
+            {"value": BenchReading.value + 1},
+        )
+
+    def delete(self, start, end):
+        self.db.delete(
+            BenchReading, (BenchReading.ts >= start) & (BenchReading.ts < end)
+        )
+
+    def close(self):
+        self.db.engine.dispose()
+
+
+class WorkloadThread(SysThread):
+    """"run"コマンドで指定された回数の読み書きを行い、操作ごとのレイテンシーを記録するSysThread。"""
+
+    def __init__(self, name, logger, sys_queues, target, role, start_ts):
+        super().__init__(name, logger, sys_queues)
+        self.target = target
+        self.role = role
+        self.next_ts = start_ts
+        self.latencies = []
+        self.rows = 0
+
+    def command_register(self):
+        super().command_register()
+        self.cmd_dispatcher.register_handler("run", self.handle_run_command)
+
+    def handle_run_command(self, *args, **kwargs):
+        task = kwargs["task"]
+        for i in range(task["ops"]):
+            start = time.perf_counter()
+            if self.role == "writer":
+                self.target.insert_many(
+                    make_rows(task["batch"], self.next_ts), task["batch"]
+                )
+                self.next_ts += task["batch"]
+                self.rows += task["batch"]
+            else:
+                begin = (i * RANGE_ROWS) % task["table_rows"]
+                self.rows += len(self.target.select_range(begin, begin + RANGE_ROWS))
+            self.latencies.append(time.perf_counter() - start)
+
+
+def run_mixed(target, table_rows, writers, readers, ops, batch):
+    """書き込みと範囲検索を行うSysThreadを同時に動かし、全スレッドの操作をまとめて集計する。"""
+    logger = logging.getLogger("db_bench")
+    names = [f"writer{i}" for i in range(writers)] + [
+        f"reader{i}" for i in range(readers)
+    ]
+    sys_queues = {name: queue.Queue() for name in names}
+    threads = [
+        WorkloadThread(
+            name,
+            logger,
+            sys_queues,
+            target,
+            "writer" if name.startswith("writer") else "reader",
+            # 書き込みスレッドごとに、既存の行と重ならない時刻の範囲を割り当てる
+            table_rows * (2 + index),
+        )
+        for index, name in enumerate(names)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.add_task2queue(
+            thread.name,
+            {
+                "cmd": "run",
+                "from": "main",
+                "ops": ops,
+                "batch": batch,
+                "table_rows": table_rows,
+            },
+        )
+    for thread in threads:
+        # stopはキューの末尾にNoneを入れるため、"run"の完了を待ってから終了する
+        thread.stop()
+    seconds = time.perf_counter() - start
+    errors = [thread.error for thread in threads if thread.error is not None]
+    if errors:
+        raise errors[0]
+    latencies = [latency for thread in threads for latency in thread.latencies]
+    result = summarize(
+        target.layer,
+        "mixed",
+        sum(thread.rows for thread in threads),
+        latencies,
+        seconds,
+    )
+    result.update({"writers": writers, "readers": readers})
+    return result
+
+
+def run_layer(target_class, args, tmpdir):
+    target = target_class(
+        os.path.join(tmpdir, f"{target_class.layer}.db"),
+        args.writers + args.readers + 1,
+    )
+    try:
+        results = []
+        rows = make_rows(OPS)
+        results.append(
+            timed(
+                target.layer,
+                "insert",
+                [(lambda row=row: target.insert(row), 1) for row in rows],
+            )
+        )
+
+        # 1件ずつの挿入の後ろに、まとめて挿入する
+        bulk = make_rows(args.rows, OPS)
+        chunks = [
+            bulk[i : i + args.chunk_size] for i in range(0, len(bulk), args.chunk_size)
+        ]
+        results.append(
+            timed(
+                target.layer,
+                "insert_many",
+                [
+                    (
+                        lambda chunk=chunk: target.insert_many(chunk, args.chunk_size),
+                        len(chunk),
+                    )
+                    for chunk in chunks
+                ],
+            )
+        )
+        table_rows = OPS + args.rows
+
+        ranges = [((i * 7919) % (table_rows - RANGE_ROWS),) for i in range(OPS)]
+        ranges = [(begin, begin + RANGE_ROWS) for (begin,) in ranges]
+        results.append(
+            timed(
+                target.layer,
+                "select_range",
+                [(lambda r=r: target.select_range(*r), RANGE_ROWS) for r in ranges],
+            )
+        )
+        results.append(
+            timed(
+                target.layer,
+                "update",
+                [(lambda r=r: target.update(*r), RANGE_ROWS) for r in ranges],
+            )
+        )
+
+        # 削除は重ならない範囲で行い、1操作あたりの削除件数を揃える
+        deletes = [
+            (begin, begin + RANGE_ROWS)
+            for begin in range(0, min(table_rows, OPS * RANGE_ROWS), RANGE_ROWS)
+        ]
+        results.append(
+            timed(
+                target.layer,
+                "delete",
+                [(lambda r=r: target.delete(*r), RANGE_ROWS) for r in deletes],
+            )
+        )
+
+        table_rows = max(table_rows - len(deletes) * RANGE_ROWS, RANGE_ROWS)
+        results.append(
+            run_mixed(
+                target,
+                table_rows,
+                args.writers,
+                args.readers,
+                OPS // 4,
+                args.chunk_size // 10 or 1,
+            )
+        )
+        return results
+    finally:
+        target.close()
+
+
+def compare(results, baseline, tolerance):
+    """前回の結果と比べて、rows_per_secがtolerance以上低下した項目のリストを返す。"""
+    previous = {
+        (item["layer"], item["benchmark"]): item for item in baseline["results"]
+    }
+    regressions = []
+    for item in results:
+        before = previous.get((item["layer"], item["benchmark"]))
+        if (
+            before is None
+            or not before.get("rows_per_sec")
+            or item["rows_per_sec"] is None
+        ):
+            continue
+        ratio = item["rows_per_sec"] / before["rows_per_sec"]
+        if ratio < 1 - tolerance:
+            regressions.append(
+                f"{item['layer']}.{item['benchmark']}: "
+                f"{before['rows_per_sec']:.0f} -> {item['rows_per_sec']:.0f} rows/sec "
+                f"({(ratio - 1) * 100:+.1f}%)"
+            )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SqliteDBとDBHandlerのベンチマーク")
+    parser.add_argument("--rows", type=int, default=10_000, help="insert_manyで挿入する行数")
+    parser.add_argument(
+        "--chunk-size", type=int, default=1000, help="insert_manyの1回の行数"
+    )
+    parser.add_argument("--writers", type=int, default=2, help="混合負荷の書き込みスレッド数")
+    parser.add_argument("--readers", type=int, default=4, help="混合負荷の読み出しスレッド数")
+    parser.add_argument(
+        "--layer",
+        choices=["SqliteDB", "DBHandler"],
+        action="append",
+        help="計測する層(複数指定可)",
+    )
+    parser.add_argument("--output", help="結果のJSONを書き込むファイル。指定しない場合は標準出力")
+    parser.add_argument("--baseline", help="比較する前回の結果のJSONファイル")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="許容するrows_per_secの低下率"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    targets = [
+        target
+        for target in (SqliteDBTarget, DBHandlerTarget)
+        if not args.layer or target.layer in args.layer
+    ]
+    results = []
+    for target_class in targets:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            results.extend(run_layer(target_class, args, tmpdir))
+
+    report = {
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "sqlalchemy": sqlalchemy.__version__,
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "rows": args.rows,
+            "chunk_size": args.chunk_size,
+            "ops": OPS,
+            "range_rows": RANGE_ROWS,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"性能が低下しました: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
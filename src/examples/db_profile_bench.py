@@ -0,0 +1,72 @@
+import os.path
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+# add the parent directory of the current file to the system path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from templates.databases import SqliteDB
+from templates.databases.sqlite_db import PRAGMA_PROFILES
+
+DURATION = 3.0  # 各プロファイルの計測時間(秒)
+BATCH_SIZE = 10  # 1トランザクションで挿入するレコード数
+
+
+def run_profile(profile, db_file):
+    """書き込みスレッドと読み出しスレッドを同時に動かし、それぞれの処理件数を計測する。"""
+    # プロファイルなし(None)もNullPoolにせず、全てのプロファイルで同じ接続を使い回してPRAGMAの違いだけを比べる
+    db = SqliteDB(db_file, profile=profile, pool="queue")
+    db.add_table("sensor_data", [("timestamp", "DATETIME"), ("data", "FLOAT")])
+    stop = threading.Event()
+    counts = {"insert": 0, "select": 0, "errors": 0}
+    base_time = datetime(2023, 1, 1)
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            rows = [(str(base_time + timedelta(seconds=i + k)), float(k)) for k in range(BATCH_SIZE)]
+            try:
+                db.insert_many("sensor_data", rows)
+                counts["insert"] += BATCH_SIZE
+            except Exception:
+                counts["errors"] += 1
+            i += BATCH_SIZE
+
+    def reader():
+        while not stop.is_set():
+            try:
+                db.select(
+                    "sensor_data",
+                    columns=["COUNT(*)"],
+                    where_clause=f'timestamp > "{base_time}"',
+                )
+                counts["select"] += 1
+            except Exception:
+                counts["errors"] += 1
+
+    threads = [threading.Thread(target=writer), threading.Thread(target=reader), threading.Thread(target=reader)]
+    for t in threads:
+        t.start()
+    time.sleep(DURATION)
+    stop.set()
+    for t in threads:
+        t.join()
+    counts["connects"] = db.pool_stats["connects"]
+    db.engine.dispose()
+    return counts
+
+
+if __name__ == "__main__":
+    print(f"{'profile':<12} {'inserts/s':>12} {'selects/s':>12} {'errors':>8} {'connects':>9}")
+    for profile in [None] + list(PRAGMA_PROFILES):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            counts = run_profile(profile, os.path.join(tmpdir, "bench.db"))
+        print(
+            f"{str(profile):<12} {counts['insert'] / DURATION:>12.0f} "
+            f"{counts['select'] / DURATION:>12.0f} {counts['errors']:>8} {counts['connects']:>9}"
+        )
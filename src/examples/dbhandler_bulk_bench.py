@@ -0,0 +1,51 @@
+import os.path
+import sys
+import tempfile
+import time
+
+# add the parent directory of the current file to the system path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from sqlalchemy import Column, Float, Integer, String
+
+from templates.databases import DBHandler
+from templates.databases.db_interaction import Base
+
+
+class Reading(Base):
+    __tablename__ = "readings"
+    id = Column(Integer, primary_key=True)
+    sensor = Column(String)
+    value = Column(Float)
+
+
+def run(size, mode):
+    """指定された方法でsize件を挿入し、1秒あたりの挿入件数を返す。"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = DBHandler(f"sqlite:///{os.path.join(tmpdir, 'bench.db')}")
+        db.add_model(Reading)
+        start = time.perf_counter()
+        if mode == "add_all":
+            db.insert_many([Reading(sensor="s", value=float(i)) for i in range(size)])
+        elif mode == "bulk instances":
+            db.insert_many((Reading(sensor="s", value=float(i)) for i in range(size)), bulk=True)
+        elif mode == "bulk dicts":
+            db.insert_many(({"sensor": "s", "value": float(i)} for i in range(size)), bulk=True, model=Reading)
+        elif mode == "bulk dicts + PK":
+            db.insert_many(
+                ({"sensor": "s", "value": float(i)} for i in range(size)), bulk=True, model=Reading, return_defaults=True
+            )
+        elapsed = time.perf_counter() - start
+        db.engine.dispose()
+    return size / elapsed
+
+
+if __name__ == "__main__":
+    # 引数で件数を指定できる。例: python dbhandler_bulk_bench.py 10000 100000
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+    modes = ["add_all", "bulk instances", "bulk dicts", "bulk dicts + PK"]
+    print(f"{'rows':>10} " + " ".join(f"{mode:>16}" for mode in modes) + "   (rows/sec)")
+    for size in sizes:
+        print(f"{size:>10} " + " ".join(f"{run(size, mode):>16.0f}" for mode in modes))
@@ -1,6 +1,7 @@
 import time
 import sys
 import os
+from datetime import datetime, timedelta
 
 
 # add the parent directory of the current file to the system path
@@ -12,6 +13,7 @@ from templates.threadman.func_thread import FuncThread
 from templates.threadman.sys_thread import SysThread
 from templates.databases import SqliteDB
 from templates.system.status import StatusTracker
+from templates.utils.helper_funcs import check_disk_space
 
 
 class EdgeDBThread(SysThread):
@@ -21,8 +23,9 @@ class EdgeDBThread(SysThread):
         self.db_file = db_file
 
         self.db = None
+        self.writer = None
         self.tables = ["sensor_data"]
-        self.last_sent_index = 0  # initialize index of last sent data
+        self.last_sent_index = 0  # rowid of the last sent data
         # StatusTrackerの初期化
         self.stats_tracker = StatusTracker(id=self, initial_status=initial_statuses)   
 
@@ -30,6 +33,7 @@ class EdgeDBThread(SysThread):
         super().command_register()
         self.cmd_dispatcher.register_handler("insert", self.handle_insert_command)
         self.cmd_dispatcher.register_handler("get_data", self.handle_get_data_command)
+        self.cmd_dispatcher.register_handler("archive", self.handle_archive_command)
 
     def thread_initiate(self):
         super().thread_initiate()
@@ -39,16 +43,19 @@ class EdgeDBThread(SysThread):
             open(self.db_file, 'w').close()
 
         # create database connection
-        self.db = SqliteDB(self.db_file)
+        self.db = SqliteDB(self.db_file, profile="throughput", pool="thread")
 
         # create tables if they do not exist
         for table in self.tables:
-            self.db.add_table(table, [("timestamp", "DATETIME"), ("data", "FLOAT")])
+            self.db.add_table(table, [("timestamp", "DATETIME"), ("data", "FLOAT")], indexes=["timestamp"])
+
+        # センサーデータは1件ずつ書き込まずに、まとめて書き込む
+        self.writer = self.db.buffered_writer(max_rows=100, max_delay=0.5)
 
     def handle_insert_command(self, *args, **kwargs):
         task = kwargs["task"]
         data = task["data"]
-        self.db.insert(task["table"], data)
+        self.writer.insert(task["table"], data)
 
     def handle_get_data_command(self, *args, **kwargs):
         task = kwargs["task"]
@@ -56,50 +63,55 @@ class EdgeDBThread(SysThread):
         self.get_data_thread = FuncThread(target=self.get_data, name=f"{self.name}.get_data")
         self.get_data_thread.start()
 
+    def handle_archive_command(self, *args, **kwargs):
+        task = kwargs["task"]
+        # ディスクの空き容量が少ない場合だけ、保持期間を過ぎた送信済みのデータを圧縮ファイルに移して削除する
+        db_dir = os.path.dirname(os.path.abspath(self.db_file))
+        status = check_disk_space(db_dir, task.get("attention_size", 10), task.get("ok_size", 5))
+        if status == "OK":
+            return
+        before = datetime.now() - timedelta(days=task.get("retention_days", 7))
+        for table in self.tables:
+            summary = self.db.archive(
+                table,
+                before,
+                os.path.join(db_dir, "archive"),
+                max_rowid=self.db.change_offset(table, "sync"),
+                format="csv.gz",
+            )
+            self.logger.info(
+                f"Disk status {status}: archived {summary['rows']} rows of {table} "
+                f"into {len(summary['files'])} files, reclaimed {summary['reclaimed_pages']} pages"
+            )
+
     def thread_cleanup(self):
         super().thread_cleanup()
+        if self.writer:
+            self.writer.close()
+            self.logger.info(f"BufferedWriter stats: {self.writer.stats}")
+            self.writer = None
         if self.db:
+            self.logger.info(f"SqliteDB pool stats: {self.db.pool_stats}")
             self.db = None
 
     def get_data(self):
         # If the accumulated data is not enough (5 records), since last send, wait until get enough data and send back to EdgeSynchronizeThread
         while True:
-            # count the number of records since last sent index
-            # ROWID approach
-            # record_count = self.db.select(
-            #     "sensor_data",
-            #     columns=["COUNT(*)"],
-            #     where_clause=f"ROWID > {self.last_sent_index}",
-            # )
-            # record_count = record_count[0][0] if record_count else 0
-
-            # Timestamp Approach
-            record_count = self.db.select(
-                "sensor_data",
-                columns=["COUNT(*)"],
-                where_clause=f'timestamp > "{self.last_sent_index}"',
-            )
-            record_count = record_count[0][0] if record_count else 0
+            # get up to 5 records not yet sent, tracked by the persisted rowid offset of the "sync" consumer
+            changes = self.db.read_changes("sensor_data", "sync", limit=5, columns=["timestamp", "data"])
             # if there are not enough records, wait for 1 second and try again
-            if record_count < 5:
+            if len(changes) < 5:
                 self.logger.info(f"Not enough records since last sent index. Check again after 1 second.")
                 time.sleep(1)
             else:
                 # break out of the loop since we have sent the required number of records
                 break
 
-        # get 5 records of unsent data since last sent data index
-        data = self.db.select(
-            "sensor_data",
-            columns=["timestamp", "data"],
-            where_clause=f'timestamp > "{self.last_sent_index}"',
-            order_by="timestamp ASC",
-            limit=5,
-        )
-
         # send data to EdgeSynchronizeThread for sending to main system
+        data = [row[1:] for row in changes]
         self.add_task2queue("sync", {"cmd": "send_data", "data": data, "from": self.name})
 
         # update the sent data index
-        self.last_sent_index = data[-1][0]
-        self.logger.info(f"Update last sent index = {self.last_sent_index}")
\ No newline at end of file
+        self.last_sent_index = changes[-1][0]
+        self.db.commit_changes("sensor_data", "sync", self.last_sent_index)
+        self.logger.info(f"Update last sent index = {self.last_sent_index}")
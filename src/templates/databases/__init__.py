@@ -1,2 +1,10 @@
 from .sqlite_db import SqliteDB
-from .db_interaction import DBHandler
\ No newline at end of file
+from .archive import Archiver
+from .buffered_writer import BufferedWriter
+from .pool_stats import PoolStats
+from .query_cache import QueryCache
+from .query_stats import QueryStats
+from .single_writer import SingleWriterExecutor
+from .thread_pool import ThreadLocalConnections
+from .async_sqlite_db import AsyncSqliteDB
+from .db_interaction import DBHandler
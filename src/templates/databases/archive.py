@@ -0,0 +1,442 @@
+import csv
+import gzip
+import io
+import json
+import math
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import text
+
+ARCHIVE_FORMATS = ("npz", "csv.gz")
+# アーカイブしたチャンクを1行ずつ記録するマニフェストのファイル名
+MANIFEST_SUFFIX = "_archive.jsonl"
+
+
+class Archiver:
+    """
+    SqliteDBのテーブルから古いレコードを圧縮ファイルに書き出し、削除して領域を回収するクラス。
+
+    time_columnがbeforeより前のレコードをrowidの順にchunk_rows件ずつ読み出し、チャンクごとに
+    1つの圧縮ファイル(列ごとの配列を持つNPZ、またはgzip圧縮のCSV)に書き出します。
+    書き出したファイルを読み直して件数を確認し、データベースの件数とも一致した場合にだけ、
+    そのチャンクのレコードを削除します。削除は小さいトランザクションに分けて行い、1回の削除が
+    max_lock_timeを超えた場合は次の削除件数を半分にするため、書き込みロックを長時間保持しません。
+    auto_vacuumがINCREMENTALのデータベースでは、最後にincremental_vacuumを少しずつ実行して空きページを
+    ファイルから切り詰めます。auto_vacuumを有効にするには、テーブルを作成する前の新しいデータベースを
+    pragmas={"auto_vacuum": "INCREMENTAL"}で開いてください。
+
+    書き出したチャンクは、directory内の"<テーブル名>_archive.jsonl"にファイル名、件数、rowidと時刻の範囲を
+    1行ずつ追記します。
+    AUTOINCREMENTの列がないテーブルでは、最大のrowidのレコードを削除するとSQLiteがrowidを再利用し、
+    変更フィードの既読位置より前のrowidが新しいレコードに振られるため、最大のrowidのレコードはアーカイブしません。
+
+    Parameters
+    ----------
+    db : SqliteDB
+        アーカイブするデータベース。
+    directory : str
+        圧縮ファイルを書き出すディレクトリ。存在しない場合は作成します。
+    format : str, optional
+        "npz"(numpyが必要)または"csv.gz"。デフォルトは"npz"です。
+    chunk_rows : int, optional
+        1つのファイルに書き出すレコード数。デフォルトは10000です。
+    delete_batch : int, optional
+        1つのトランザクションで削除するレコード数の上限。デフォルトは1000です。
+    max_lock_time : float, optional
+        1回の削除で書き込みロックを保持する目安の時間(秒)。デフォルトは0.05秒です。
+    vacuum_pages : int, optional
+        1回のincremental_vacuumで回収するページ数。デフォルトは256です。
+
+    """
+
+    def __init__(
+        self,
+        db,
+        directory: str,
+        format: str = "npz",
+        chunk_rows: int = 10000,
+        delete_batch: int = 1000,
+        max_lock_time: float = 0.05,
+        vacuum_pages: int = 256,
+    ):
+        if format not in ARCHIVE_FORMATS:
+            raise ValueError(f"不明なアーカイブ形式です: format={format}, 有効な値={ARCHIVE_FORMATS}")
+        for name, value in (
+            ("chunk_rows", chunk_rows),
+            ("delete_batch", delete_batch),
+            ("vacuum_pages", vacuum_pages),
+        ):
+            if value < 1:
+                raise ValueError(f"{name} は1以上を指定してください: {name}={value}")
+        if format == "npz":
+            try:
+                import numpy as np
+            except ImportError as e:
+                raise ImportError("npz形式でアーカイブするには numpy をインストールしてください。") from e
+            self._np = np
+        self.db = db
+        self.directory = directory
+        self.format = format
+        self.chunk_rows = chunk_rows
+        self.delete_batch = delete_batch
+        self.max_lock_time = max_lock_time
+        self.vacuum_pages = vacuum_pages
+
+    def run(
+        self,
+        table_name: str,
+        before,
+        time_column: str = "timestamp",
+        max_rowid: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """
+        time_columnがbeforeより前のレコードをアーカイブして削除します。
+
+        Parameters
+        ----------
+        table_name : str
+            テーブル名。
+        before : datetime or str
+            この日時より前のレコードをアーカイブします。
+        time_column : str, optional
+            日時の列名。デフォルトは"timestamp"です。
+        max_rowid : int, optional
+            アーカイブするレコードのrowidの上限。変更フィードのコンシューマーがまだ読んでいないレコードを
+            残す場合に、change_offset()の値を指定します。デフォルトはNone(上限なし)です。
+
+        Returns
+        -------
+        Dict[str, Any]
+            アーカイブしたレコード数(rows)、書き出したファイルのパスのリスト(files)、削除したレコード数(deleted)、
+            削除のトランザクション数(delete_transactions)と最長の時間(max_delete_time、秒)、
+            回収したページ数(reclaimed_pages)と、残った空きページ数(freelist_pages)。
+
+        """
+        if table_name in self.db.partitioned:
+            raise ValueError(
+                f"分割テーブルは drop_partitions で削除してください: table_name={table_name}"
+            )
+        schema = self.db.schema.get(table_name) or self.db.reflect().get(table_name)
+        if schema is None:
+            raise ValueError(f"テーブルが存在しません: table_name={table_name}")
+        if time_column not in schema["columns"]:
+            raise ValueError(
+                f"列が存在しません: table_name={table_name}, time_column={time_column}"
+            )
+        os.makedirs(self.directory, exist_ok=True)
+        if not self._has_autoincrement(table_name):
+            newest = self._newest_rowid(table_name)
+            if newest is not None:
+                max_rowid = (
+                    newest - 1 if max_rowid is None else min(max_rowid, newest - 1)
+                )
+
+        summary = {
+            "rows": 0,
+            "files": [],
+            "deleted": 0,
+            "delete_transactions": 0,
+            "max_delete_time": 0.0,
+        }
+        cutoff = str(before)
+        last_rowid = 0
+        while True:
+            rows = self._read_chunk(
+                table_name, time_column, cutoff, last_rowid, max_rowid
+            )
+            if not rows:
+                break
+            first_rowid, last_rowid = rows[0][0], rows[-1][0]
+            path = self._write_chunk(table_name, schema, rows)
+            self._verify_chunk(
+                table_name,
+                time_column,
+                cutoff,
+                path,
+                first_rowid,
+                last_rowid,
+                len(rows),
+            )
+            times = [row[1 + schema["columns"].index(time_column)] for row in rows]
+            self._append_manifest(
+                table_name, path, rows, first_rowid, last_rowid, times, cutoff
+            )
+            summary["rows"] += len(rows)
+            summary["files"].append(path)
+            self._delete_chunk(
+                table_name, time_column, cutoff, first_rowid, last_rowid, summary
+            )
+
+        summary.update(self._incremental_vacuum())
+        return summary
+
+    def _has_autoincrement(self, table_name: str) -> bool:
+        """テーブルがAUTOINCREMENTの列を持ち、削除したrowidが再利用されないかどうかを返します。"""
+        with self.db.get_session() as session:
+            sql = session.execute(
+                text(
+                    "SELECT sql FROM sqlite_master "
+                    "WHERE type = 'table' AND name = :name"
+                ),
+                {"name": table_name},
+            ).scalar()
+        return sql is not None and "AUTOINCREMENT" in sql.upper()
+
+    def _newest_rowid(self, table_name: str) -> Optional[int]:
+        with self.db.get_session() as session:
+            return session.execute(
+                text(f"SELECT MAX(rowid) FROM {table_name}")
+            ).scalar()
+
+    def _read_chunk(
+        self,
+        table_name: str,
+        time_column: str,
+        cutoff: str,
+        last_rowid: int,
+        max_rowid: Optional[int],
+    ) -> List[Tuple]:
+        """rowidの順にchunk_rows件を読み出します。読み出しごとにセッションを閉じ、長い読み取りを避けます。"""
+        bound = " AND rowid <= :max_rowid" if max_rowid is not None else ""
+        statement = text(
+            f"SELECT rowid, * FROM {table_name} "
+            f"WHERE {time_column} < :cutoff AND rowid > :last_rowid{bound} "
+            f"ORDER BY rowid LIMIT :limit"
+        )
+        params = {
+            "cutoff": cutoff,
+            "last_rowid": last_rowid,
+            "limit": self.chunk_rows,
+            "max_rowid": max_rowid,
+        }
+        with self.db.get_session() as session:
+            return session.execute(statement, params).fetchall()
+
+    def _chunk_path(self, table_name: str, first_rowid: int, last_rowid: int) -> str:
+        return os.path.join(
+            self.directory,
+            f"{table_name}_{first_rowid:012d}_{last_rowid:012d}.{self.format}",
+        )
+
+    def _write_chunk(self, table_name: str, schema: dict, rows: List[Tuple]) -> str:
+        """チャンクを一時ファイルに書き出してから名前を変え、書きかけのファイルが残らないようにします。"""
+        path = self._chunk_path(table_name, rows[0][0], rows[-1][0])
+        temp_path = path + ".tmp"
+        names = ["rowid"] + list(schema["columns"])
+        affinities = ["INTEGER"] + list(schema["affinities"])
+        with open(temp_path, "wb") as f:
+            if self.format == "npz":
+                self._np.savez_compressed(
+                    f, **self._npz_arrays(names, affinities, rows)
+                )
+            else:
+                with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+                    with io.TextIOWrapper(gz, encoding="utf-8", newline="") as out:
+                        writer = csv.writer(out)
+                        writer.writerow(names)
+                        writer.writerows(rows)
+        os.replace(temp_path, path)
+        return path
+
+    def _npz_arrays(
+        self, names: Sequence[str], affinities: Sequence[str], rows: List[Tuple]
+    ) -> dict:
+        """
+        列ごとの配列を作成します。NULLを含む列は"<列名>.null"にNULLの位置の真偽値の配列を加えます。
+
+        pickleを使わずに読み込めるように、値の型が揃わない列は文字列の配列にします。
+        """
+        np = self._np
+        arrays = {}
+        for i, (name, affinity) in enumerate(zip(names, affinities)):
+            values = [row[i] for row in rows]
+            nulls = [value is None for value in values]
+            present = [value for value in values if value is not None]
+            if all(isinstance(value, int) for value in present) and affinity != "TEXT":
+                array = np.array(
+                    [0 if value is None else value for value in values], dtype="i8"
+                )
+            elif (
+                all(isinstance(value, (int, float)) for value in present)
+                and affinity != "TEXT"
+            ):
+                array = np.array(
+                    [math.nan if value is None else value for value in values],
+                    dtype="f8",
+                )
+            elif all(isinstance(value, bytes) for value in present):
+                array = np.array(
+                    [b"" if value is None else value for value in values], dtype="S"
+                )
+            else:
+                array = np.array(
+                    ["" if value is None else str(value) for value in values], dtype="U"
+                )
+            arrays[name] = array
+            if any(nulls):
+                arrays[f"{name}.null"] = np.array(nulls, dtype=bool)
+        return arrays
+
+    def _count_file_rows(self, path: str) -> int:
+        if self.format == "npz":
+            with self._np.load(path, allow_pickle=False) as archive:
+                lengths = {len(archive[name]) for name in archive.files}
+            if len(lengths) != 1:
+                raise RuntimeError(f"アーカイブファイルの列の長さが一致しません: path={path}")
+            return lengths.pop()
+        with gzip.open(path, "rt", encoding="utf-8", newline="") as f:
+            return sum(1 for _ in csv.reader(f)) - 1
+
+    def _verify_chunk(
+        self,
+        table_name: str,
+        time_column: str,
+        cutoff: str,
+        path: str,
+        first_rowid: int,
+        last_rowid: int,
+        count: int,
+    ):
+        """ファイルの件数と、削除する範囲のデータベースの件数が、読み出した件数と一致することを確認します。"""
+        written = self._count_file_rows(path)
+        with self.db.get_session() as session:
+            stored = session.execute(
+                text(
+                    f"SELECT COUNT(*) FROM {table_name} "
+                    "WHERE rowid BETWEEN :first_rowid AND :last_rowid "
+                    f"AND {time_column} < :cutoff"
+                ),
+                {
+                    "first_rowid": first_rowid,
+                    "last_rowid": last_rowid,
+                    "cutoff": cutoff,
+                },
+            ).scalar()
+        if written != count or stored != count:
+            raise RuntimeError(
+                f"アーカイブの件数が一致しないため、削除を中止しました: path={path}, "
+                f"読み出し={count}, ファイル={written}, データベース={stored}"
+            )
+
+    def _append_manifest(
+        self,
+        table_name: str,
+        path: str,
+        rows: List[Tuple],
+        first_rowid: int,
+        last_rowid: int,
+        times: list,
+        cutoff: str,
+    ):
+        present = [str(value) for value in times if value is not None]
+        entry = {
+            "file": os.path.basename(path),
+            "rows": len(rows),
+            "first_rowid": first_rowid,
+            "last_rowid": last_rowid,
+            "min_time": min(present) if present else None,
+            "max_time": max(present) if present else None,
+            "before": cutoff,
+            "archived_at": datetime.now(timezone.utc).isoformat(),
+        }
+        with open(
+            os.path.join(self.directory, table_name + MANIFEST_SUFFIX),
+            "a",
+            encoding="utf-8",
+        ) as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def _delete_chunk(
+        self,
+        table_name: str,
+        time_column: str,
+        cutoff: str,
+        first_rowid: int,
+        last_rowid: int,
+        summary: dict,
+    ):
+        """チャンクのレコードを、1回の削除時間がmax_lock_timeに収まるように件数を調整しながら削除します。"""
+        batch = self.delete_batch
+        while True:
+            start = time.perf_counter()
+            deleted = self._write(
+                self._delete_batch,
+                table_name,
+                time_column,
+                cutoff,
+                first_rowid,
+                last_rowid,
+                batch,
+            )
+            elapsed = time.perf_counter() - start
+            if deleted == 0:
+                return
+            summary["deleted"] += deleted
+            summary["delete_transactions"] += 1
+            summary["max_delete_time"] = max(summary["max_delete_time"], elapsed)
+            if elapsed > self.max_lock_time:
+                batch = max(1, batch // 2)
+            elif elapsed < self.max_lock_time / 4:
+                batch = min(self.delete_batch, batch * 2)
+            # 削除の合間に、他のスレッドの書き込みがロックを取得できるようにする
+            time.sleep(0)
+
+    @staticmethod
+    def _delete_batch(
+        connection,
+        table_name: str,
+        time_column: str,
+        cutoff: str,
+        first_rowid: int,
+        last_rowid: int,
+        batch: int,
+    ) -> int:
+        result = connection.execute(
+            text(
+                f"DELETE FROM {table_name} WHERE rowid IN ("
+                f"SELECT rowid FROM {table_name} "
+                "WHERE rowid BETWEEN :first_rowid AND :last_rowid "
+                f"AND {time_column} < :cutoff ORDER BY rowid LIMIT :batch)"
+            ),
+            {
+                "first_rowid": first_rowid,
+                "last_rowid": last_rowid,
+                "cutoff": cutoff,
+                "batch": batch,
+            },
+        )
+        return result.rowcount
+
+    def _incremental_vacuum(self) -> Dict[str, int]:
+        """auto_vacuumがINCREMENTALの場合に、空きページをvacuum_pagesずつ回収します。"""
+        freelist = self._pragma("freelist_count")
+        if self._pragma("auto_vacuum") != 2:
+            return {"reclaimed_pages": 0, "freelist_pages": freelist}
+        reclaimed = 0
+        while freelist > 0:
+            self._write(self._vacuum_step, self.vacuum_pages)
+            remaining = self._pragma("freelist_count")
+            if remaining >= freelist:
+                break
+            reclaimed += freelist - remaining
+            freelist = remaining
+            time.sleep(0)
+        return {"reclaimed_pages": reclaimed, "freelist_pages": freelist}
+
+    @staticmethod
+    def _vacuum_step(connection, pages: int):
+        connection.exec_driver_sql(f"PRAGMA incremental_vacuum({int(pages)})")
+
+    def _pragma(self, name: str) -> int:
+        with self.db.get_session() as session:
+            return session.connection().exec_driver_sql(f"PRAGMA {name}").scalar()
+
+    def _write(self, fn, *args) -> Optional[Any]:
+        """書き込みを、SingleWriterExecutorが開始されていればその書き込みスレッドで、それ以外は直接実行します。"""
+        if self.db.executor is not None:
+            return self.db.executor.submit_write(fn, *args).result()
+        with self.db.get_session() as session:
+            return fn(session.connection(), *args)
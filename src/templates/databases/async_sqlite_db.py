@@ -0,0 +1,129 @@
+import asyncio
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .sqlite_db import SqliteDB
+
+
+class AsyncSqliteDB:
+    """
+    SqliteDBの操作をasyncioのコルーチンとして提供するクラス。
+
+    書き込み(add_table/insert/insert_many/update/delete)はSingleWriterExecutorの書き込みスレッド1本で
+    実行し(連続した書き込みは1つのトランザクションにまとめられます)、読み出し(select)は読み出し用の
+    スレッドプールで並行して実行するため、イベントループをブロックしません。
+    実行中・待機中の操作数はmax_in_flightまでに制限され、上限に達すると呼び出し側が待たされます。
+
+    Parameters
+    ----------
+    db_file : str
+        SQLiteデータベースのファイルパス。
+    readers : int, optional
+        読み出し用スレッドの数。デフォルトは4です。
+    max_in_flight : int, optional
+        同時に受け付ける操作数の上限。デフォルトは64です。
+    max_batch : int, optional
+        1つのトランザクションにまとめる書き込みの最大数。デフォルトは100です。
+    **kwargs
+        SqliteDBに渡す引数(profile、pragmas、poolなど)。
+
+    Attributes
+    ----------
+    db : SqliteDB
+        操作を実行するSqliteDB。
+    executor : SingleWriterExecutor
+        書き込みスレッドと読み出し用スレッドプール。
+
+    """
+
+    def __init__(
+        self,
+        db_file: str,
+        readers: int = 4,
+        max_in_flight: int = 64,
+        max_batch: int = 100,
+        **kwargs,
+    ):
+        if max_in_flight < 1:
+            raise ValueError(
+                f"max_in_flight は1以上を指定してください: max_in_flight={max_in_flight}"
+            )
+        self.db = SqliteDB(db_file, **kwargs)
+        self.max_in_flight = max_in_flight
+        self.executor = self.db.start_single_writer(
+            readers=readers, max_batch=max_batch
+        )
+        # Python 3.9以前ではSemaphoreが作成時のイベントループに紐付くため、最初の操作時に作成する
+        self._semaphore = None
+
+    async def add_table(
+        self, table_name: str, columns: List[Tuple[str, str]], **kwargs
+    ):
+        """SqliteDB.add_tableを書き込みスレッドで実行します。"""
+        await self._run(
+            self.executor.submit, self.db.add_table, table_name, columns, **kwargs
+        )
+
+    async def insert(self, table_name: str, values: Tuple):
+        """SqliteDB.insertを書き込みスレッドで実行します。"""
+        await self._run(self.executor.insert, table_name, values)
+
+    async def insert_many(
+        self, table_name: str, values: Iterable[Tuple], chunk_size: int = 1000
+    ) -> int:
+        """SqliteDB.insert_manyを書き込みスレッドで実行し、挿入したレコード数を返します。"""
+        return await self._run(
+            self.executor.insert_many, table_name, values, chunk_size
+        )
+
+    async def select(
+        self,
+        table_name: str,
+        columns: List[str] = None,
+        where_clause: str = None,
+        order_by: str = None,
+        join_clause: str = None,
+        limit: int = None,
+        params: Optional[Dict[str, Any]] = None,
+    ) -> List[Tuple]:
+        """SqliteDB.selectを読み出し用スレッドで実行し、結果を返します。"""
+        return await self._run(
+            self.executor.select,
+            table_name,
+            columns,
+            where_clause,
+            order_by,
+            join_clause,
+            limit,
+            params,
+        )
+
+    async def update(self, table_name: str, set_clause: str, where_clause: str):
+        """SqliteDB.updateを書き込みスレッドで実行します。"""
+        await self._run(self.executor.update, table_name, set_clause, where_clause)
+
+    async def delete(self, table_name: str, where_clause: str):
+        """SqliteDB.deleteを書き込みスレッドで実行します。"""
+        await self._run(self.executor.delete, table_name, where_clause)
+
+    async def close(self):
+        """実行中の操作の完了を待ってから、スレッドとエンジンを終了します。"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._shutdown)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def _shutdown(self):
+        self.db.stop_single_writer()
+        self.db.engine.dispose()
+
+    async def _run(self, submit: Callable[..., Future], *args, **kwargs):
+        """操作数の上限内で、executorに操作を投入し、その完了を待ちます。"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        async with self._semaphore:
+            return await asyncio.wrap_future(submit(*args, **kwargs))
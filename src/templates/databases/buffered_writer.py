@@ -0,0 +1,271 @@
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.exc import OperationalError
+
+# rejectedに保持する、書き込めなかったレコードの件数の上限
+MAX_REJECTED = 100
+
+
+class BufferedWriter:
+    """
+    SqliteDBへの単一レコード挿入をテーブルごとにバッファリングし、まとめて書き込むクラス。
+
+    行数のしきい値(max_rows)または最古の未書き込みレコードの経過時間(max_delay)に達すると、
+    バッファ内の全テーブルのレコードを1つのトランザクションで書き込みます。
+    close()時にも残りのレコードを書き込みます。
+    データベースのロック(database is locked、SQLITE_BUSY)で書き込めなかった場合は、レコードをバッファに戻して
+    次の書き込みで再試行します。制約違反や列数の誤り、存在しないテーブルなどのそれ以外のエラーでは、
+    バッチを半分に分けて書き込み直し、原因のレコードだけを取り除いてrejectedに記録します。
+
+    Parameters
+    ----------
+    db : SqliteDB
+        書き込み先のデータベース。
+    max_rows : int, optional
+        書き込みを行うバッファ内のレコード数のしきい値。デフォルトは500です。
+    max_delay : float, optional
+        レコードをバッファに保持する最大秒数。デフォルトは1.0秒です。
+    chunk_size : int, optional
+        1回のexecutemanyで送信するレコード数。デフォルトは1000です。
+
+    Attributes
+    ----------
+    stats : dict
+        書き込み回数、書き込みレコード数、書き込めなかったレコード数、バッチサイズ、書き込み所要時間(秒)の統計。
+    rejected : List[Tuple[str, Tuple, Exception]]
+        書き込めずに取り除いたレコードの、テーブル名、値、例外のタプルのリスト。直近のMAX_REJECTED件まで保持します。
+    error : Exception or None
+        バックグラウンドの書き込みで最後に発生したエラー。
+
+    """
+
+    def __init__(
+        self, db, max_rows: int = 500, max_delay: float = 1.0, chunk_size: int = 1000
+    ):
+        if max_rows < 1:
+            raise ValueError(f"max_rows は1以上を指定してください: max_rows={max_rows}")
+        if max_delay <= 0:
+            raise ValueError(f"max_delay は0より大きい値を指定してください: max_delay={max_delay}")
+        if chunk_size < 1:
+            raise ValueError(f"chunk_size は1以上を指定してください: chunk_size={chunk_size}")
+        self.db = db
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.chunk_size = chunk_size
+        self._buffer: Dict[str, List[Tuple]] = {}
+        self._pending = 0
+        self._oldest = None
+        self._closed = False
+        self._error = None
+        self._rejected = deque(maxlen=MAX_REJECTED)
+        self._stats = {
+            "flushes": 0,
+            "rows": 0,
+            "rejected": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_flush_latency": 0.0,
+            "max_flush_latency": 0.0,
+            "total_flush_latency": 0.0,
+        }
+        # バッファ操作用のロックと、書き込みを直列化するロック
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, name="SqliteDB.BufferedWriter", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def stats(self) -> dict:
+        with self._cond:
+            stats = dict(self._stats)
+            stats["pending"] = self._pending
+        stats["avg_flush_latency"] = (
+            stats["total_flush_latency"] / stats["flushes"] if stats["flushes"] else 0.0
+        )
+        return stats
+
+    @property
+    def error(self) -> Optional[Exception]:
+        return self._error
+
+    @property
+    def rejected(self) -> List[Tuple[str, Tuple, Exception]]:
+        with self._cond:
+            return list(self._rejected)
+
+    def insert(self, table_name: str, values: Tuple):
+        """
+        レコードをバッファに追加します。しきい値に達した場合はその場で書き込みます。
+
+        Parameters
+        ----------
+        table_name : str
+            テーブル名。
+        values : Tuple
+            新しいレコードの値のタプル。
+
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("BufferedWriter はすでに閉じられています。")
+            self._buffer.setdefault(table_name, []).append(tuple(values))
+            self._pending += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+                self._cond.notify()
+            should_flush = self._pending >= self.max_rows
+        if should_flush:
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        バッファ内の全レコードを1つのトランザクションで書き込みます。
+
+        データベースのロックで書き込めなかったレコードはバッファの先頭に戻され、例外が再送出されます。
+        それ以外のエラーの原因のレコードは、例外を送出せずに取り除かれ、rejectedに記録されます。
+
+        Returns
+        -------
+        int
+            書き込んだレコード数。
+
+        """
+        with self._flush_lock:
+            with self._cond:
+                batch, self._buffer = self._buffer, {}
+                batch_size, self._pending = self._pending, 0
+                self._oldest = None
+            if not batch_size:
+                return 0
+
+            start = time.perf_counter()
+            try:
+                self._write(batch)
+                written = batch_size
+            except Exception as e:
+                if self._is_locked(e):
+                    self._requeue(batch, batch_size)
+                    raise
+                written = self._write_isolating(batch)
+            latency = time.perf_counter() - start
+
+            with self._cond:
+                self._stats["flushes"] += 1
+                self._stats["rows"] += written
+                self._stats["last_batch_size"] = batch_size
+                self._stats["max_batch_size"] = max(
+                    self._stats["max_batch_size"], batch_size
+                )
+                self._stats["last_flush_latency"] = latency
+                self._stats["max_flush_latency"] = max(
+                    self._stats["max_flush_latency"], latency
+                )
+                self._stats["total_flush_latency"] += latency
+            return written
+
+    def _write(self, batch: Dict[str, List[Tuple]]):
+        """
+        テーブルごとのレコードを1つのトランザクションで書き込みます。
+
+        SingleWriterExecutorが開始されている場合は、その書き込みスレッドで実行します。
+        """
+        if self.db.executor is not None:
+            self.db.executor.submit_write(self._write_rows, batch).result()
+            return
+        with self.db.get_session() as session:
+            self._write_rows(session.connection(), batch)
+
+    def _write_rows(self, connection, batch: Dict[str, List[Tuple]]):
+        for table_name, rows in batch.items():
+            self.db._insert_rows(connection, table_name, rows, self.chunk_size)
+
+    def _write_isolating(self, batch: Dict[str, List[Tuple]]) -> int:
+        """
+        失敗したバッチを半分に分けて別々のトランザクションで書き込み直し、原因のレコードだけを取り除きます。
+
+        途中でデータベースのロックで書き込めなかった場合は、まだ書き込んでいないレコードだけをバッファに戻します。
+        """
+        written = 0
+        # 先頭のレコードから書き込むように、末尾から取り出すスタックに逆順で積む
+        pending = [(table_name, rows) for table_name, rows in batch.items()][::-1]
+        while pending:
+            table_name, rows = pending.pop()
+            try:
+                self._write({table_name: rows})
+                written += len(rows)
+            except Exception as e:
+                if self._is_locked(e):
+                    pending.append((table_name, rows))
+                    remaining = {}
+                    for name, part in reversed(pending):
+                        remaining.setdefault(name, []).extend(part)
+                    self._requeue(remaining, sum(len(part) for _, part in pending))
+                    raise
+                if len(rows) == 1:
+                    with self._cond:
+                        self._rejected.append((table_name, rows[0], e))
+                        self._stats["rejected"] += 1
+                    continue
+                middle = len(rows) // 2
+                pending.append((table_name, rows[middle:]))
+                pending.append((table_name, rows[:middle]))
+        return written
+
+    @staticmethod
+    def _is_locked(error: Exception) -> bool:
+        """データベースのロック(SQLITE_BUSY/SQLITE_LOCKED)による、再試行で解消しうるエラーかどうかを返します。"""
+        if not isinstance(error, OperationalError):
+            return False
+        message = str(error.orig).lower()
+        return "locked" in message or "busy" in message
+
+    def close(self):
+        """バックグラウンドスレッドを停止し、残りのレコードを書き込みます。"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _requeue(self, batch: Dict[str, List[Tuple]], batch_size: int):
+        """書き込みに失敗したレコードを、後から追加されたレコードより前に戻します。"""
+        with self._cond:
+            for table_name, rows in self._buffer.items():
+                batch.setdefault(table_name, []).extend(rows)
+            self._buffer = batch
+            self._pending += batch_size
+            self._oldest = time.monotonic()
+            self._cond.notify()
+
+    def _run(self):
+        """最古のレコードがmax_delayを超えたら書き込むバックグラウンドループ。"""
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if self._oldest is None:
+                        self._cond.wait()
+                        continue
+                    remaining = self._oldest + self.max_delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+                self._error = None
+            except Exception as e:
+                self._error = e
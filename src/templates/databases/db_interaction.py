@@ -1,13 +1,115 @@
-from sqlalchemy import create_engine, MetaData, select
-from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy.engine.url import URL
+from sqlalchemy import (
+    create_engine,
+    MetaData,
+    select,
+    inspect,
+    and_,
+    or_,
+    event,
+    bindparam,
+    tuple_,
+    false,
+)
+from sqlalchemy.orm import (
+    sessionmaker,
+    Session,
+    joinedload,
+    selectinload,
+    make_transient_to_detached,
+)
+from sqlalchemy.orm import RelationshipProperty
+from sqlalchemy.engine.url import URL, make_url
+from collections import Counter
 from contextlib import contextmanager
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import SQLAlchemyError, OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from typing import Type, Optional
+from sqlalchemy.orm.attributes import (
+    instance_state,
+    InstrumentedAttribute,
+    set_committed_value,
+)
+from sqlalchemy.sql.util import find_tables
+from sqlalchemy.pool import QueuePool
+from itertools import groupby, islice
+import copy
+import threading
+import time
+import warnings
+from typing import Any, Iterable, Iterator, List, Sequence, Tuple, Type, Optional, Union
+
+from .pool_stats import PoolStats
+from .query_cache import QueryCache
+from .query_stats import QueryStats
 
 Base = declarative_base()
 
+# selectのoptionsに文字列や属性で指定した関連の読み込み方法
+LOADERS = {"joined": joinedload, "selectin": selectinload}
+
+# 書き込んだテーブル名をセッションに記録するキー。コミット後にキャッシュを無効化するために使う
+_WRITTEN_TABLES = "written_tables"
+
+
+def _mark_written(session: Session, tables):
+    session.info.setdefault(_WRITTEN_TABLES, set()).update(
+        table.name for table in tables
+    )
+
+
+def _freeze(value):
+    """バインドパラメーターの値をキャッシュのキーに使えるように変換する。"""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _copy_results(results: list) -> list:
+    """
+    キャッシュした結果を、呼び出し元が変更しても他の呼び出し元に影響しないように複製する。
+
+    Rowは変更できないためそのまま返し、辞書は複製する。ORMのインスタンスは、読み込み済みの属性と
+    一緒に読み込んだ関連ごと、新しい切り離されたインスタンスに複製する。
+    """
+    memo = {}
+    copied = []
+    for result in results:
+        if isinstance(result, dict):
+            copied.append(copy.deepcopy(result))
+        elif hasattr(result, "_sa_instance_state"):
+            copied.append(_copy_instance(result, memo))
+        else:
+            copied.append(result)
+    return copied
+
+
+def _copy_instance(instance, memo: dict):
+    """切り離されたインスタンスを複製する。結果の中で同じインスタンスへの参照は、同じ複製を参照する。"""
+    copied = memo.get(id(instance))
+    if copied is not None:
+        return copied
+    state = instance_state(instance)
+    mapper = state.mapper
+    copied = mapper.class_manager.new_instance()
+    memo[id(instance)] = copied
+    # state.dictには読み込み済みの属性だけが含まれる
+    for key, value in list(state.dict.items()):
+        prop = mapper.attrs.get(key)
+        if prop is None:
+            continue
+        if not isinstance(prop, RelationshipProperty):
+            value = copy.deepcopy(value)
+        elif prop.uselist:
+            value = [_copy_instance(item, memo) for item in value]
+        elif value is not None:
+            value = _copy_instance(value, memo)
+        set_committed_value(copied, key, value)
+    # 主キーから識別子を設定し、読み込んでいない属性は元のインスタンスと同じく未読み込みにする
+    make_transient_to_detached(copied)
+    return copied
+
+
 class DBHandler:
     """
     データベース操作を抽象化するためのハンドラークラス。
@@ -20,20 +122,271 @@ class DBHandler:
         SQLAlchemyを使用したデータベースエンジン。
     Session : sqlalchemy.orm.session.sessionmaker
         データベースセッションを作成するためのsessionmakerインスタンス。
+    cache : Optional[QueryCache]
+        selectの結果のキャッシュ。cache_sizeを指定しない場合はNone。
+    debug : bool
+        Trueの場合、get_sessionのブロックごとに実行したSQL文を数え、N+1パターンを警告する。
+    statement_timeout : Optional[float]
+        1つのSQL文の実行時間の上限(秒)。
+    query_stats : Optional[QueryStats]
+        enable_query_stats()で有効にしたSQL文の実行時間の集計。無効の場合はNone。
     """
 
-    def __init__(self, database_uri: str):
+    def __init__(
+        self,
+        database_uri: str,
+        cache_size: int = 0,
+        cache_ttl: Optional[float] = 60.0,
+        debug: bool = False,
+        n_plus_one_threshold: int = 10,
+        pool_size: Optional[int] = None,
+        max_overflow: Optional[int] = None,
+        pool_timeout: Optional[float] = None,
+        pool_recycle: Optional[int] = None,
+        pool_pre_ping: bool = False,
+        statement_timeout: Optional[float] = None,
+    ):
         """
         Parameters
         ----------
         database_uri : str
             データベースへの接続URI。
+        cache_size : int, optional
+            selectの結果をキャッシュするエントリの最大数。0の場合はキャッシュしない。デフォルトは0。
+            キャッシュはセッションを指定しないselectにだけ使われ、このハンドラーのinsert、insert_many、
+            update、deleteで書き込んだテーブルのエントリは、コミット後に削除される。
+            キャッシュから返すインスタンスや辞書は呼び出しごとの複製のため、変更しても他の結果に影響しない。
+            optionsにローダーオプションのオブジェクト(例: joinedload(User.addresses))を指定したselectはキャッシュしない。
+        cache_ttl : Optional[float], optional
+            キャッシュの有効期限(秒)。Noneの場合は期限切れにならない。デフォルトは60秒。
+        debug : bool, optional
+            Trueの場合、get_sessionのブロックごとに実行したSQL文を数え、同じSELECT文がn_plus_one_threshold回以上
+            実行されたブロックをN+1パターンとして警告する。数はlast_statement_countで取得できる。デフォルトはFalse。
+        n_plus_one_threshold : int, optional
+            N+1パターンとみなす、1つのブロック内で同じSELECT文が実行された回数。デフォルトは10。
+        pool_size : Optional[int], optional
+            常時保持する接続数。pool_size、max_overflow、pool_timeoutのいずれかを指定した場合は
+            QueuePoolを使用する。デフォルトはNone(SQLAlchemyの既定値)。
+        max_overflow : Optional[int], optional
+            pool_sizeを超えて作成できる接続数。
+        pool_timeout : Optional[float], optional
+            空き接続を待つ最大秒数。超えた場合はsqlalchemy.exc.TimeoutErrorが発生する。
+        pool_recycle : Optional[int], optional
+            接続を作り直すまでの秒数。サーバー側で切断される前に接続を入れ替える。
+        pool_pre_ping : bool, optional
+            Trueの場合、接続の貸し出し時に疎通を確認し、切断された接続を作り直す。デフォルトはFalse。
+        statement_timeout : Optional[float], optional
+            1つのSQL文の実行時間の上限(秒)。PostgreSQLではstatement_timeout、MySQLではmax_execution_timeを
+            各接続に設定し、SQLiteではプログレスハンドラーで実行を中断する。SQLiteでは実行を開始してから、
+            次のSQL文の実行かトランザクションの終了までを計測するため、結果の行の読み出しも含む。
+            デフォルトはNone(上限なし)。
         """
 
         # データベースエンジンの作成
-        self.engine = create_engine(database_uri)
+        engine_options = {}
+        if (
+            pool_size is not None
+            or max_overflow is not None
+            or pool_timeout is not None
+        ):
+            engine_options["poolclass"] = QueuePool
+            if make_url(database_uri).get_backend_name() == "sqlite":
+                # プールの接続は複数のスレッドで使い回される
+                engine_options["connect_args"] = {"check_same_thread": False}
+            for name, value in (
+                ("pool_size", pool_size),
+                ("max_overflow", max_overflow),
+                ("pool_timeout", pool_timeout),
+            ):
+                if value is not None:
+                    engine_options[name] = value
+        if pool_recycle is not None:
+            engine_options["pool_recycle"] = pool_recycle
+        if pool_pre_ping:
+            engine_options["pool_pre_ping"] = True
+        self.engine = create_engine(database_uri, **engine_options)
+        self.statement_timeout = statement_timeout
+        if statement_timeout is not None:
+            self._install_statement_timeout(statement_timeout)
+        self.query_stats = None
+        if not isinstance(self.engine.pool, QueuePool):
+            max_overflow = 0
+        elif max_overflow is None:
+            # QueuePoolのmax_overflowの既定値
+            max_overflow = 10
+        self._pool_stats = PoolStats(self.engine, max_overflow=max_overflow)
         self.Session = sessionmaker(bind=self.engine)
-        
+        self.cache = QueryCache(cache_size, cache_ttl) if cache_size else None
+        if self.cache is not None:
+            event.listen(self.Session, "after_commit", self._invalidate_written_tables)
+        self.debug = debug
+        self.n_plus_one_threshold = n_plus_one_threshold
+        # get_sessionのブロックごとのSQL文の数は、スレッドごとに数える
+        self._local = threading.local()
+        if debug:
+            event.listen(self.engine, "before_cursor_execute", self._count_statement)
+
+    @property
+    def pool_stats(self) -> dict:
+        """
+        コネクションプールの統計。
+
+        接続数(connects)、貸し出し回数(checkouts)、貸し出し中の接続数(checked_out)とその最大値、
+        空き接続を待った回数(waits)と待ち時間(秒)など。詳細はPoolStats.snapshot()を参照してください。
+        """
+        return self._pool_stats.snapshot()
+
+    def enable_query_stats(
+        self, logger=None, slow_threshold: float = 0.5, **kwargs
+    ) -> QueryStats:
+        """
+        SQL文の実行時間の集計を開始する。すでに開始している場合は、その集計を返す。
+
+        Parameters
+        ----------
+        logger : optional
+            slow_threshold秒以上かかったSQL文を出力するロガー。
+        slow_threshold : float, optional
+            遅いSQL文とみなす実行時間(秒)。デフォルトは0.5秒。
+        **kwargs
+            QueryStatsに渡すその他の引数(buckets、max_templates)。
+
+        Returns
+        -------
+        QueryStats
+            集計結果を持つオブジェクト。snapshot()で統計を取得する。
+        """
+
+        if self.query_stats is None:
+            self.query_stats = QueryStats(
+                self.engine, logger=logger, slow_threshold=slow_threshold, **kwargs
+            )
+        return self.query_stats
+
+    def disable_query_stats(self) -> Optional[QueryStats]:
+        """SQL文の実行時間の集計を止め、それまでの集計を返す。"""
+        query_stats, self.query_stats = self.query_stats, None
+        if query_stats is not None:
+            query_stats.close()
+        return query_stats
+
+    def _install_statement_timeout(self, timeout: float):
+        """データベースの種類に応じて、SQL文の実行時間の上限を各接続に設定するイベントを登録する。"""
+        if timeout <= 0:
+            raise ValueError(
+                f"statement_timeout は0より大きい値を指定してください: statement_timeout={timeout}"
+            )
+        milliseconds = int(timeout * 1000)
+        dialect = self.engine.dialect.name
+        if dialect == "sqlite":
+            event.listen(self.engine, "connect", self._set_sqlite_progress_handler)
+            event.listen(
+                self.engine, "before_cursor_execute", self._start_statement_timer
+            )
+            # 最初の行が返った後の読み出しも計測するため、実行後ではなく、次のSQL文の実行か
+            # トランザクションの終了まで計測を続ける。コミットやロールバックが中断されないように、その前に止める
+            event.listen(self.engine, "commit", self._stop_statement_timer)
+            event.listen(self.engine, "rollback", self._stop_statement_timer)
+            event.listen(
+                self.engine, "handle_error", self._stop_statement_timer_on_error
+            )
+            event.listen(self.engine.pool, "reset", self._stop_statement_timer_on_reset)
+            return
+        if dialect == "postgresql":
+            statement = f"SET statement_timeout = {milliseconds}"
+        elif dialect in ("mysql", "mariadb"):
+            statement = f"SET SESSION max_execution_time = {milliseconds}"
+        else:
+            raise ValueError(f"statement_timeout はこのデータベースに対応していません: dialect={dialect}")
+
+        @event.listens_for(self.engine, "connect")
+        def set_statement_timeout(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            try:
+                cursor.execute(statement)
+            finally:
+                cursor.close()
+            # 接続の返却時のロールバックで設定が戻らないようにコミットする
+            dbapi_connection.commit()
+
+    def _set_sqlite_progress_handler(self, dbapi_connection, connection_record):
+        info = connection_record.info
+
+        def interrupt_if_timed_out():
+            start = info.get("statement_start")
+            # 0以外を返すと、SQLiteは実行中のSQL文を中断する
+            return (
+                start is not None and time.monotonic() - start > self.statement_timeout
+            )
+
+        dbapi_connection.set_progress_handler(interrupt_if_timed_out, 1000)
+
+    @staticmethod
+    def _start_statement_timer(
+        conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info["statement_start"] = time.monotonic()
+
+    @staticmethod
+    def _stop_statement_timer(conn):
+        conn.info.pop("statement_start", None)
+
+    @staticmethod
+    def _stop_statement_timer_on_error(exception_context):
+        if exception_context.connection is not None:
+            exception_context.connection.info.pop("statement_start", None)
+
+    @staticmethod
+    def _stop_statement_timer_on_reset(dbapi_connection, connection_record):
+        # 接続の返却時のロールバックは、commit/rollbackイベントを経由しない
+        connection_record.info.pop("statement_start", None)
+
+    @property
+    def last_statement_count(self) -> Optional[int]:
+        """debug=Trueの場合に、このスレッドで最後に終了したget_sessionのブロックで実行したSQL文の数。"""
+        return getattr(self._local, "last_statement_count", None)
+
+    def _count_statement(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        blocks = getattr(self._local, "blocks", None)
+        if blocks:
+            blocks[-1][statement] += 1
+
+    def _check_statements(self, statements: Counter):
+        self._local.last_statement_count = sum(statements.values())
+        # まとめて追加したインスタンスのINSERTなどは繰り返されても問題ないため、関連の読み込みのSELECTだけを調べる
+        selects = Counter(
+            {
+                statement: count
+                for statement, count in statements.items()
+                if statement.lstrip()[:6].upper() == "SELECT"
+            }
+        )
+        if not selects:
+            return
+        statement, count = selects.most_common(1)[0]
+        if count >= self.n_plus_one_threshold:
+            warnings.warn(
+                f"同じSQL文が1つのセッションで{count}回実行されました。N+1パターンの可能性があります。"
+                f"selectのoptionsで関連を一括で読み込んでください: {statement}",
+                RuntimeWarning,
+                stacklevel=4,
+            )
+
+    @property
+    def cache_stats(self) -> Optional[dict]:
+        """キャッシュのヒット数、ミス数などの統計。キャッシュを使わない場合はNone。"""
+        return self.cache.stats if self.cache is not None else None
+
+    def _invalidate_written_tables(self, session: Session):
+        # セーブポイントのコミットでは、まだ他のセッションから変更が見えないため無効化しない
+        if session.in_nested_transaction():
+            return
+        tables = session.info.pop(_WRITTEN_TABLES, None)
+        if tables:
+            self.cache.invalidate(tables)
+
     @contextmanager
     def get_session(self) -> Session:
         """
@@ -44,10 +397,16 @@ class DBHandler:
         Session
             新しいデータベースセッション。
         """
-                
+
+        if self.debug:
+            if not hasattr(self._local, "blocks"):
+                self._local.blocks = []
+            self._local.blocks.append(Counter())
+
         # トランザクションの開始
         session = self.Session()
         try:
+            self._pool_stats.acquire(session)
             yield session
             # トランザクションのコミット
             session.commit()
@@ -58,7 +417,9 @@ class DBHandler:
         finally:
             # セッションを閉じる
             session.close()
-            
+            if self.debug:
+                self._check_statements(self._local.blocks.pop())
+
     @contextmanager
     def custom_transaction(self):
         """
@@ -81,7 +442,7 @@ class DBHandler:
                 # エラーが起きた場合、ロールバックする
                 session.rollback()
                 raise e
-    
+
     def add_model(self, model: Type[Base]):
         """
         モデルに対応するテーブルをデータベースに追加する。
@@ -116,32 +477,200 @@ class DBHandler:
         if session is None:
             with self.get_session() as session:
                 session.add(instance)
+                _mark_written(session, inspect(instance).mapper.tables)
         else:
             session.add(instance)
-            
-    def insert_many(self, instances: list[Base], session: Optional[Session] = None):
+            _mark_written(session, inspect(instance).mapper.tables)
+
+    def insert_many(
+        self,
+        instances: Iterable[Union[Base, dict]],
+        session: Optional[Session] = None,
+        bulk: bool = False,
+        model: Optional[Type[Base]] = None,
+        chunk_size: int = 10000,
+        return_defaults: bool = False,
+    ) -> Optional[int]:
         """
         複数のインスタンスをデータベースに追加する。
 
+        bulk=Trueの場合は、インスタンスをセッションに登録せずに、Coreのexecutemanyでchunk_size件ずつ挿入する。
+        アイデンティティマップへの登録や行ごとの主キーの取得を行わないため、大量のデータの挿入に向いている。
+
         Parameters
         ----------
-        instances : list[Base]
-            データベースに追加するインスタンスのリスト。
+        instances : Iterable[Union[Base, dict]]
+            データベースに追加するインスタンスのイテラブル。bulk=Trueの場合は、属性名をキーとする辞書も指定できる。
         session : Optional[Session], optional
             追加操作を実行するセッション。指定しない場合、新しいセッションが開始されます。
+        bulk : bool, optional
+            Trueの場合、Coreの一括挿入を使用する。デフォルトはFalse。
+        model : Optional[Type[Base]], optional
+            挿入先のモデルの型。辞書を挿入する場合に指定する。指定しない場合は最初のインスタンスの型を使用する。
+        chunk_size : int, optional
+            bulk=Trueの場合に、1回のexecutemanyで送信するレコード数。デフォルトは10000。
+        return_defaults : bool, optional
+            bulk=Trueの場合に、自動採番された主キーなどをインスタンス(または辞書)に設定する。
+            行ごとに主キーを取得するため遅くなる。デフォルトはFalse。
+
+        Returns
+        -------
+        Optional[int]
+            bulk=Trueの場合は挿入したレコード数。それ以外はNone。
         """
-                
+
+        if bulk:
+            if session is None:
+                with self.get_session() as session:
+                    return self._bulk_insert(
+                        session, instances, model, chunk_size, return_defaults
+                    )
+            return self._bulk_insert(
+                session, instances, model, chunk_size, return_defaults
+            )
+
         # 複数のインスタンスをデータベースに追加する
+        instances = list(instances)
+        tables = {
+            table for instance in instances for table in inspect(instance).mapper.tables
+        }
         if session is None:
             with self.get_session() as session:
                 session.add_all(instances)
+                _mark_written(session, tables)
         else:
             session.add_all(instances)
-            
-    def select(self, model: Type[Base], conditions=None, order_by=None, limit=None, session: Optional[Session] = None):
+            _mark_written(session, tables)
+
+    @staticmethod
+    def _bulk_insert(
+        session: Session, instances, model, chunk_size: int, return_defaults: bool
+    ) -> int:
+        if chunk_size < 1:
+            raise ValueError(f"chunk_size は1以上を指定してください: chunk_size={chunk_size}")
+        rows = iter(instances)
+        inserted = 0
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            if model is None:
+                if isinstance(chunk[0], dict):
+                    raise ValueError("辞書を挿入する場合は model を指定してください。")
+                model = type(chunk[0])
+            mapper = inspect(model)
+            _mark_written(session, mapper.tables)
+
+            if return_defaults:
+                # ORMの一括挿入で、採番された主キーをインスタンスまたは辞書に設定する
+                if isinstance(chunk[0], dict):
+                    session.bulk_insert_mappings(mapper, chunk, return_defaults=True)
+                else:
+                    session.bulk_save_objects(chunk, return_defaults=True)
+                inserted += len(chunk)
+                continue
+
+            # 属性名を列のキーに変換し、インスタンスは設定済みの属性だけを使う
+            column_keys = {
+                prop.key: prop.columns[0].key for prop in mapper.column_attrs
+            }
+            mappings = []
+            for row in chunk:
+                values = row if isinstance(row, dict) else instance_state(row).dict
+                mappings.append(
+                    {
+                        column_keys[key]: value
+                        for key, value in values.items()
+                        if key in column_keys
+                    }
+                )
+            # executemanyは同じ列の組み合わせの行にしか使えないため、連続する同じ列の行ごとに実行する
+            for _, group in groupby(mappings, key=lambda mapping: tuple(mapping)):
+                group = list(group)
+                session.execute(mapper.local_table.insert(), group)
+                inserted += len(group)
+        return inserted
+
+    def insert_batch(
+        self,
+        instances: Iterable[Union[Base, dict]],
+        model: Optional[Type[Base]] = None,
+        batch_size: int = 500,
+    ) -> List[Tuple[Any, Exception]]:
+        """
+        インスタンスをバッチごとにセーブポイント内で挿入し、挿入できなかったインスタンスを返す。
+
+        custom_transactionの中で、batch_size件ずつCoreの一括挿入を行う。制約違反などで失敗したバッチは
+        セーブポイントまでロールバックし、半分に分けて挿入し直すことで、失敗の原因となったインスタンスだけを
+        取り除く。残りのインスタンスはコミットされる。接続の切断やロックなどのOperationalErrorは
+        インスタンスの問題ではないため、全体をロールバックして例外を送出する。
+
+        Parameters
+        ----------
+        instances : Iterable[Union[Base, dict]]
+            データベースに追加するインスタンス、または属性名をキーとする辞書のイテラブル。
+        model : Optional[Type[Base]], optional
+            挿入先のモデルの型。辞書を挿入する場合に指定する。
+        batch_size : int, optional
+            1つのセーブポイントで挿入するインスタンス数。デフォルトは500。
+
+        Returns
+        -------
+        List[Tuple[Any, Exception]]
+            挿入できなかったインスタンスと、その原因の例外のタプルのリスト。
+        """
+
+        if batch_size < 1:
+            raise ValueError(f"batch_size は1以上を指定してください: batch_size={batch_size}")
+        rejects = []
+        rows = iter(instances)
+        with self.custom_transaction() as session:
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                if model is None:
+                    if isinstance(batch[0], dict):
+                        raise ValueError("辞書を挿入する場合は model を指定してください。")
+                    model = type(batch[0])
+                self._insert_bisect(session, batch, model, rejects)
+        return rejects
+
+    def _insert_bisect(
+        self, session: Session, batch: list, model: Type[Base], rejects: list
+    ):
+        try:
+            with session.begin_nested():
+                self._bulk_insert(session, batch, model, len(batch), False)
+        except OperationalError:
+            raise
+        except SQLAlchemyError as e:
+            if len(batch) == 1:
+                rejects.append((batch[0], e))
+                return
+            # 失敗したバッチを半分に分けて、失敗の原因のインスタンスを絞り込む
+            middle = len(batch) // 2
+            self._insert_bisect(session, batch[:middle], model, rejects)
+            self._insert_bisect(session, batch[middle:], model, rejects)
+
+    def select(
+        self,
+        model: Type[Base],
+        conditions=None,
+        order_by=None,
+        limit=None,
+        session: Optional[Session] = None,
+        columns: Optional[Sequence] = None,
+        as_dict: bool = False,
+        options: Optional[Sequence] = None,
+        loader: str = "selectin",
+    ):
         """
         データベースからインスタンスを選択する。
 
+        columnsを指定した場合は、ORMのインスタンスを作らずにCoreのSELECTで指定した列だけを取得し、
+        名前付きタプルとして扱える行(または辞書)のリストを返す。読み出し専用の大量のデータの取得に向いている。
+
         Parameters
         ----------
         model : Type[Base]
@@ -154,27 +683,98 @@ class DBHandler:
             取得するインスタンスの最大数。
         session : Optional[Session], optional
             選択操作を実行するセッション。指定しない場合、新しいセッションが開始されます。
+        columns : Optional[Sequence], optional
+            取得する列。モデルの属性(例: User.name)または属性名の文字列のリスト。
+        as_dict : bool, optional
+            columnsを指定した場合に、行を列名をキーとする辞書で返す。デフォルトはFalse。
+        options : Optional[Sequence], optional
+            インスタンスと一緒に読み込む関連。ローダーオプション(例: joinedload(User.addresses))、
+            または関連の属性や属性名を指定する。セッションを閉じた後に関連を参照する場合に指定する。
+        loader : str, optional
+            optionsに属性や属性名を指定した場合の読み込み方法。"selectin"(関連ごとに1回のIN検索)
+            または"joined"(LEFT OUTER JOIN)。デフォルトは"selectin"。
 
         Returns
         -------
         list
-            選択されたインスタンスのリスト。
+            選択されたインスタンスのリスト。columnsを指定した場合は行(または辞書)のリスト。
         """
 
+        option_key = ()
+        if options is not None:
+            if columns is not None:
+                raise ValueError("options は columns と同時に指定できません。")
+            option_key = self._option_key(model, options, loader)
+            options = self._loader_options(model, options, loader)
+
+        # ローダーオプションのオブジェクトを指定した場合は、キャッシュキーを作れないためキャッシュしない
+        if session is None and self.cache is not None and option_key is not None:
+            return self._cached_select(
+                model,
+                conditions,
+                order_by,
+                limit,
+                columns,
+                as_dict,
+                options,
+                option_key,
+            )
+
+        if columns is not None:
+            if session is None:
+                with self.get_session() as session:
+                    rows = self._select_rows(
+                        session, model, columns, conditions, order_by, limit, as_dict
+                    )
+            else:
+                rows = self._select_rows(
+                    session, model, columns, conditions, order_by, limit, as_dict
+                )
+            return self._count_rows(rows)
+
         # データベースからインスタンスを選択する
         if session is None:
             with self.get_session() as session:
-                results = self._select(session, model, conditions, order_by, limit)
+                results = self._select(
+                    session, model, conditions, order_by, limit, options
+                )
                 # Load all attributes eagerly
                 session.expunge_all()  # remove objects from session
                 session.close()  # close session
-                return results
+                return self._count_rows(results)
         else:
-            return self._select(session, model, conditions, order_by, limit)
+            return self._count_rows(
+                self._select(session, model, conditions, order_by, limit, options)
+            )
+
+    def _count_rows(self, results: list) -> list:
+        """SQL文の実行時間を集計している場合に、取得した行数を記録する。"""
+        if self.query_stats is not None:
+            self.query_stats.add_rows(len(results))
+        return results
+
+    @staticmethod
+    def _loader_options(model: Type[Base], options: Sequence, loader: str) -> list:
+        if loader not in LOADERS:
+            raise ValueError(
+                f"loader は {list(LOADERS)} のいずれかを指定してください: loader={loader}"
+            )
+        resolved = []
+        for option in options:
+            if isinstance(option, str):
+                option = getattr(model, option)
+            if isinstance(option, InstrumentedAttribute):
+                option = LOADERS[loader](option)
+            resolved.append(option)
+        return resolved
 
     @staticmethod
-    def _select(session: Session, model: Type[Base], conditions, order_by, limit):
+    def _select(
+        session: Session, model: Type[Base], conditions, order_by, limit, options=None
+    ):
         query = session.query(model)
+        if options:
+            query = query.options(*options)
         if conditions is not None:
             query = query.filter(conditions)
         if order_by is not None:
@@ -183,7 +783,249 @@ class DBHandler:
             query = query.limit(limit)
         return query.all()
 
-    def update(self, model: Type[Base], conditions, update_values, session: Optional[Session] = None):
+    @staticmethod
+    def _select_rows(
+        session: Session,
+        model: Type[Base],
+        columns,
+        conditions,
+        order_by,
+        limit,
+        as_dict: bool,
+    ):
+        statement = DBHandler._select_statement(
+            model, columns, conditions, order_by, limit
+        )
+        result = session.execute(statement)
+        if as_dict:
+            return [dict(row._mapping) for row in result]
+        return result.all()
+
+    @staticmethod
+    def _select_statement(
+        model: Type[Base], columns, conditions, order_by, limit, options=None
+    ):
+        if columns is None:
+            statement = select(model)
+            if options:
+                statement = statement.options(*options)
+        else:
+            # 文字列の列名はモデルの属性に変換する
+            columns = [
+                getattr(model, column) if isinstance(column, str) else column
+                for column in columns
+            ]
+            statement = select(*columns)
+        if conditions is not None:
+            statement = statement.where(conditions)
+        if order_by is not None:
+            statement = statement.order_by(order_by)
+        if limit is not None:
+            statement = statement.limit(limit)
+        return statement
+
+    @staticmethod
+    def _related_tables(mapper) -> set:
+        tables, mappers = set(), [mapper]
+        seen = {mapper}
+        while mappers:
+            for relationship in mappers.pop().relationships:
+                if relationship.mapper not in seen:
+                    seen.add(relationship.mapper)
+                    mappers.append(relationship.mapper)
+                tables.update(relationship.mapper.tables)
+                if relationship.secondary is not None:
+                    tables.add(relationship.secondary)
+        return tables
+
+    @staticmethod
+    def _option_key(
+        model: Type[Base], options: Sequence, loader: str
+    ) -> Optional[tuple]:
+        """属性や属性名で指定したoptionsのキャッシュキー。ローダーオプションのオブジェクトを含む場合はNone。"""
+        names = []
+        for option in options:
+            if isinstance(option, str):
+                option = getattr(model, option)
+            if not isinstance(option, InstrumentedAttribute):
+                return None
+            # 属性名と属性のどちらで指定しても同じキーになるように、"モデル名.属性名"にする
+            names.append(str(option))
+        return loader, tuple(names)
+
+    def _cached_select(
+        self,
+        model: Type[Base],
+        conditions,
+        order_by,
+        limit,
+        columns,
+        as_dict: bool,
+        options=None,
+        option_key: tuple = (),
+    ) -> list:
+        statement = self._select_statement(
+            model, columns, conditions, order_by, limit, options
+        )
+        compiled = statement.compile(self.engine)
+        # selectinloadなどはSQL文に現れないため、optionsのキャッシュキーもキーに含める
+        key = (
+            str(compiled),
+            _freeze(compiled.params),
+            columns is None,
+            as_dict,
+            option_key,
+        )
+        try:
+            hash(key)
+        except TypeError:
+            # キーにできないパラメーターを含む場合はキャッシュしない
+            key = None
+
+        if key is not None:
+            generation = self.cache.generation
+            hit, results = self.cache.get(key)
+            if hit:
+                return _copy_results(results)
+
+        with self.get_session() as session:
+            if columns is None:
+                results = session.execute(statement).scalars().unique().all()
+                session.expunge_all()
+            else:
+                results = self._select_rows(
+                    session, model, columns, conditions, order_by, limit, as_dict
+                )
+        self._count_rows(results)
+        if key is not None:
+            tables = {
+                table.name
+                for table in find_tables(
+                    statement, check_columns=True, include_joins=True
+                )
+            }
+            if options:
+                # 一緒に読み込んだ関連のテーブルへの書き込みでも無効化されるように、関連先のテーブルも加える
+                tables.update(
+                    table.name for table in self._related_tables(inspect(model))
+                )
+            self.cache.put(key, tables, results, generation)
+            # キャッシュしたオブジェクトは呼び出し元に渡さず、複製を返す
+            return _copy_results(results)
+        return results
+
+    def paginate(
+        self,
+        model: Type[Base],
+        order_by_key,
+        page_size: int = 1000,
+        conditions=None,
+        descending: bool = False,
+    ) -> Iterator[list]:
+        """
+        キーセット(シーク)方式で、モデルのインスタンスをページごとに返すジェネレーター。
+
+        前のページの最後の値より後ろの行をインデックスで検索するため、OFFSETと異なり
+        どのページでも取得にかかる時間が変わらない。order_by_keyにはインデックスのある列を指定する。
+        値が重複する列の場合は、主キー(複合主キーでは全ての列)を並び順の後続のキーに使って取りこぼしを防ぐ。
+        NULLを含む列では、SQLiteやMySQLと同じく、NULLを昇順の先頭(降順の末尾)に並べる。
+        各ページは個別のセッションで取得され、インスタンスはセッションから切り離されて返される。
+
+        Parameters
+        ----------
+        model : Type[Base]
+            選択するインスタンスのモデルの型。
+        order_by_key :
+            並び順とページの区切りに使う列。モデルの属性または属性名の文字列。
+        page_size : int, optional
+            1ページあたりのインスタンス数。デフォルトは1000。
+        conditions : optional
+            選択するインスタンスに適用する条件。
+        descending : bool, optional
+            Trueの場合、降順にたどる。デフォルトはFalse。
+
+        Yields
+        ------
+        list
+            1ページ分のインスタンスのリスト。
+        """
+
+        if page_size < 1:
+            raise ValueError(f"page_size は1以上を指定してください: page_size={page_size}")
+        key = (
+            getattr(model, order_by_key)
+            if isinstance(order_by_key, str)
+            else order_by_key
+        )
+        mapper = inspect(model)
+        # 並び順の列以外の主キーの列を、後続のキーにする
+        tiebreakers = [
+            getattr(model, mapper.get_property_by_column(column).key)
+            for column in mapper.primary_key
+            if column is not key.property.columns[0]
+        ]
+        order_key = key.desc() if descending else key
+        if self.engine.dialect.name == "postgresql":
+            # PostgreSQLはNULLを昇順の末尾に並べるため、ページの区切りの条件に合わせて明示する
+            order_key = order_key.nullslast() if descending else order_key.nullsfirst()
+        order = [order_key]
+        order.extend(
+            tiebreaker.desc() if descending else tiebreaker
+            for tiebreaker in tiebreakers
+        )
+
+        last = None
+        while True:
+            with self.get_session() as session:
+                query = session.query(model)
+                if conditions is not None:
+                    query = query.filter(conditions)
+                if last is not None:
+                    query = query.filter(
+                        self._keyset_condition(key, tiebreakers, last, descending)
+                    )
+                page = query.order_by(*order).limit(page_size).all()
+                session.expunge_all()
+            if not page:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+            last_instance = page[-1]
+            last = (
+                getattr(last_instance, key.key),
+                [getattr(last_instance, tiebreaker.key) for tiebreaker in tiebreakers],
+            )
+
+    @staticmethod
+    def _keyset_condition(key, tiebreakers, last, descending: bool):
+        """前のページの最後の行より後ろに並ぶ行の条件。NULLは昇順の先頭、降順の末尾に並ぶものとする。"""
+        last_key, last_tiebreakers = last
+        if last_key is None:
+            # NULLの後ろには、昇順ではNULL以外の全ての値が並び、降順では何も並ばない
+            same_key = key.is_(None)
+            after_key = false() if descending else key.isnot(None)
+        else:
+            same_key = key == last_key
+            after_key = (
+                or_(key < last_key, key.is_(None)) if descending else key > last_key
+            )
+        if not tiebreakers:
+            return after_key
+        # 後続のキーは、先頭の列から順に比べる(主キーの列はNULLにならない)
+        after_tiebreakers = false()
+        for tiebreaker, value in reversed(list(zip(tiebreakers, last_tiebreakers))):
+            after = tiebreaker < value if descending else tiebreaker > value
+            after_tiebreakers = or_(after, and_(tiebreaker == value, after_tiebreakers))
+        return or_(after_key, and_(same_key, after_tiebreakers))
+
+    def update(
+        self,
+        model: Type[Base],
+        conditions,
+        update_values,
+        session: Optional[Session] = None,
+    ):
         """
         データベースのインスタンスを更新する。
 
@@ -203,8 +1045,155 @@ class DBHandler:
         if session is None:
             with self.get_session() as session:
                 session.query(model).filter(conditions).update(update_values)
+                _mark_written(session, inspect(model).tables)
         else:
             session.query(model).filter(conditions).update(update_values)
+            _mark_written(session, inspect(model).tables)
+
+    def update_many(
+        self,
+        model: Type[Base],
+        mappings: Iterable[dict],
+        session: Optional[Session] = None,
+        chunk_size: int = 1000,
+    ) -> int:
+        """
+        主キーで指定したインスタンスを、それぞれ異なる値で一括更新する。
+
+        各辞書の主キーの値で行を特定し、残りの値で更新する。同じ属性の組み合わせの辞書をまとめて、
+        chunk_size件ずつCoreのexecutemanyで実行する。全ての更新は1つのトランザクションで実行される。
+
+        Parameters
+        ----------
+        model : Type[Base]
+            更新するインスタンスのモデルの型。
+        mappings : Iterable[dict]
+            主キーと更新する値を、属性名をキーとして持つ辞書のイテラブル。主キー以外の値を含まない辞書はValueErrorになる。
+        session : Optional[Session], optional
+            更新操作を実行するセッション。指定しない場合、新しいセッションが開始されます。
+        chunk_size : int, optional
+            1回のexecutemanyで送信するレコード数。デフォルトは1000。
+
+        Returns
+        -------
+        int
+            更新されたレコード数。
+        """
+
+        if session is None:
+            with self.get_session() as session:
+                return self._update_many(session, model, mappings, chunk_size)
+        return self._update_many(session, model, mappings, chunk_size)
+
+    @staticmethod
+    def _update_many(
+        session: Session, model: Type[Base], mappings: Iterable[dict], chunk_size: int
+    ) -> int:
+        if chunk_size < 1:
+            raise ValueError(f"chunk_size は1以上を指定してください: chunk_size={chunk_size}")
+        mapper = inspect(model)
+        table = mapper.local_table
+        column_keys = {prop.key: prop.columns[0].key for prop in mapper.column_attrs}
+        primary_keys = [
+            mapper.get_property_by_column(column).key for column in mapper.primary_key
+        ]
+        _mark_written(session, mapper.tables)
+
+        rows = iter(mappings)
+        updated = 0
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            params = []
+            for mapping in chunk:
+                missing = [key for key in primary_keys if key not in mapping]
+                if missing:
+                    raise ValueError(f"主キーの値が指定されていません: {missing}")
+                unknown = [key for key in mapping if key not in column_keys]
+                if unknown:
+                    raise ValueError(f"{model.__name__} にない属性が指定されています: {unknown}")
+                if len(mapping) == len(primary_keys):
+                    raise ValueError(f"更新する値が指定されていません: {mapping}")
+                # 列名と重ならないように、バインドパラメーター名に接頭辞を付ける
+                params.append(
+                    {
+                        f"_{'pk' if key in primary_keys else 'v'}_{key}": value
+                        for key, value in mapping.items()
+                    }
+                )
+            # executemanyは同じ列の組み合わせの行にしか使えないため、連続する同じ列の行ごとに実行する
+            for names, group in groupby(params, key=lambda param: tuple(param)):
+                values = {
+                    column_keys[name[3:]]: bindparam(name)
+                    for name in names
+                    if name.startswith("_v_")
+                }
+                statement = table.update().values(values)
+                for key in primary_keys:
+                    statement = statement.where(
+                        table.c[column_keys[key]] == bindparam(f"_pk_{key}")
+                    )
+                updated += session.execute(statement, list(group)).rowcount
+        return updated
+
+    def delete_many(
+        self,
+        model: Type[Base],
+        primary_keys: Iterable,
+        session: Optional[Session] = None,
+        chunk_size: int = 500,
+    ) -> int:
+        """
+        主キーのリストで指定したインスタンスを一括削除する。
+
+        主キーをchunk_size件ずつ IN (...) の条件にまとめて削除する。全ての削除は1つのトランザクションで実行される。
+
+        Parameters
+        ----------
+        model : Type[Base]
+            削除するインスタンスのモデルの型。
+        primary_keys : Iterable
+            削除するインスタンスの主キーの値のイテラブル。複合主キーの場合は値のタプル。
+        session : Optional[Session], optional
+            削除操作を実行するセッション。指定しない場合、新しいセッションが開始されます。
+        chunk_size : int, optional
+            1回のDELETE文にまとめる主キーの数。デフォルトは500。
+
+        Returns
+        -------
+        int
+            削除されたレコード数。
+        """
+
+        if session is None:
+            with self.get_session() as session:
+                return self._delete_many(session, model, primary_keys, chunk_size)
+        return self._delete_many(session, model, primary_keys, chunk_size)
+
+    @staticmethod
+    def _delete_many(
+        session: Session, model: Type[Base], primary_keys: Iterable, chunk_size: int
+    ) -> int:
+        if chunk_size < 1:
+            raise ValueError(f"chunk_size は1以上を指定してください: chunk_size={chunk_size}")
+        mapper = inspect(model)
+        table = mapper.local_table
+        key = (
+            mapper.primary_key[0]
+            if len(mapper.primary_key) == 1
+            else tuple_(*mapper.primary_key)
+        )
+        _mark_written(session, mapper.tables)
+
+        keys = iter(primary_keys)
+        deleted = 0
+        while True:
+            chunk = list(islice(keys, chunk_size))
+            if not chunk:
+                break
+            deleted += session.execute(table.delete().where(key.in_(chunk))).rowcount
+        return deleted
 
     def delete(self, model: Type[Base], conditions, session: Optional[Session] = None):
         """
@@ -224,9 +1213,10 @@ class DBHandler:
         if session is None:
             with self.get_session() as session:
                 session.query(model).filter(conditions).delete()
+                _mark_written(session, inspect(model).tables)
         else:
             session.query(model).filter(conditions).delete()
-
+            _mark_written(session, inspect(model).tables)
 
 
 if __name__ == "__main__":
@@ -300,4 +1290,4 @@ if __name__ == "__main__":
     transaction_users = db.select(User)
     print("トランザクション後のユーザを選択しました:")
     for user in transaction_users:
-        print(user.name)
\ No newline at end of file
+        print(user.name)
@@ -0,0 +1,123 @@
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+
+class PoolStats:
+    """
+    SQLAlchemyエンジンのコネクションプールの利用状況を集計するクラス。
+
+    engineのconnect/checkout/checkinイベントで接続数と貸し出し数を数え、
+    acquire()で接続を取得する際に、空き接続がなく待たされた回数と待ち時間、タイムアウトした回数を記録します。
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        集計対象のエンジン。
+    max_overflow : int, optional
+        QueuePoolのmax_overflow。待ちの判定に使用します。負の値は上限なしを表します。デフォルトは0です。
+
+    """
+
+    def __init__(self, engine, max_overflow: Optional[int] = None):
+        self.engine = engine
+        self.max_overflow = max_overflow or 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "connects": 0,
+            "checkouts": 0,
+            "checkins": 0,
+            "checked_out": 0,
+            "max_checked_out": 0,
+            "waits": 0,
+            "wait_time": 0.0,
+            "max_wait_time": 0.0,
+            "timeouts": 0,
+            "max_overflow_used": 0,
+        }
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+
+    def snapshot(self) -> dict:
+        """
+        現在の統計を辞書で返します。
+
+        Returns
+        -------
+        dict
+            接続数(connects)、貸し出し回数(checkouts)、返却回数(checkins)、貸し出し中の接続数(checked_out)と
+            その最大値、待ちの回数(waits)と待ち時間(秒)、待ちがタイムアウトした回数(timeouts)、プールの種類と、QueuePoolの場合はサイズとオーバーフロー数。
+
+        """
+        pool = self.engine.pool
+        with self._lock:
+            stats = dict(self._stats)
+        stats["pool"] = type(pool).__name__
+        if isinstance(pool, QueuePool):
+            stats["pool_size"] = pool.size()
+            stats["checked_in"] = pool.checkedin()
+            stats["overflow"] = max(pool.overflow(), 0)
+        return stats
+
+    def acquire(self, session):
+        """
+        セッションに接続を割り当て、空き接続を待った場合はその回数と時間を記録します。
+
+        Parameters
+        ----------
+        session : sqlalchemy.orm.Session
+            接続を割り当てるセッション。
+
+        """
+        would_wait = self._would_wait()
+        start = time.perf_counter()
+        try:
+            session.connection()
+        except exc.TimeoutError:
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise
+        finally:
+            if would_wait:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self._stats["waits"] += 1
+                    self._stats["wait_time"] += elapsed
+                    self._stats["max_wait_time"] = max(
+                        self._stats["max_wait_time"], elapsed
+                    )
+
+    def _would_wait(self) -> bool:
+        """QueuePoolに空き接続がなく、オーバーフローの上限にも達しているかどうかを返します。"""
+        pool = self.engine.pool
+        if not isinstance(pool, QueuePool) or self.max_overflow < 0:
+            # max_overflowが負の場合は接続数に上限がなく、待つことはない
+            return False
+        return pool.checkedin() == 0 and pool.overflow() >= self.max_overflow
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self._stats["connects"] += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        pool = self.engine.pool
+        with self._lock:
+            self._stats["checkouts"] += 1
+            self._stats["checked_out"] += 1
+            self._stats["max_checked_out"] = max(
+                self._stats["max_checked_out"], self._stats["checked_out"]
+            )
+            if isinstance(pool, QueuePool):
+                self._stats["max_overflow_used"] = max(
+                    self._stats["max_overflow_used"], pool.overflow()
+                )
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self._stats["checkins"] += 1
+            self._stats["checked_out"] -= 1
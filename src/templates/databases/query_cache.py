@@ -0,0 +1,152 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional, Set, Tuple
+
+
+class QueryCache:
+    """
+    クエリの結果を保持する、有効期限(TTL)付きのLRUキャッシュ。
+
+    各エントリは参照したテーブル名と一緒に保存され、invalidate()で指定したテーブルを参照する
+    エントリがまとめて削除されます。結果を取得してからput()するまでの間に無効化が行われた場合、
+    古い結果を保存しないように、get()の前にgenerationを取得しておき、put()に渡します。
+
+    Parameters
+    ----------
+    max_entries : int, optional
+        保持するエントリの最大数。超えた場合は最も長く使われていないエントリを削除します。デフォルトは128です。
+    ttl : float, optional
+        エントリの有効期限(秒)。Noneの場合は期限切れになりません。デフォルトは60秒です。
+
+    """
+
+    def __init__(self, max_entries: int = 128, ttl: Optional[float] = 60.0):
+        if max_entries < 1:
+            raise ValueError(f"max_entries は1以上を指定してください: max_entries={max_entries}")
+        if ttl is not None and ttl <= 0:
+            raise ValueError(f"ttl は0より大きい値を指定してください: ttl={ttl}")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: (
+            "OrderedDict[Hashable, Tuple[Optional[float], Set[str], Any]]"
+        ) = OrderedDict()
+        self._keys_by_table: Dict[str, Set[Hashable]] = {}
+        self._generation = 0
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+        }
+
+    @property
+    def generation(self) -> int:
+        """無効化のたびに増える番号。"""
+        with self._lock:
+            return self._generation
+
+    @property
+    def stats(self) -> dict:
+        """ヒット数、ミス数、LRUで削除した数、期限切れの数、無効化で削除した数と、現在のエントリ数。"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+        return stats
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """
+        キーに対応する結果を返します。
+
+        Parameters
+        ----------
+        key : Hashable
+            エントリのキー。
+
+        Returns
+        -------
+        Tuple[bool, Any]
+            (キャッシュにあったかどうか, 結果)。なかった場合の結果はNoneです。
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if (
+                entry is not None
+                and entry[0] is not None
+                and entry[0] <= time.monotonic()
+            ):
+                self._remove(key)
+                self._stats["expirations"] += 1
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return True, entry[2]
+
+    def put(self, key: Hashable, tables: Iterable[str], value: Any, generation: int):
+        """
+        結果を保存します。generationがget()前に取得した値から変わっている場合は保存しません。
+
+        Parameters
+        ----------
+        key : Hashable
+            エントリのキー。
+        tables : Iterable[str]
+            結果が参照したテーブル名。
+        value : Any
+            保存する結果。
+        generation : int
+            結果を取得する前に取得したgeneration。
+
+        """
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        tables = set(tables)
+        with self._lock:
+            if generation != self._generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires, tables, value)
+            for table in tables:
+                self._keys_by_table.setdefault(table, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def invalidate(self, tables: Iterable[str]):
+        """
+        指定したテーブルを参照するエントリを削除します。
+
+        Parameters
+        ----------
+        tables : Iterable[str]
+            変更されたテーブル名。
+
+        """
+        with self._lock:
+            self._generation += 1
+            for table in tables:
+                for key in list(self._keys_by_table.get(table, ())):
+                    self._remove(key)
+                    self._stats["invalidations"] += 1
+
+    def clear(self):
+        """全てのエントリを削除します。"""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._keys_by_table.clear()
+
+    def _remove(self, key: Hashable):
+        _, tables, _ = self._entries.pop(key)
+        for table in tables:
+            keys = self._keys_by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_table[table]
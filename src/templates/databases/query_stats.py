@@ -0,0 +1,228 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+from functools import lru_cache
+from typing import Dict, Optional, Sequence
+
+from sqlalchemy import event
+
+# レイテンシーのヒストグラムの区切り(秒)。最後の区間はこれより長いSQL文
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+# テンプレート数の上限を超えたSQL文をまとめるキー
+OTHER_TEMPLATE = "(other)"
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+_WHITESPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=1024)
+def statement_template(statement: str) -> str:
+    """
+    SQL文に直接埋め込まれた文字列と数値のリテラルを"?"に置き換え、空白を詰めたテンプレートを返します。
+
+    where_clauseに値を埋め込んだSQL文も、値の違いによらず同じテンプレートとして集計するために使用します。
+    """
+    template = _STRING_LITERAL.sub("?", statement)
+    template = _NUMBER_LITERAL.sub("?", template)
+    return _WHITESPACE.sub(" ", template).strip()
+
+
+class QueryStats:
+    """
+    SQLAlchemyエンジンで実行されたSQL文の実行時間を、テンプレートごとに集計するクラス。
+
+    engineのbefore_cursor_execute/after_cursor_executeイベントで1文ごとの実行時間を計り、
+    結果を読み出した側がadd_rows()を呼び出した場合は、読み出しにかかった時間も実行時間に含めます。
+    テンプレートごとに実行回数、合計・最大時間、レイテンシーのヒストグラム、行数、実行したスレッド名を記録します。
+    slow_threshold秒以上かかったSQL文は、loggerに警告として出力します。
+    イベントはこのクラスを作成した時点で登録され、close()で解除されるため、使用しない場合の負荷はありません。
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        集計対象のエンジン。
+    logger : logging.Logger, optional
+        遅いSQL文を出力するロガー。templates.utils.log_tools.logger.Loggerなど。Noneの場合は出力しません。
+    slow_threshold : float, optional
+        遅いSQL文とみなす実行時間(秒)。デフォルトは0.5秒です。
+    buckets : Sequence[float], optional
+        ヒストグラムの区切り(秒)の昇順のリスト。デフォルトはDEFAULT_BUCKETSです。
+    max_templates : int, optional
+        集計するテンプレート数の上限。超えた分はOTHER_TEMPLATEにまとめます。デフォルトは1000です。
+
+    """
+
+    def __init__(
+        self,
+        engine,
+        logger=None,
+        slow_threshold: float = 0.5,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        max_templates: int = 1000,
+    ):
+        if list(buckets) != sorted(buckets):
+            raise ValueError(f"buckets は昇順で指定してください: buckets={buckets}")
+        self.engine = engine
+        self.logger = logger
+        self.slow_threshold = slow_threshold
+        self.buckets = tuple(buckets)
+        self.max_templates = max_templates
+        self._lock = threading.Lock()
+        self._templates: Dict[str, dict] = {}
+        self._slow_queries = 0
+        # add_rows()で行数と読み出し時間を加えるために、スレッドごとに最後に実行したSQL文を保持する
+        self._local = threading.local()
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(engine, "handle_error", self._handle_error)
+
+    def close(self):
+        """イベントの登録を解除し、集計を止めます。集計済みの統計は残ります。"""
+        if event.contains(
+            self.engine, "before_cursor_execute", self._before_cursor_execute
+        ):
+            event.remove(
+                self.engine, "before_cursor_execute", self._before_cursor_execute
+            )
+            event.remove(
+                self.engine, "after_cursor_execute", self._after_cursor_execute
+            )
+            event.remove(self.engine, "handle_error", self._handle_error)
+
+    def reset(self):
+        """集計済みの統計を消去します。"""
+        with self._lock:
+            self._templates.clear()
+            self._slow_queries = 0
+
+    def snapshot(self) -> dict:
+        """
+        現在の統計を辞書で返します。
+
+        Returns
+        -------
+        dict
+            "templates"に、テンプレートごとの実行回数(count)、合計・平均・最大時間(秒)、行数(rows)、
+            ヒストグラム(区間の上限の文字列とその回数、最後は"inf")、スレッド名ごとの実行回数(threads)。
+            "slow_queries"に、遅いSQL文の数。
+
+        """
+        labels = [str(bucket) for bucket in self.buckets] + ["inf"]
+        with self._lock:
+            templates = {
+                template: {
+                    "count": stats["count"],
+                    "total_time": stats["total_time"],
+                    "mean_time": stats["total_time"] / stats["count"],
+                    "max_time": stats["max_time"],
+                    "rows": stats["rows"],
+                    "histogram": dict(zip(labels, stats["histogram"])),
+                    "threads": dict(stats["threads"]),
+                }
+                for template, stats in self._templates.items()
+            }
+            return {"templates": templates, "slow_queries": self._slow_queries}
+
+    def add_rows(self, rows: int):
+        """
+        このスレッドで最後に実行したSQL文のテンプレートに、取得した行数と読み出しにかかった時間を加えます。
+
+        SELECT文の行数はDBAPIから取得できない場合があるため、結果を読み出した側から呼び出します。
+        SQLiteではafter_cursor_executeが最初の行を読み出した時点で呼ばれるため、
+        残りの行の読み出し時間はここで実行時間に加え、遅いSQL文の判定もやり直します。
+        """
+        last_query = getattr(self._local, "last_query", None)
+        if last_query is None:
+            return
+        self._local.last_query = None
+        template, stats, elapsed, executed, statement, parameters = last_query
+        total = elapsed + time.perf_counter() - executed
+        slow = elapsed < self.slow_threshold <= total
+        with self._lock:
+            # reset()後は集計し直しているため加えない
+            if self._templates.get(template) is not stats:
+                return
+            stats["rows"] += rows
+            stats["total_time"] += total - elapsed
+            stats["max_time"] = max(stats["max_time"], total)
+            stats["histogram"][bisect_left(self.buckets, elapsed)] -= 1
+            stats["histogram"][bisect_left(self.buckets, total)] += 1
+            if slow:
+                self._slow_queries += 1
+        if slow:
+            self._log_slow(total, statement, parameters)
+
+    def _before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info.setdefault("query_stats_start", []).append(time.perf_counter())
+
+    def _handle_error(self, context):
+        # 失敗したSQL文ではafter_cursor_executeが呼ばれないため、開始時刻を取り除く
+        if context.connection is None:
+            return
+        starts = context.connection.info.get("query_stats_start")
+        if starts:
+            starts.pop()
+
+    def _after_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        executed = time.perf_counter()
+        elapsed = executed - conn.info["query_stats_start"].pop()
+        template = statement_template(statement)
+        thread = threading.current_thread().name
+        # SELECT文などで行数が分からない場合、rowcountは-1になる
+        rowcount = (
+            cursor.rowcount
+            if cursor.rowcount is not None and cursor.rowcount >= 0
+            else None
+        )
+        slow = elapsed >= self.slow_threshold
+        with self._lock:
+            stats = self._templates.get(template)
+            if stats is None:
+                if len(self._templates) >= self.max_templates:
+                    template = OTHER_TEMPLATE
+                    stats = self._templates.get(template)
+                if stats is None:
+                    stats = self._templates[template] = {
+                        "count": 0,
+                        "total_time": 0.0,
+                        "max_time": 0.0,
+                        "rows": 0,
+                        "histogram": [0] * (len(self.buckets) + 1),
+                        "threads": {},
+                    }
+            stats["count"] += 1
+            stats["total_time"] += elapsed
+            stats["max_time"] = max(stats["max_time"], elapsed)
+            stats["histogram"][bisect_left(self.buckets, elapsed)] += 1
+            stats["threads"][thread] = stats["threads"].get(thread, 0) + 1
+            if rowcount is not None:
+                stats["rows"] += rowcount
+            if slow:
+                self._slow_queries += 1
+        self._local.last_query = (
+            (template, stats, elapsed, executed, statement, parameters)
+            if rowcount is None
+            else None
+        )
+
+        if slow:
+            self._log_slow(elapsed, statement, parameters)
+
+    def _log_slow(self, elapsed: float, statement: str, parameters):
+        """遅いSQL文をloggerに出力します。"""
+        if self.logger is None:
+            return
+        shown = repr(parameters)
+        if len(shown) > 200:
+            shown = shown[:200] + "..."
+        self.logger.warning(
+            f"遅いSQL文を検出しました: {elapsed * 1000:.1f} ms, "
+            f"スレッド={threading.current_thread().name}, "
+            f"SQL={_WHITESPACE.sub(' ', statement).strip()}, パラメータ={shown}"
+        )
@@ -0,0 +1,250 @@
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+
+class _WriteTask:
+    """書き込みスレッドのキューに入れる操作。"""
+
+    __slots__ = ("fn", "args", "kwargs", "future", "in_transaction")
+
+    def __init__(self, fn: Callable, args: tuple, kwargs: dict, in_transaction: bool):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.in_transaction = in_transaction
+
+
+class SingleWriterExecutor:
+    """
+    SqliteDBへの書き込みを1本の書き込みスレッドに集約し、読み出しをスレッドプールで並行実行するクラス。
+
+    書き込みはキューに入れられ、書き込みスレッドがキュー内の連続した書き込みを最大max_batch件まとめて
+    1つのトランザクションで実行します。まとめた書き込みのいずれかが失敗した場合は、
+    各書き込みを個別のトランザクションで実行し直し、失敗した書き込みだけが例外になります。
+    全ての操作はconcurrent.futures.Futureを返します。
+
+    SqliteDB.start_single_writer()で作成すると、SqliteDBのinsert/insert_many/upsert_many/update/delete/
+    commit_changes/archiveとBufferedWriterの書き込みも、このクラスを経由して実行されます。
+
+    Parameters
+    ----------
+    db : SqliteDB
+        操作対象のデータベース。
+    readers : int, optional
+        読み出し用スレッドの数。デフォルトは4です。
+    max_batch : int, optional
+        1つのトランザクションにまとめる書き込みの最大数。デフォルトは100です。
+
+    Attributes
+    ----------
+    stats : dict
+        実行した書き込み数、トランザクション数、最大のまとめ数、個別に再実行した回数。
+
+    """
+
+    def __init__(self, db, readers: int = 4, max_batch: int = 100):
+        if readers < 1:
+            raise ValueError(f"readers は1以上を指定してください: readers={readers}")
+        if max_batch < 1:
+            raise ValueError(f"max_batch は1以上を指定してください: max_batch={max_batch}")
+        self.db = db
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._stats = {
+            "writes": 0,
+            "transactions": 0,
+            "max_batch_size": 0,
+            "retries": 0,
+        }
+        self._readers = ThreadPoolExecutor(
+            max_workers=readers, thread_name_prefix="SqliteDB.reader"
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="SqliteDB.writer", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["pending"] = self._queue.qsize()
+        return stats
+
+    def insert(self, table_name: str, values: Tuple) -> Future:
+        """SqliteDB.insertと同じレコードの挿入を書き込みスレッドで実行します。"""
+        return self.submit_write(self.db._insert_rows, table_name, [tuple(values)], 1)
+
+    def insert_many(
+        self, table_name: str, values: Iterable[Tuple], chunk_size: int = 1000
+    ) -> Future:
+        """SqliteDB.insert_manyと同じ挿入を書き込みスレッドで実行します。結果は挿入したレコード数です。"""
+        # 失敗時に個別に再実行できるように、ジェネレーターはこの時点で展開する
+        return self.submit_write(
+            self.db._insert_rows, table_name, list(values), chunk_size
+        )
+
+    def update(self, table_name: str, set_clause: str, where_clause: str) -> Future:
+        """SqliteDB.updateと同じ更新を書き込みスレッドで実行します。"""
+        return self.submit_write(self.db._update, table_name, set_clause, where_clause)
+
+    def delete(self, table_name: str, where_clause: str) -> Future:
+        """SqliteDB.deleteと同じ削除を書き込みスレッドで実行します。"""
+        return self.submit_write(self.db._delete, table_name, where_clause)
+
+    def select(
+        self,
+        table_name: str,
+        columns: List[str] = None,
+        where_clause: str = None,
+        order_by: str = None,
+        join_clause: str = None,
+        limit: int = None,
+        params: Optional[Dict[str, Any]] = None,
+    ) -> Future:
+        """SqliteDB.selectを読み出し用スレッドで実行します。結果はレコードのタプルのリストです。"""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("SingleWriterExecutor はすでに閉じられています。")
+            return self._readers.submit(
+                self.db.select,
+                table_name,
+                columns,
+                where_clause,
+                order_by,
+                join_clause,
+                limit,
+                params,
+            )
+
+    def submit_write(self, fn: Callable, *args, **kwargs) -> Future:
+        """
+        接続を第1引数に取る関数を、書き込みスレッドのトランザクション内で実行します。
+
+        Parameters
+        ----------
+        fn : Callable
+            fn(connection, *args, **kwargs)の形で呼び出される関数。
+        *args, **kwargs
+            fnに渡す引数。
+
+        Returns
+        -------
+        Future
+            fnの戻り値を結果に持つFuture。
+
+        """
+        return self._put(_WriteTask(fn, args, kwargs, in_transaction=True))
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """
+        関数を、他の書き込みとまとめずに書き込みスレッドで実行します。add_tableなどのDDLに使用します。
+
+        Parameters
+        ----------
+        fn : Callable
+            fn(*args, **kwargs)の形で呼び出される関数。
+        *args, **kwargs
+            fnに渡す引数。
+
+        Returns
+        -------
+        Future
+            fnの戻り値を結果に持つFuture。
+
+        """
+        return self._put(_WriteTask(fn, args, kwargs, in_transaction=False))
+
+    def close(self):
+        """キュー内の書き込みを全て実行してから、書き込みスレッドと読み出し用スレッドを終了します。"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+        self._readers.shutdown(wait=True)
+
+    def _put(self, task: _WriteTask) -> Future:
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("SingleWriterExecutor はすでに閉じられています。")
+            self._queue.put(task)
+        return task.future
+
+    def _run(self):
+        """キューから連続した書き込みを取り出し、まとめて実行する書き込みスレッドのループ。"""
+        stop = False
+        while not stop:
+            task = self._queue.get()
+            if task is None:
+                break
+            tasks = [task]
+            while len(tasks) < self.max_batch:
+                try:
+                    task = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if task is None:
+                    stop = True
+                    break
+                tasks.append(task)
+
+            batch = []
+            for task in tasks:
+                if task.in_transaction:
+                    batch.append(task)
+                    continue
+                self._execute_batch(batch)
+                batch = []
+                self._execute_call(task)
+            self._execute_batch(batch)
+
+    def _execute_call(self, task: _WriteTask):
+        if not task.future.set_running_or_notify_cancel():
+            return
+        try:
+            task.future.set_result(task.fn(*task.args, **task.kwargs))
+        except Exception as e:
+            task.future.set_exception(e)
+
+    def _execute_batch(self, tasks: List[_WriteTask]):
+        """書き込みを1つのトランザクションで実行し、失敗した場合は個別に実行し直します。"""
+        tasks = [task for task in tasks if task.future.set_running_or_notify_cancel()]
+        if not tasks:
+            return
+        try:
+            results = self._execute_transaction(tasks)
+        except Exception as e:
+            if len(tasks) == 1:
+                tasks[0].future.set_exception(e)
+                return
+            with self._lock:
+                self._stats["retries"] += 1
+            for task in tasks:
+                try:
+                    result = self._execute_transaction([task])[0]
+                except Exception as task_error:
+                    task.future.set_exception(task_error)
+                else:
+                    task.future.set_result(result)
+            return
+        for task, result in zip(tasks, results):
+            task.future.set_result(result)
+
+    def _execute_transaction(self, tasks: List[_WriteTask]) -> list:
+        with self.db.get_session() as session:
+            connection = session.connection()
+            results = [task.fn(connection, *task.args, **task.kwargs) for task in tasks]
+        with self._lock:
+            self._stats["writes"] += len(tasks)
+            self._stats["transactions"] += 1
+            self._stats["max_batch_size"] = max(
+                self._stats["max_batch_size"], len(tasks)
+            )
+        return results
@@ -1,7 +1,145 @@
-from typing import List, Tuple
-from contextlib import contextmanager
-from sqlalchemy import create_engine
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+from itertools import islice
+from functools import lru_cache
+from contextlib import contextmanager, nullcontext
+from datetime import date, datetime, timedelta
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.sql.elements import TextClause
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool, QueuePool
+
+from .archive import Archiver
+from .buffered_writer import BufferedWriter
+from .pool_stats import PoolStats
+from .query_stats import QueryStats
+from .single_writer import SingleWriterExecutor
+from .thread_pool import ThreadLocalConnections
+
+# SqliteDBで選択できるコネクションプールの方式
+POOL_STRATEGIES = ("thread", "queue", "null")
+# 変更フィードのコンシューマーごとの既読位置を保存するテーブル名
+CHANGE_FEED_TABLE = "change_feed_offsets"
+
+# add_tableのインデックス宣言: 列名、列名のリスト、または"columns"などをキーに持つ辞書
+IndexSpec = Union[str, Sequence[str], Dict[str, Any]]
+
+# 接続プロファイルごとのPRAGMA設定
+# throughput : WALと synchronous=NORMAL で書き込みスループットを優先する
+# durable    : synchronous=FULL でコミットごとの永続性を優先する
+# read-mostly: 大きいキャッシュとmmapで読み出しを優先する
+PRAGMA_PROFILES = {
+    "throughput": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64000,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+    "durable": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "cache_size": -16000,
+        "mmap_size": 0,
+        "temp_store": "DEFAULT",
+        "busy_timeout": 10000,
+    },
+    "read-mostly": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -128000,
+        "mmap_size": 1073741824,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+}
+
+# パーティション期間ごとの、パーティション名の日付書式、文字列の日時から切り出す長さ、日付部分の桁数
+PARTITION_INTERVALS = {
+    "day": ("%Y%m%d", 10, 8),
+    "month": ("%Y%m", 7, 6),
+}
+
+
+def _partition_key(value, interval: str) -> str:
+    """日時の値から、パーティション名の日付部分を返します。"""
+    date_format, length, key_length = PARTITION_INTERVALS[interval]
+    if isinstance(value, (datetime, date)):
+        return value.strftime(date_format)
+    # "YYYY-MM-DD HH:MM:SS"形式の文字列は、解析せずに先頭を切り出す
+    key = str(value)[:length].replace("-", "")
+    if len(key) != key_length or not key.isdigit():
+        raise ValueError(f"パーティションを決定できない日時の値です: {value}")
+    return key
+
+
+def _partition_bounds(key: str, interval: str) -> Tuple[datetime, datetime]:
+    """パーティション名の日付部分から、その期間の開始と終了(含まない)を返します。"""
+    start = datetime.strptime(key, PARTITION_INTERVALS[interval][0])
+    if interval == "day":
+        return start, start + timedelta(days=1)
+    if start.month == 12:
+        return start, start.replace(year=start.year + 1, month=1)
+    return start, start.replace(month=start.month + 1)
+
+
+def _partition_overlaps(key: str, interval: str, start, end) -> bool:
+    """パーティションの期間が、start以上end未満の範囲と重なるかどうかを返します。"""
+    partition_start, partition_end = _partition_bounds(key, interval)
+    # 日時は"YYYY-MM-DD HH:MM:SS"形式の文字列として比較する
+    if start is not None and str(partition_end) <= str(start):
+        return False
+    if end is not None and str(partition_start) >= str(end):
+        return False
+    return True
+
+
+def _affinity(declared_type: str) -> str:
+    """SQLiteの型アフィニティの規則に従って、宣言された列の型からアフィニティを返します。"""
+    declared_type = declared_type.upper()
+    if "INT" in declared_type:
+        return "INTEGER"
+    if "CHAR" in declared_type or "CLOB" in declared_type or "TEXT" in declared_type:
+        return "TEXT"
+    if "BLOB" in declared_type or not declared_type.strip():
+        return "BLOB"
+    if "REAL" in declared_type or "FLOA" in declared_type or "DOUB" in declared_type:
+        return "REAL"
+    return "NUMERIC"
+
+
+def _is_unindexed_step(detail: str) -> bool:
+    """EXPLAIN QUERY PLANのステップが、全件走査または一時B-treeの作成かどうかを返します。"""
+    if detail.startswith("USE TEMP B-TREE"):
+        return True
+    # SQLiteのバージョンにより"SCAN TABLE t"または"SCAN t"と表示される。
+    # "SCAN t USING INDEX i"もインデックスを全件たどるため対象とし、SEARCHのみをインデックス検索とみなす
+    return detail.startswith("SCAN ") and detail != "SCAN CONSTANT ROW"
+
+
+@lru_cache(maxsize=256)
+def _select_statement(
+    table_name: str,
+    columns: Optional[Tuple[str, ...]],
+    where_clause: Optional[str],
+    order_by: Optional[str],
+    join_clause: Optional[str],
+    limit: Optional[int],
+) -> TextClause:
+    """SELECT文を組み立てます。同じ引数の文は構築済みのものを再利用します。"""
+    column_string = "*"
+    if columns:
+        column_string = ", ".join(columns)
+    query = f"SELECT {column_string} FROM {table_name}"
+    if join_clause:
+        query += f" {join_clause}"
+    if where_clause:
+        query += f" WHERE {where_clause}"
+    if order_by:
+        query += f" ORDER BY {order_by}"
+    if limit:
+        query += f" LIMIT {limit}"
+    return text(query)
 
 
 class SqliteDB:
@@ -12,21 +150,52 @@ class SqliteDB:
     ----------
     db_file : str
         SQLiteデータベースのファイルパス。
+    profile : str, optional
+        接続プロファイル名。PRAGMA_PROFILESのキーのいずれか。
+    pragmas : dict, optional
+        プロファイルに追加または上書きするPRAGMAの辞書。
+    pool : str, optional
+        コネクションプールの方式。POOL_STRATEGIESのいずれか。
 
     Attributes
     ----------
     db_file : str
         SQLiteデータベースのファイルパス。
+    pragmas : dict
+        各接続に適用するPRAGMAの辞書。
     tables : dict
-        データベース内のテーブル名と列定義のマップ。
+        データベース内のテーブル名と列定義のマップ。作成時に既存のテーブルも読み込まれます。
+    schema : dict
+        テーブル名と、列名("columns")・型("types")・アフィニティ("affinities")・INSERT文("insert")のマップ。
+    indexes : dict
+        add_tableで作成したテーブル名とインデックス名のリストのマップ。
+    queries : dict
+        register_queryで登録したクエリ名とselectの引数のマップ。
+    partitioned : dict
+        add_partitioned_tableで登録したテーブル名とパーティション設定のマップ。
+    executor : SingleWriterExecutor or None
+        start_single_writerで開始した書き込みスレッド。開始していない場合はNone。
     engine : sqlalchemy.engine.Engine
         データベースエンジン。
     Session : sqlalchemy.orm.session.sessionmaker
         セッションを作成するためのsessionmakerオブジェクト。
+    pool_stats : dict
+        コネクションプールの統計。
+    query_stats : QueryStats
+        enable_query_stats()で有効にしたSQL文の実行時間の集計。無効の場合はNone。
 
     """
 
-    def __init__(self, db_file: str):
+    def __init__(
+        self,
+        db_file: str,
+        profile: Optional[str] = None,
+        pragmas: Optional[Dict[str, Union[str, int]]] = None,
+        pool: Optional[str] = None,
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        pool_timeout: float = 30,
+    ):
         """
         SQLiteデータベースのファイルパスを指定して、SqliteDBオブジェクトを作成します。
 
@@ -34,14 +203,201 @@ class SqliteDB:
         ----------
         db_file : str
             SQLiteデータベースのファイルパス。
+        profile : str, optional
+            接続プロファイル名。"throughput"、"durable"、"read-mostly"のいずれか。
+            指定した場合、プロファイルのPRAGMAをプールの全接続に適用します。デフォルトはNone(SQLiteの既定値)です。
+            profileまたはpragmasを指定し、poolを指定しない場合は、接続を保持する"queue"を使用します。
+        pragmas : Dict[str, Union[str, int]], optional
+            プロファイルに追加または上書きするPRAGMAの辞書。
+        pool : str, optional
+            コネクションプールの方式。デフォルトはNone(SQLAlchemyの既定値。ファイルの場合は接続を再利用しない)です。
+            - "thread": スレッドごとに接続を1つ保持して再利用する(ThreadLocalConnections)。
+              実行中のスレッドの接続は閉じず、終了したスレッドの接続はpool_size個まで、新しいスレッドに引き継ぎます。
+              同じスレッドで入れ子にしたget_sessionは、外側のトランザクションに影響しないよう別の接続を使用します。
+            - "queue": pool_size個の接続を共有し、不足時はmax_overflow個まで追加する(QueuePool)。
+            - "null": セッションごとに接続を開いて閉じる(NullPool)。
+        pool_size : int, optional
+            "thread"では終了したスレッドから引き継ぐために保持する接続数、"queue"では常時保持する接続数。
+            デフォルトは5です。
+        max_overflow : int, optional
+            "queue"でpool_sizeを超えて作成できる接続数。デフォルトは10です。
+        pool_timeout : float, optional
+            "queue"で空き接続を待つ最大秒数。デフォルトは30秒です。
 
         """
         self.db_file = db_file
         self.tables = {}
-        self.engine = create_engine(f"sqlite:///{db_file}", connect_args={"check_same_thread": False})
+        self.indexes = {}
+        self.queries = {}
+        self.partitioned = {}
+        self.executor = None
+        self.pragmas = self._resolve_pragmas(profile, pragmas)
+        if pool is None and self.pragmas and db_file not in ("", ":memory:"):
+            # ファイルの既定のNullPoolではセッションごとに接続を開き直してPRAGMAを適用し直すため、接続を保持する
+            pool = "queue"
+        self.engine = create_engine(
+            f"sqlite:///{db_file}",
+            connect_args={"check_same_thread": False},
+            **self._pool_options(pool, pool_size, max_overflow, pool_timeout),
+        )
+        if self.pragmas:
+            event.listen(self.engine, "connect", self._apply_pragmas)
+        self._pool_stats = PoolStats(
+            self.engine, max_overflow=self._pool_max_overflow(pool, max_overflow)
+        )
+        self._thread_connections = (
+            ThreadLocalConnections(self.engine) if pool == "thread" else None
+        )
+        self.query_stats = None
         self.Session = sessionmaker(bind=self.engine)
+        self.schema = {}
+        self.reflect()
+
+    @property
+    def pool_stats(self) -> dict:
+        """
+        コネクションプールの統計。
+
+        接続数(connects)、貸し出し回数(checkouts)、貸し出し中の接続数(checked_out)とその最大値、
+        空き接続を待った回数(waits)と待ち時間(秒)など。詳細はPoolStats.snapshot()を参照してください。
+        """
+        return self._pool_stats.snapshot()
+
+    def enable_query_stats(
+        self, logger=None, slow_threshold: float = 0.5, **kwargs
+    ) -> QueryStats:
+        """
+        SQL文の実行時間の集計を開始します。すでに開始している場合は、その集計を返します。
+
+        Parameters
+        ----------
+        logger : logging.Logger, optional
+            slow_threshold秒以上かかったSQL文を出力するロガー。
+        slow_threshold : float, optional
+            遅いSQL文とみなす実行時間(秒)。デフォルトは0.5秒です。
+        **kwargs
+            QueryStatsに渡すその他の引数(buckets、max_templates)。
+
+        Returns
+        -------
+        QueryStats
+            集計結果を持つオブジェクト。snapshot()で統計を取得します。
+
+        """
+        if self.query_stats is None:
+            self.query_stats = QueryStats(
+                self.engine, logger=logger, slow_threshold=slow_threshold, **kwargs
+            )
+        return self.query_stats
+
+    def disable_query_stats(self) -> Optional[QueryStats]:
+        """SQL文の実行時間の集計を止め、それまでの集計を返します。"""
+        query_stats, self.query_stats = self.query_stats, None
+        if query_stats is not None:
+            query_stats.close()
+        return query_stats
+
+    @staticmethod
+    def _pool_options(
+        pool: Optional[str], pool_size: int, max_overflow: int, pool_timeout: float
+    ) -> dict:
+        """コネクションプールの方式から、create_engineに渡す引数を作成します。"""
+        if pool is None:
+            return {}
+        if pool == "thread":
+            # 接続はスレッドごとに保持するため、スレッド数だけ接続を貸し出せるようにする
+            return {"poolclass": QueuePool, "pool_size": pool_size, "max_overflow": -1}
+        if pool == "queue":
+            return {
+                "poolclass": QueuePool,
+                "pool_size": pool_size,
+                "max_overflow": max_overflow,
+                "pool_timeout": pool_timeout,
+            }
+        if pool == "null":
+            return {"poolclass": NullPool}
+        raise ValueError(f"不明なコネクションプールの方式です: pool={pool}, 有効な値={POOL_STRATEGIES}")
+
+    @staticmethod
+    def _pool_max_overflow(pool: Optional[str], max_overflow: int) -> int:
+        """プールの方式から、QueuePoolに渡したmax_overflowを返します。"""
+        if pool == "queue":
+            return max_overflow
+        if pool == "thread":
+            return -1
+        return 0
+
+    @staticmethod
+    def _resolve_pragmas(
+        profile: Optional[str], pragmas: Optional[Dict[str, Union[str, int]]]
+    ) -> Dict[str, Union[str, int]]:
+        """プロファイルと個別指定から、接続に適用するPRAGMAを決定します。"""
+        resolved = {}
+        if profile is not None:
+            if profile not in PRAGMA_PROFILES:
+                raise ValueError(
+                    f"不明な接続プロファイルです: profile={profile}, 有効な値={list(PRAGMA_PROFILES)}"
+                )
+            resolved.update(PRAGMA_PROFILES[profile])
+        if pragmas:
+            resolved.update(pragmas)
+        return resolved
+
+    def _apply_pragmas(self, dbapi_connection, connection_record):
+        """新しいDBAPI接続が作られるたびにPRAGMAを適用するengineのconnectフック。"""
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in self.pragmas.items():
+                cursor.execute(f"PRAGMA {name} = {value}")
+        finally:
+            cursor.close()
+
+    def reflect(self) -> Dict[str, dict]:
+        """
+        データベースに存在するテーブルの列定義を読み込み、スキーマキャッシュを更新します。
+
+        SqliteDBの作成時に1回呼び出されるため、開き直したデータベースのテーブルも
+        add_tableを呼び出さずにinsert_manyなどで使用できます。
+        add_tableで登録済みのテーブルの列定義(tables)は上書きしません。
+
+        Returns
+        -------
+        Dict[str, dict]
+            テーブル名とスキーマ情報のマップ(schema属性)。
+
+        """
+        with self.get_session() as session:
+            connection = session.connection()
+            names = connection.exec_driver_sql(
+                "SELECT name FROM sqlite_master "
+                "WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+            ).fetchall()
+            for (table_name,) in names:
+                info = connection.exec_driver_sql(
+                    f'PRAGMA table_info("{table_name}")'
+                ).fetchall()
+                # table_infoの各行は(cid, name, type, notnull, dflt_value, pk)
+                columns = [(row[1], row[2]) for row in info]
+                self.tables.setdefault(table_name, columns)
+                self._cache_schema(table_name, columns)
+        return self.schema
+
+    def _cache_schema(self, table_name: str, columns: List[Tuple[str, str]]):
+        """列定義から、列名・型・アフィニティと挿入用のINSERT文をキャッシュします。"""
+        types = [col[1] for col in columns]
+        self.schema[table_name] = {
+            "columns": [col[0] for col in columns],
+            "types": types,
+            "affinities": [_affinity(col_type) for col_type in types],
+            "insert": self._insert_statement(table_name, len(columns)),
+        }
 
-    def add_table(self, table_name: str, columns: List[Tuple[str, str]]):
+    def add_table(
+        self,
+        table_name: str,
+        columns: List[Tuple[str, str]],
+        indexes: Optional[List[IndexSpec]] = None,
+    ):
         """
         指定されたテーブル名と列定義を使用して、データベース内に新しいテーブルを作成します。
 
@@ -51,12 +407,55 @@ class SqliteDB:
             テーブル名。
         columns : List[Tuple[str, str]]
             列定義のリスト。各要素は、列名とデータ型のタプルです。
+        indexes : List[Union[str, Sequence[str], dict]], optional
+            作成するインデックスのリスト。各要素は以下のいずれかです。
+            - 列名の文字列(単一列インデックス)。例: "timestamp"
+            - 列名のリストまたはタプル(複合インデックス)。例: ["sensor_id", "timestamp DESC"]
+            - "columns"、"unique"、"where"、"name"をキーに持つ辞書(ユニーク・部分インデックス)。
+              例: {"columns": ["timestamp"], "unique": True, "where": "data IS NOT NULL"}
 
         """
         self.tables[table_name] = columns
+        self._cache_schema(table_name, columns)
+        index_statements = [
+            self._create_index_statement(table_name, index) for index in indexes or []
+        ]
         with self.get_session() as session:
             column_string = ", ".join([f"{col[0]} {col[1]}" for col in columns])
-            session.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({column_string})")
+            session.execute(
+                f"CREATE TABLE IF NOT EXISTS {table_name} ({column_string})"
+            )
+            for index_name, statement in index_statements:
+                session.execute(text(statement))
+        self.indexes.setdefault(table_name, [])
+        for index_name, _ in index_statements:
+            if index_name not in self.indexes[table_name]:
+                self.indexes[table_name].append(index_name)
+
+    @staticmethod
+    def _create_index_statement(table_name: str, index: IndexSpec) -> Tuple[str, str]:
+        """インデックス宣言から、インデックス名とCREATE INDEX文を作成します。"""
+        if isinstance(index, str):
+            index = {"columns": [index]}
+        elif not isinstance(index, dict):
+            index = {"columns": list(index)}
+        columns = index.get("columns")
+        if not columns:
+            raise ValueError(f"インデックスの列が指定されていません: table={table_name}, index={index}")
+        if isinstance(columns, str):
+            columns = [columns]
+        # 列名の後の"DESC"などは除いてインデックス名を作る
+        name = index.get("name") or f"idx_{table_name}_" + "_".join(
+            col.split()[0] for col in columns
+        )
+        unique = "UNIQUE " if index.get("unique") else ""
+        statement = (
+            f"CREATE {unique}INDEX IF NOT EXISTS {name} "
+            f"ON {table_name} ({', '.join(columns)})"
+        )
+        if index.get("where"):
+            statement += f" WHERE {index['where']}"
+        return name, statement
 
     def insert(self, table_name: str, values: Tuple):
         """
@@ -70,34 +469,228 @@ class SqliteDB:
             新しいレコードの値のタプル。
 
         """
+        if self.executor is not None:
+            self.executor.insert(table_name, values).result()
+            return
         with self.get_session() as session:
-            value_string = ", ".join([f"'{v}'" for v in values])
-            session.execute(f"INSERT INTO {table_name} VALUES ({value_string})")
+            self._insert_rows(session.connection(), table_name, [tuple(values)], 1)
 
-    def insert_many(self, table_name: str, values: List[Tuple]):
+    def insert_many(
+        self, table_name: str, values: Iterable[Tuple], chunk_size: int = 1000
+    ) -> int:
         """
         指定されたテーブルに、複数の新しいレコードを挿入します。
+        バインドパラメータを使ったexecutemanyで、chunk_size件ずつ1つのトランザクション内で挿入します。
 
         Parameters
         ----------
         table_name : str
             テーブル名。
-        values : List[Tuple]
-            新しいレコードの値のリスト。各要素は、列の値のタプル
+        values : Iterable[Tuple]
+            新しいレコードの値のイテラブル。各要素は、列の値のタプル。
+            ジェネレーターも指定でき、全件をメモリ上に展開せずに挿入します。
+        chunk_size : int, optional
+            1回のexecutemanyで送信するレコード数。デフォルトは1000です。
+
+        Returns
+        -------
+        int
+            挿入したレコード数。
+
         """
+        if chunk_size < 1:
+            raise ValueError(f"chunk_size は1以上を指定してください: chunk_size={chunk_size}")
+
+        if self.executor is not None:
+            return self.executor.insert_many(table_name, values, chunk_size).result()
         with self.get_session() as session:
-            column_count = len(self.tables[table_name])
+            return self._insert_rows(
+                session.connection(), table_name, values, chunk_size
+            )
+
+    def upsert_many(
+        self,
+        table_name: str,
+        values: Iterable[Tuple],
+        conflict_columns: Union[str, Sequence[str]],
+        update_columns: Optional[Sequence[str]] = None,
+        do_nothing: bool = False,
+        chunk_size: int = 500,
+    ) -> Dict[str, int]:
+        """
+        INSERT ... ON CONFLICT を使って、複数のレコードを挿入または更新します。
+
+        chunk_size件ごとに1つのトランザクションで実行します。conflict_columnsには、
+        add_tableでユニークインデックス(または主キー)を作成した列を指定してください。
+
+        Parameters
+        ----------
+        table_name : str
+            add_tableで登録したテーブル名。
+        values : Iterable[Tuple]
+            レコードの値のイテラブル。各要素は、全ての列の値のタプル。
+        conflict_columns : Union[str, Sequence[str]]
+            重複の判定に使う列名、または列名のリスト。
+        update_columns : Sequence[str], optional
+            重複時に更新する列名のリスト。デフォルトはconflict_columns以外の全ての列です。
+        do_nothing : bool, optional
+            Trueの場合、重複したレコードは更新せずにスキップします。デフォルトはFalseです。
+        chunk_size : int, optional
+            1つのトランザクションで処理するレコード数。デフォルトは500です。
+
+        Returns
+        -------
+        Dict[str, int]
+            挿入したレコード数("inserted")、更新したレコード数("updated")、スキップしたレコード数("skipped")。
+
+        """
+        if chunk_size < 1:
+            raise ValueError(f"chunk_size は1以上を指定してください: chunk_size={chunk_size}")
+        if table_name not in self.tables:
+            raise ValueError(f"テーブル {table_name} はadd_tableで登録されていません。")
+        if isinstance(conflict_columns, str):
+            conflict_columns = [conflict_columns]
+        column_names = [col[0] for col in self.tables[table_name]]
+        key_positions = [column_names.index(col) for col in conflict_columns]
+        if update_columns is None:
+            update_columns = [
+                col for col in column_names if col not in conflict_columns
+            ]
+
+        placeholders = ", ".join(["?"] * len(column_names))
+        statement = (
+            f"INSERT INTO {table_name} ({', '.join(column_names)}) "
+            f"VALUES ({placeholders}) "
+            f"ON CONFLICT ({', '.join(conflict_columns)}) "
+        )
+        if do_nothing or not update_columns:
+            statement += "DO NOTHING"
+        else:
+            statement += "DO UPDATE SET " + ", ".join(
+                f"{col} = excluded.{col}" for col in update_columns
+            )
+
+        counts = {"inserted": 0, "updated": 0, "skipped": 0}
+        rows = iter(values)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            args = (table_name, statement, chunk, conflict_columns, key_positions)
+            if self.executor is not None:
+                inserted = self.executor.submit_write(
+                    self._upsert_chunk, *args
+                ).result()
+            else:
+                with self.get_session() as session:
+                    inserted = self._upsert_chunk(session.connection(), *args)
+            counts["inserted"] += inserted
+            counts["skipped" if do_nothing or not update_columns else "updated"] += (
+                len(chunk) - inserted
+            )
+        return counts
+
+    def _upsert_chunk(
+        self,
+        connection,
+        table_name: str,
+        statement: str,
+        chunk: List[Tuple],
+        conflict_columns,
+        key_positions,
+    ) -> int:
+        """接続上で1チャンクのINSERT ... ON CONFLICTを実行し、新しく挿入したレコード数を返します。"""
+        keys = {tuple(row[i] for i in key_positions) for row in chunk}
+        existing = self._existing_keys(connection, table_name, conflict_columns, keys)
+        connection.exec_driver_sql(statement, chunk)
+        # チャンク内の重複したキーは、最初の1件が挿入され、残りは更新(またはスキップ)になる
+        return len(keys - existing)
+
+    @staticmethod
+    def _existing_keys(
+        connection, table_name: str, key_columns: Sequence[str], keys: set
+    ) -> set:
+        """指定されたキーのうち、テーブルにすでに存在するものを返します。"""
+        key_list = list(keys)
+        # SQLiteのバインドパラメータ数の上限(古いバージョンでは999)を超えないように分割する
+        batch_size = max(1, 900 // len(key_columns))
+        column_string = ", ".join(key_columns)
+        existing = set()
+        for start in range(0, len(key_list), batch_size):
+            batch = key_list[start:start + batch_size]
+            if len(key_columns) == 1:
+                condition = f"{column_string} IN ({', '.join(['?'] * len(batch))})"
+                params = tuple(key[0] for key in batch)
+            else:
+                row_placeholder = f"({', '.join(['?'] * len(key_columns))})"
+                rows = ", ".join([row_placeholder] * len(batch))
+                condition = f"({column_string}) IN (VALUES {rows})"
+                params = tuple(value for key in batch for value in key)
+            result = connection.exec_driver_sql(
+                f"SELECT {column_string} FROM {table_name} WHERE {condition}", params
+            )
+            existing.update(tuple(row) for row in result)
+        return existing
+
+    def buffered_writer(
+        self, max_rows: int = 500, max_delay: float = 1.0, chunk_size: int = 1000
+    ) -> BufferedWriter:
+        """
+        単一レコードの挿入をまとめて書き込むBufferedWriterを作成します。
+
+        Parameters
+        ----------
+        max_rows : int, optional
+            書き込みを行うバッファ内のレコード数のしきい値。デフォルトは500です。
+        max_delay : float, optional
+            レコードをバッファに保持する最大秒数。デフォルトは1.0秒です。
+        chunk_size : int, optional
+            1回のexecutemanyで送信するレコード数。デフォルトは1000です。
+
+        Returns
+        -------
+        BufferedWriter
+            このデータベースに書き込むBufferedWriter。使用後はclose()を呼び出してください。
+
+        """
+        return BufferedWriter(
+            self, max_rows=max_rows, max_delay=max_delay, chunk_size=chunk_size
+        )
 
-            # 各タプルの値をカンマ区切りの文字列に変換して、括弧で囲んでリストに格納する
-            value_strings = []
-            for value in values:
-                item_strings = [f'"{value[i]}"' for i in range(column_count)]
-                value_string = f"({', '.join(item_strings)})"
-                value_strings.append(value_string)
+    def _insert_rows(
+        self, connection, table_name: str, values: Iterable[Tuple], chunk_size: int
+    ) -> int:
+        """接続上でレコードをchunk_size件ずつexecutemanyで挿入し、挿入件数を返します。"""
+        if table_name in self.partitioned:
+            return self._insert_partitioned_rows(
+                connection, table_name, values, chunk_size
+            )
+        rows = iter(values)
+        inserted = 0
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            schema = self.schema.get(table_name)
+            if schema is None:
+                # スキーマが不明なテーブルの場合は、最初のレコードから列数を決める
+                statement = self._insert_statement(table_name, len(chunk[0]))
+            else:
+                if len(chunk[0]) != len(schema["columns"]):
+                    raise ValueError(
+                        f"テーブル {table_name} の列数は {len(schema['columns'])} ですが、"
+                        f"{len(chunk[0])} 個の値が指定されました: {chunk[0]}"
+                    )
+                statement = schema["insert"]
+            connection.exec_driver_sql(statement, chunk)
+            inserted += len(chunk)
+        return inserted
 
-            # 各タプルの値をカンマ区切りで結合し、INSERTクエリを実行する
-            value_string = ", ".join(value_strings)
-            session.execute(f"INSERT INTO {table_name} VALUES {value_string}")
+    @staticmethod
+    def _insert_statement(table_name: str, column_count: int) -> str:
+        """プレースホルダー付きのINSERT文を作成します。"""
+        placeholders = ", ".join(["?"] * column_count)
+        return f"INSERT INTO {table_name} VALUES ({placeholders})"
 
     def select(
         self,
@@ -107,10 +700,15 @@ class SqliteDB:
         order_by: str = None,
         join_clause: str = None,
         limit: int = None,
+        params: Optional[Dict[str, Any]] = None,
     ) -> List[Tuple]:
         """
         指定されたテーブルから、指定された条件に一致するレコードを取得します。
 
+        同じ引数の組み合わせに対するSELECT文はキャッシュされ、再利用されます。
+        値はwhere_clauseに直接埋め込まずに、":name"形式のバインドパラメータとparamsで渡すと、
+        値が変わっても同じ文が再利用されます。
+
         Parameters
         ----------
         table_name : str
@@ -125,6 +723,8 @@ class SqliteDB:
             JOIN句の文字列。デフォルトはNoneです。
         limit : int, optional
             取得するレコードの最大数。デフォルトはNoneです。
+        params : Dict[str, Any], optional
+            バインドパラメータの辞書。デフォルトはNoneです。
 
         Returns
         -------
@@ -132,22 +732,707 @@ class SqliteDB:
             指定された条件に一致するレコードのタプルのリスト。
 
         """
+        statement = _select_statement(
+            table_name,
+            tuple(columns) if columns else None,
+            where_clause,
+            order_by,
+            join_clause,
+            limit,
+        )
+        with self.get_session() as session:
+            result = session.execute(statement, params or {})
+            rows = result.fetchall()
+            if self.query_stats is not None:
+                self.query_stats.add_rows(len(rows))
+        return rows
+
+    def select_iter(
+        self,
+        table_name: str,
+        columns: List[str] = None,
+        where_clause: str = None,
+        order_by: str = None,
+        join_clause: str = None,
+        limit: int = None,
+        params: Optional[Dict[str, Any]] = None,
+        fetch_size: int = 1000,
+    ) -> Iterator[Tuple]:
+        """
+        selectと同じ条件でレコードを取得し、fetch_size件ずつカーソルから読み出しながら1件ずつ返すジェネレーター。
+
+        結果全体をメモリ上に展開しないため、大量のレコードのエクスポートに使用します。
+        反復中はセッションを開いたままにし、最後まで読み出すか、ジェネレーターが閉じられた時点
+        (for文のbreakやclose()など)でカーソルとセッションを閉じます。
+
+        Parameters
+        ----------
+        table_name : str
+            テーブル名。
+        columns : List[str], optional
+            取得する列名のリスト。デフォルトは全ての列を取得します。
+        where_clause : str, optional
+            WHERE句の文字列。デフォルトはNoneです。
+        order_by : str, optional
+            ORDER BY句の文字列。デフォルトはNoneです。
+        join_clause : str, optional
+            JOIN句の文字列。デフォルトはNoneです。
+        limit : int, optional
+            取得するレコードの最大数。デフォルトはNoneです。
+        params : Dict[str, Any], optional
+            バインドパラメータの辞書。デフォルトはNoneです。
+        fetch_size : int, optional
+            カーソルから一度に読み出すレコード数。デフォルトは1000です。
+
+        Yields
+        ------
+        Tuple
+            指定された条件に一致するレコード。
+
+        """
+        if fetch_size < 1:
+            raise ValueError(f"fetch_size は1以上を指定してください: fetch_size={fetch_size}")
+        statement = _select_statement(
+            table_name,
+            tuple(columns) if columns else None,
+            where_clause,
+            order_by,
+            join_clause,
+            limit,
+        )
+        with self.get_session() as session:
+            result = session.execute(
+                statement.execution_options(stream_results=True), params or {}
+            )
+            try:
+                while True:
+                    rows = result.fetchmany(fetch_size)
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                result.close()
+
+    def select_numpy(
+        self,
+        table_name: str,
+        columns: List[str] = None,
+        where_clause: str = None,
+        order_by: str = None,
+        join_clause: str = None,
+        limit: int = None,
+        params: Optional[Dict[str, Any]] = None,
+        dtypes: Optional[Dict[str, Any]] = None,
+        fetch_size: int = 10000,
+        structured: bool = False,
+    ):
+        """
+        selectと同じ条件でレコードを取得し、列ごとのNumPy配列として返します。
+
+        カーソルからfetch_size件ずつ読み出したタプルのリストを、そのまま構造化配列に変換するため、
+        Pythonレベルでの行ごとの変換を行いません。numpyが必要です。
+
+        各列のdtypeは、dtypesで指定したもの、add_tableで登録した列の型のアフィニティ
+        (INTEGER: int64、REAL: float64、TEXT/BLOB: object)、最初のレコードの値の型の順に決定します。
+        NULLを含むINTEGER列は、dtypesで"f8"などを指定してください(NULLはnanになります)。
+
+        Parameters
+        ----------
+        table_name : str
+            テーブル名。
+        columns : List[str], optional
+            取得する列名のリスト。デフォルトは全ての列を取得します。
+        where_clause : str, optional
+            WHERE句の文字列。デフォルトはNoneです。
+        order_by : str, optional
+            ORDER BY句の文字列。デフォルトはNoneです。
+        join_clause : str, optional
+            JOIN句の文字列。デフォルトはNoneです。
+        limit : int, optional
+            取得するレコードの最大数。デフォルトはNoneです。
+        params : Dict[str, Any], optional
+            バインドパラメータの辞書。デフォルトはNoneです。
+        dtypes : Dict[str, Any], optional
+            列名とNumPyのdtypeの辞書。デフォルトはNoneです。
+        fetch_size : int, optional
+            カーソルから一度に読み出すレコード数。デフォルトは10000です。
+        structured : bool, optional
+            Trueの場合、列ごとの辞書ではなく構造化配列を返します。デフォルトはFalseです。
+
+        Returns
+        -------
+        Dict[str, numpy.ndarray] or numpy.ndarray
+            列名とNumPy配列の辞書。structured=Trueの場合は構造化配列。
+
+        """
+        try:
+            import numpy as np
+        except ImportError as e:
+            raise ImportError("select_numpy を使用するには numpy をインストールしてください。") from e
+        if fetch_size < 1:
+            raise ValueError(f"fetch_size は1以上を指定してください: fetch_size={fetch_size}")
+
+        statement = _select_statement(
+            table_name,
+            tuple(columns) if columns else None,
+            where_clause,
+            order_by,
+            join_clause,
+            limit,
+        )
+        with self.get_session() as session:
+            # sqlite3のカーソルは行をタプルで返すため、DBAPIカーソルから直接読み出す
+            cursor = session.connection().connection.cursor()
+            try:
+                cursor.execute(statement.text, params or {})
+                names = [description[0] for description in cursor.description]
+                rows = cursor.fetchmany(fetch_size)
+                dtype = self._numpy_dtype(
+                    np, table_name, names, rows[0] if rows else None, dtypes
+                )
+                chunks = []
+                while rows:
+                    chunks.append(np.array(rows, dtype=dtype))
+                    rows = cursor.fetchmany(fetch_size)
+            finally:
+                cursor.close()
+
+        array = np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype)
+        if structured:
+            return array
+        return {name: np.ascontiguousarray(array[name]) for name in names}
+
+    def _numpy_dtype(
+        self,
+        np,
+        table_name: str,
+        names: List[str],
+        sample: Optional[Tuple],
+        dtypes: Optional[Dict[str, Any]],
+    ):
+        """列名と最初のレコードから、select_numpyで使用する構造化配列のdtypeを決定します。"""
+        schema = self.schema.get(table_name)
+        affinities = (
+            dict(zip(schema["columns"], schema["affinities"])) if schema else {}
+        )
+        fields = []
+        for i, name in enumerate(names):
+            if dtypes and name in dtypes:
+                fields.append((name, dtypes[name]))
+                continue
+            affinity = affinities.get(name, "NUMERIC")
+            if affinity == "INTEGER":
+                dtype = "i8"
+            elif affinity == "REAL":
+                dtype = "f8"
+            elif affinity in ("TEXT", "BLOB"):
+                dtype = "O"
+            else:
+                # NUMERICアフィニティや式の列は、実際の値の型から決める
+                value = sample[i] if sample is not None else None
+                if isinstance(value, int):
+                    dtype = "i8"
+                elif isinstance(value, float):
+                    dtype = "f8"
+                else:
+                    dtype = "O"
+            fields.append((name, dtype))
+        return np.dtype(fields)
+
+    def register_query(
+        self,
+        name: str,
+        table_name: str,
+        columns: List[str] = None,
+        where_clause: str = None,
+        order_by: str = None,
+        join_clause: str = None,
+        limit: int = None,
+        params: Optional[Dict[str, Any]] = None,
+    ):
+        """
+        インデックスの確認対象として、selectの引数でクエリを登録します。
+
+        Parameters
+        ----------
+        name : str
+            クエリ名。
+        table_name : str
+            テーブル名。
+        columns, where_clause, order_by, join_clause, limit, params : optional
+            selectと同じ引数。paramsを省略したバインドパラメータはNULLとして実行計画を確認します。
+
+        """
+        self.queries[name] = {
+            "table_name": table_name,
+            "columns": columns,
+            "where_clause": where_clause,
+            "order_by": order_by,
+            "join_clause": join_clause,
+            "limit": limit,
+            "params": params,
+        }
+
+    def explain(
+        self,
+        table_name: str,
+        columns: List[str] = None,
+        where_clause: str = None,
+        order_by: str = None,
+        join_clause: str = None,
+        limit: int = None,
+        params: Optional[Dict[str, Any]] = None,
+    ) -> List[str]:
+        """
+        selectと同じ引数のクエリに対するEXPLAIN QUERY PLANの結果を返します。
+
+        Returns
+        -------
+        List[str]
+            実行計画の各ステップの説明(detail列)のリスト。
+
+        """
+        statement = _select_statement(
+            table_name,
+            tuple(columns) if columns else None,
+            where_clause,
+            order_by,
+            join_clause,
+            limit,
+        )
+        # 値が指定されていないバインドパラメータはNULLで埋める
+        bind_values = dict(statement.compile().params)
+        bind_values.update(params or {})
+        with self.get_session() as session:
+            result = session.execute(
+                text(f"EXPLAIN QUERY PLAN {statement.text}"), bind_values
+            )
+            return [row[-1] for row in result.fetchall()]
+
+    def check_index_coverage(self) -> Dict[str, List[str]]:
+        """
+        登録されたクエリの実行計画を確認し、インデックス検索にならないステップを報告します。
+
+        テーブルまたはインデックスの全件走査(SCAN)と、
+        ORDER BYなどのための一時B-treeの作成(USE TEMP B-TREE)を対象とします。
+
+        Returns
+        -------
+        Dict[str, List[str]]
+            問題のあるクエリ名と、該当する実行計画のステップのマップ。全てのクエリがインデックスを使う場合は空の辞書。
+
+        """
+        report = {}
+        for name, query in self.queries.items():
+            details = [
+                detail for detail in self.explain(**query) if _is_unindexed_step(detail)
+            ]
+            if details:
+                report[name] = details
+        return report
+
+    @staticmethod
+    def query_cache_info():
+        """
+        SELECT文キャッシュのヒット数、ミス数、最大サイズ、現在のサイズを返します。
+
+        Returns
+        -------
+        functools._CacheInfo
+            functools.lru_cacheのcache_info()と同じ形式の統計。
+
+        """
+        return _select_statement.cache_info()
+
+    def read_changes(
+        self,
+        table_name: str,
+        consumer: str,
+        limit: int = 100,
+        columns: List[str] = None,
+    ) -> List[Tuple]:
+        """
+        コンシューマーがまだ読んでいないレコードを、rowidの順に最大limit件取得します。
+
+        コンシューマーごとの既読位置(rowidの最大値)はデータベース内のテーブル
+        (CHANGE_FEED_TABLE)に保存され、commit_changesで進めます。
+        rowidの主キー検索のみで取得するため、テーブル全体の走査や、タイムスタンプが重複したレコードの
+        取りこぼしがありません。最新のレコードを削除するとrowidが再利用されるため、
+        レコードを削除するテーブルでは"INTEGER PRIMARY KEY AUTOINCREMENT"の列を定義してください。
+
+        Parameters
+        ----------
+        table_name : str
+            テーブル名。分割テーブルには使用できません。
+        consumer : str
+            コンシューマー名。
+        limit : int, optional
+            取得するレコードの最大数。デフォルトは100です。
+        columns : List[str], optional
+            取得する列名のリスト。デフォルトは全ての列を取得します。
+
+        Returns
+        -------
+        List[Tuple]
+            先頭の要素がrowidのレコードのタプルのリスト。
+
+        """
+        if table_name in self.partitioned:
+            raise ValueError(f"分割テーブル {table_name} には変更フィードを使用できません。")
+        self._ensure_change_feed_table()
+        column_string = ", ".join(columns) if columns else "*"
+        query = (
+            f"SELECT rowid, {column_string} FROM {table_name} "
+            "WHERE rowid > "
+            f"(SELECT COALESCE(MAX(last_rowid), 0) FROM {CHANGE_FEED_TABLE} "
+            "WHERE consumer = :consumer AND table_name = :table_name) "
+            "ORDER BY rowid LIMIT :limit"
+        )
         with self.get_session() as session:
-            column_string = "*"
-            if columns:
-                column_string = ", ".join(columns)
-            query = f"SELECT {column_string} FROM {table_name}"
-            if join_clause:
-                query += f" {join_clause}"
-            if where_clause:
-                query += f" WHERE {where_clause}"
-            if order_by:
-                query += f" ORDER BY {order_by}"
-            if limit:
-                query += f" LIMIT {limit}"
-            result = session.execute(query)
+            result = session.execute(
+                text(query),
+                {"consumer": consumer, "table_name": table_name, "limit": limit},
+            )
             return result.fetchall()
 
+    def commit_changes(self, table_name: str, consumer: str, last_rowid: int):
+        """
+        コンシューマーの既読位置をlast_rowidまで進めます。既読位置が戻ることはありません。
+
+        Parameters
+        ----------
+        table_name : str
+            テーブル名。
+        consumer : str
+            コンシューマー名。
+        last_rowid : int
+            処理を終えたレコードのrowid(read_changesの結果の最後のレコードの先頭の要素)。
+
+        """
+        self._ensure_change_feed_table()
+        if self.executor is not None:
+            self.executor.submit_write(
+                self._commit_offset, table_name, consumer, last_rowid
+            ).result()
+            return
+        with self.get_session() as session:
+            self._commit_offset(session.connection(), table_name, consumer, last_rowid)
+
+    @staticmethod
+    def _commit_offset(connection, table_name: str, consumer: str, last_rowid: int):
+        """接続上でコンシューマーの既読位置を進めます。"""
+        connection.execute(
+            text(
+                f"INSERT INTO {CHANGE_FEED_TABLE} (consumer, table_name, last_rowid) "
+                "VALUES (:consumer, :table_name, :last_rowid) "
+                "ON CONFLICT (consumer, table_name) "
+                "DO UPDATE SET last_rowid = MAX(last_rowid, excluded.last_rowid)"
+            ),
+            {"consumer": consumer, "table_name": table_name, "last_rowid": last_rowid},
+        )
+
+    def change_offset(self, table_name: str, consumer: str) -> int:
+        """
+        コンシューマーの既読位置(処理済みのrowidの最大値)を返します。
+
+        Returns
+        -------
+        int
+            既読位置。まだ読んでいない場合は0。
+
+        """
+        self._ensure_change_feed_table()
+        result = self.select(
+            CHANGE_FEED_TABLE,
+            columns=["last_rowid"],
+            where_clause="consumer = :consumer AND table_name = :table_name",
+            params={"consumer": consumer, "table_name": table_name},
+        )
+        return result[0][0] if result else 0
+
+    def _ensure_change_feed_table(self):
+        """既読位置を保存するテーブルがなければ作成します。"""
+        if CHANGE_FEED_TABLE not in self.schema:
+            self.add_table(
+                CHANGE_FEED_TABLE,
+                [
+                    ("consumer", "TEXT NOT NULL"),
+                    ("table_name", "TEXT NOT NULL"),
+                    ("last_rowid", "INTEGER NOT NULL"),
+                ],
+                indexes=[{"columns": ["consumer", "table_name"], "unique": True}],
+            )
+
+    def add_partitioned_table(
+        self,
+        table_name: str,
+        columns: List[Tuple[str, str]],
+        time_column: str = "timestamp",
+        interval: str = "day",
+        indexes: Optional[List[IndexSpec]] = None,
+    ):
+        """
+        時間で分割されたテーブルを登録します。
+
+        レコードは time_column の値に応じて "{table_name}_YYYYMMDD"(interval="day")または
+        "{table_name}_YYYYMM"(interval="month")のパーティションテーブルに格納されます。
+        パーティションは挿入時に必要に応じて作成され、insert/insert_many/BufferedWriterは
+        table_nameを指定するだけで該当するパーティションに振り分けます。
+        既存のデータベースを開き直した場合も、同じ引数で再度呼び出してください。
+
+        Parameters
+        ----------
+        table_name : str
+            パーティションをまとめるテーブル名。
+        columns : List[Tuple[str, str]]
+            列定義のリスト。各要素は、列名とデータ型のタプルです。
+        time_column : str, optional
+            パーティションの振り分けに使う列名。値はdatetimeまたは"YYYY-MM-DD..."形式の文字列。
+            デフォルトは"timestamp"です。
+        interval : str, optional
+            パーティションの期間。"day"または"month"。デフォルトは"day"です。
+        indexes : List[Union[str, Sequence[str], dict]], optional
+            各パーティションに作成するインデックス。add_tableと同じ形式。
+
+        """
+        if interval not in PARTITION_INTERVALS:
+            raise ValueError(
+                f"不明なパーティション期間です: interval={interval}, 有効な値={list(PARTITION_INTERVALS)}"
+            )
+        column_names = [col[0] for col in columns]
+        if time_column not in column_names:
+            raise ValueError(f"列 {time_column} がテーブル {table_name} の列定義にありません。")
+        self.partitioned[table_name] = {
+            "columns": columns,
+            "time_column": time_column,
+            "time_index": column_names.index(time_column),
+            "interval": interval,
+            "indexes": indexes or [],
+            "partitions": set(self._existing_partitions(table_name, interval)),
+        }
+
+    def partitions(self, table_name: str) -> List[str]:
+        """
+        分割テーブルの既存のパーティションテーブル名を、古い順に返します。
+
+        Parameters
+        ----------
+        table_name : str
+            add_partitioned_tableで登録したテーブル名。
+
+        Returns
+        -------
+        List[str]
+            パーティションテーブル名のリスト。
+
+        """
+        config = self.partitioned[table_name]
+        return sorted(config["partitions"])
+
+    def select_range(
+        self,
+        table_name: str,
+        start=None,
+        end=None,
+        columns: List[str] = None,
+        where_clause: str = None,
+        order_by: str = None,
+        limit: int = None,
+        params: Optional[Dict[str, Any]] = None,
+    ) -> List[Tuple]:
+        """
+        分割テーブルから、time_columnが start 以上 end 未満のレコードを取得します。
+
+        期間が重なるパーティションのみをUNION ALLで検索します。
+        order_byには取得する列の名前を指定してください。
+
+        Parameters
+        ----------
+        table_name : str
+            add_partitioned_tableで登録したテーブル名。
+        start : datetime or str, optional
+            期間の開始(この値を含む)。デフォルトはNone(制限なし)です。
+        end : datetime or str, optional
+            期間の終了(この値を含まない)。デフォルトはNone(制限なし)です。
+        columns : List[str], optional
+            取得する列名のリスト。デフォルトは全ての列を取得します。
+        where_clause : str, optional
+            期間の条件に追加するWHERE句の文字列。デフォルトはNoneです。
+        order_by : str, optional
+            ORDER BY句の文字列。デフォルトはNoneです。
+        limit : int, optional
+            取得するレコードの最大数。デフォルトはNoneです。
+        params : Dict[str, Any], optional
+            バインドパラメータの辞書。デフォルトはNoneです。
+
+        Returns
+        -------
+        List[Tuple]
+            指定された条件に一致するレコードのタプルのリスト。
+
+        """
+        config = self.partitioned[table_name]
+        names = [
+            name
+            for name in self.partitions(table_name)
+            if _partition_overlaps(
+                name[len(table_name) + 1 :], config["interval"], start, end
+            )
+        ]
+        if not names:
+            return []
+
+        conditions = []
+        bind_values = dict(params or {})
+        if start is not None:
+            conditions.append(f"{config['time_column']} >= :range_start")
+            bind_values["range_start"] = str(start)
+        if end is not None:
+            conditions.append(f"{config['time_column']} < :range_end")
+            bind_values["range_end"] = str(end)
+        if where_clause:
+            conditions.append(f"({where_clause})")
+        condition_string = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        column_string = ", ".join(columns) if columns else "*"
+
+        query = " UNION ALL ".join(
+            f"SELECT {column_string} FROM {name}{condition_string}" for name in names
+        )
+        if order_by:
+            query += f" ORDER BY {order_by}"
+        if limit:
+            query += f" LIMIT {limit}"
+        with self.get_session() as session:
+            return session.execute(text(query), bind_values).fetchall()
+
+    def drop_partitions(self, table_name: str, before) -> List[str]:
+        """
+        期間の終わりが before 以前のパーティションを、テーブルごと削除します。
+
+        行単位のDELETEを行わないため、保持期間を過ぎたデータを一定の時間で削除できます。
+        削除したページはデータベース内で再利用されます。
+
+        Parameters
+        ----------
+        table_name : str
+            add_partitioned_tableで登録したテーブル名。
+        before : datetime or str
+            この日時より前のデータだけを含むパーティションを削除します。
+
+        Returns
+        -------
+        List[str]
+            削除したパーティションテーブル名のリスト。
+
+        """
+        config = self.partitioned[table_name]
+        dropped = [
+            name
+            for name in self.partitions(table_name)
+            if not _partition_overlaps(
+                name[len(table_name) + 1 :], config["interval"], before, None
+            )
+        ]
+        with self.get_session() as session:
+            for name in dropped:
+                session.execute(text(f"DROP TABLE IF EXISTS {name}"))
+        config["partitions"].difference_update(dropped)
+        for name in dropped:
+            self.tables.pop(name, None)
+            self.schema.pop(name, None)
+        return dropped
+
+    def archive(
+        self,
+        table_name: str,
+        before,
+        directory: str,
+        time_column: str = "timestamp",
+        max_rowid: Optional[int] = None,
+        **kwargs,
+    ) -> Dict[str, Any]:
+        """
+        time_columnがbeforeより前のレコードを圧縮ファイルに書き出してから削除し、領域を回収します。
+
+        レコードはchunk_rows件ずつのファイルに書き出され、件数を確認してから小さいトランザクションに
+        分けて削除されます。AUTOINCREMENTの列がないテーブルでは、rowidが再利用されないように
+        最大のrowidのレコードを残します。詳細はArchiverを参照してください。
+        分割テーブルにはdrop_partitionsを使用します。
+
+        Parameters
+        ----------
+        table_name : str
+            テーブル名。
+        before : datetime or str
+            この日時より前のレコードをアーカイブします。
+        directory : str
+            圧縮ファイルを書き出すディレクトリ。
+        time_column : str, optional
+            日時の列名。デフォルトは"timestamp"です。
+        max_rowid : int, optional
+            アーカイブするレコードのrowidの上限。未送信のレコードを残す場合に、change_offset()の値を指定します。
+        **kwargs
+            Archiverに渡す引数(format、chunk_rows、delete_batch、max_lock_time、vacuum_pages)。
+
+        Returns
+        -------
+        Dict[str, Any]
+            アーカイブしたレコード数(rows)、書き出したファイル(files)、削除したレコード数(deleted)、
+            回収したページ数(reclaimed_pages)など。
+
+        """
+        return Archiver(self, directory, **kwargs).run(
+            table_name, before, time_column, max_rowid
+        )
+
+    def _existing_partitions(self, table_name: str, interval: str) -> List[str]:
+        """スキーマキャッシュから、データベースに存在する分割テーブルのパーティション名を返します。"""
+        key_length = PARTITION_INTERVALS[interval][2]
+        prefix = f"{table_name}_"
+        return [
+            name
+            for name in self.schema
+            if name.startswith(prefix)
+            and name[len(prefix) :].isdigit()
+            and len(name) - len(prefix) == key_length
+        ]
+
+    def _insert_partitioned_rows(
+        self, connection, table_name: str, values: Iterable[Tuple], chunk_size: int
+    ) -> int:
+        """レコードをパーティションごとに振り分けて挿入し、挿入件数を返します。"""
+        config = self.partitioned[table_name]
+        time_index = config["time_index"]
+        interval = config["interval"]
+        rows = iter(values)
+        inserted = 0
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            groups = {}
+            for row in chunk:
+                key = _partition_key(row[time_index], interval)
+                groups.setdefault(f"{table_name}_{key}", []).append(row)
+            for name, group in groups.items():
+                if name not in config["partitions"]:
+                    self._create_partition(connection, config, name)
+                connection.exec_driver_sql(self.schema[name]["insert"], group)
+            inserted += len(chunk)
+        return inserted
+
+    def _create_partition(self, connection, config: dict, name: str):
+        """パーティションテーブルとそのインデックスを作成します。"""
+        column_string = ", ".join([f"{col[0]} {col[1]}" for col in config["columns"]])
+        connection.exec_driver_sql(
+            f"CREATE TABLE IF NOT EXISTS {name} ({column_string})"
+        )
+        for index in config["indexes"]:
+            _, index_statement = self._create_index_statement(name, index)
+            connection.exec_driver_sql(index_statement)
+        self._cache_schema(name, config["columns"])
+        config["partitions"].add(name)
+
     def update(self, table_name: str, set_clause: str, where_clause: str):
         """
         指定されたテーブル内のレコードを更新します。
@@ -162,9 +1447,18 @@ class SqliteDB:
             WHERE句の文字列。
 
         """
+        if self.executor is not None:
+            self.executor.update(table_name, set_clause, where_clause).result()
+            return
         with self.get_session() as session:
-            query = f"UPDATE {table_name} SET {set_clause} WHERE {where_clause}"
-            session.execute(query)
+            self._update(session.connection(), table_name, set_clause, where_clause)
+
+    @staticmethod
+    def _update(connection, table_name: str, set_clause: str, where_clause: str):
+        """接続上でUPDATE文を実行します。"""
+        connection.execute(
+            text(f"UPDATE {table_name} SET {set_clause} WHERE {where_clause}")
+        )
 
     def delete(self, table_name: str, where_clause: str):
         """
@@ -177,9 +1471,50 @@ class SqliteDB:
         where_clause : str
             WHERE句の文字列。
         """
+        if self.executor is not None:
+            self.executor.delete(table_name, where_clause).result()
+            return
         with self.get_session() as session:
-            query = f"DELETE FROM {table_name} WHERE {where_clause}"
-            session.execute(query)
+            self._delete(session.connection(), table_name, where_clause)
+
+    @staticmethod
+    def _delete(connection, table_name: str, where_clause: str):
+        """接続上でDELETE文を実行します。"""
+        connection.execute(text(f"DELETE FROM {table_name} WHERE {where_clause}"))
+
+    def start_single_writer(
+        self, readers: int = 4, max_batch: int = 100
+    ) -> SingleWriterExecutor:
+        """
+        書き込みを1本の書き込みスレッドに集約するSingleWriterExecutorを開始します。
+
+        開始後は、insert/insert_many/upsert_many/update/delete/commit_changes/archiveと
+        BufferedWriterの書き込みが書き込みスレッドで実行され、完了まで呼び出し元のスレッドを待たせます。Futureを受け取る場合はexecutorのメソッドを使用してください。
+
+        Parameters
+        ----------
+        readers : int, optional
+            読み出し用スレッドの数。デフォルトは4です。
+        max_batch : int, optional
+            1つのトランザクションにまとめる書き込みの最大数。デフォルトは100です。
+
+        Returns
+        -------
+        SingleWriterExecutor
+            開始したexecutor。
+
+        """
+        if self.executor is not None:
+            raise RuntimeError("SingleWriterExecutor はすでに開始されています。")
+        self.executor = SingleWriterExecutor(self, readers=readers, max_batch=max_batch)
+        return self.executor
+
+    def stop_single_writer(self):
+        """キュー内の書き込みを全て実行してから、SingleWriterExecutorを停止します。"""
+        if self.executor is None:
+            return
+        executor, self.executor = self.executor, None
+        executor.close()
 
     @contextmanager
     def get_session(self):
@@ -192,19 +1527,21 @@ class SqliteDB:
             新しいセッションオブジェクト。
 
         """
-        session = self.Session()
-        try:
-            yield session
-            session.commit()
-        except Exception as e:
-            session.rollback()
-            raise e
-        finally:
-            session.close()
-
-           
-
-
+        if self._thread_connections is None:
+            bind = nullcontext(self.engine)
+        else:
+            bind = self._thread_connections.connect()
+        with bind as connection:
+            session = self.Session(bind=connection)
+            try:
+                self._pool_stats.acquire(session)
+                yield session
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                raise e
+            finally:
+                session.close()
 
 
 if __name__ == "__main__":
@@ -217,18 +1554,40 @@ if __name__ == "__main__":
         db = SqliteDB(os.path.join(tmpdir, "test.db"))
 
         # テーブルの作成
-        db.add_table("users", [("id", "INTEGER PRIMARY KEY"), ("name", "TEXT"), ("email", "TEXT")])
-        db.add_table("posts", [("id", "INTEGER PRIMARY KEY"), ("title", "TEXT"), ("content", "TEXT"), ("user_id", "INTEGER")])
-        
+        db.add_table(
+            "users",
+            [("id", "INTEGER PRIMARY KEY"), ("name", "TEXT"), ("email", "TEXT")],
+        )
+        db.add_table(
+            "posts",
+            [
+                ("id", "INTEGER PRIMARY KEY"),
+                ("title", "TEXT"),
+                ("content", "TEXT"),
+                ("user_id", "INTEGER"),
+            ],
+        )
+
         # データの挿入
         for i in range(1, 6):
             db.insert("users", (i, f"User {i}", f"user{i}@example.com"))
             db.insert("posts", (i, f"Post {i}", f"Content of post {i}", i))
 
             # 複数のレコードの挿入
-        records = [(7, "Alice", "alice@example.com"), (8, "Bob", "bob@example.com"), (9, "Charlie", "charlie@example.com")]
+        records = [
+            (7, "Alice", "alice@example.com"),
+            (8, "Bob", "bob@example.com"),
+            (9, "Charlie", "charlie@example.com"),
+        ]
         db.insert_many("users", records)
 
+        # ジェネレーターからの大量レコードの挿入（chunk_size件ずつ挿入される）
+        db.insert_many(
+            "users",
+            ((i, f"User {i}", f"user{i}@example.com") for i in range(10, 5010)),
+            chunk_size=1000,
+        )
+
         # データの選択
         data = db.select("users", columns=["name", "email"], where_clause="id = 1")
         print(data)
@@ -262,4 +1621,4 @@ if __name__ == "__main__":
         # トランザクション内で複数の操作を実行する例
         with db.get_session() as session:
             session.execute("UPDATE users SET name = 'Alice' WHERE id = 1")
-            session.execute("UPDATE users SET email = 'alice@example.com' WHERE id = 1")
\ No newline at end of file
+            session.execute("UPDATE users SET email = 'alice@example.com' WHERE id = 1")
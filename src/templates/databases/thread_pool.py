@@ -0,0 +1,76 @@
+import threading
+from contextlib import contextmanager
+
+
+class ThreadLocalConnections:
+    """
+    スレッドごとにエンジンの接続(Connection)を1つ保持して再利用するクラス。
+
+    接続はエンジンのコネクションプールから取得し、スレッドが終了するまで保持します。
+    実行中のスレッドの接続は閉じず、終了したスレッドの接続は、次に新しいスレッドが接続するときに
+    プールへ返却します。返却された接続の保持数はエンジンのプール(QueuePoolのpool_size)に従います。
+
+    同じスレッドで入れ子にconnect()を呼び出した場合、内側には外側のトランザクションに影響しないよう
+    プールから別の接続を貸し出します。SQLiteでは、外側が書き込み中のまま内側で書き込むと
+    ロックの解放待ちになるため、入れ子の書き込みは避けてください。
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        接続を取得するエンジン。
+
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._lock = threading.Lock()
+        # スレッドと、そのスレッドが保持している接続のマップ
+        self._connections = {}
+        # 接続を使用中のスレッド
+        self._in_use = set()
+
+    @contextmanager
+    def connect(self):
+        """
+        現在のスレッドの接続を返します。withブロック内で使用します。
+
+        Yields
+        ------
+        sqlalchemy.engine.Connection
+            現在のスレッドの接続。入れ子の場合はプールから貸し出した別の接続。
+
+        """
+        thread = threading.current_thread()
+        with self._lock:
+            nested = thread in self._in_use
+            if not nested:
+                connection = self._thread_connection(thread)
+                self._in_use.add(thread)
+        if nested:
+            with self.engine.connect() as connection:
+                yield connection
+            return
+        try:
+            yield connection
+        finally:
+            with self._lock:
+                self._in_use.discard(thread)
+
+    def close(self):
+        """使用中でない接続を全てプールに返却します。"""
+        with self._lock:
+            for thread in list(self._connections):
+                if thread not in self._in_use:
+                    self._connections.pop(thread).close()
+
+    def _thread_connection(self, thread):
+        """スレッドの接続を返します。ない場合は、終了したスレッドの接続を返却してから取得します。"""
+        connection = self._connections.get(thread)
+        if connection is not None and not (connection.closed or connection.invalidated):
+            return connection
+        for owner in list(self._connections):
+            if owner is thread or not owner.is_alive() and owner not in self._in_use:
+                self._connections.pop(owner).close()
+        connection = self.engine.connect()
+        self._connections[thread] = connection
+        return connection
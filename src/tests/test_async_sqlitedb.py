@@ -0,0 +1,82 @@
+import asyncio
+import os.path
+import sys
+import threading
+import time
+
+# add the parent directory of the current file to the system path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from templates.databases import AsyncSqliteDB
+
+
+class TestAsyncSqliteDB:
+    def test_crud(self, tmp_path):
+        async def scenario():
+            async with AsyncSqliteDB(str(tmp_path / "async.db")) as db:
+                await db.add_table(
+                    "users",
+                    [
+                        ("id", "INTEGER PRIMARY KEY"),
+                        ("name", "TEXT"),
+                        ("age", "INTEGER"),
+                    ],
+                )
+                await db.insert("users", (1, "Alice", 20))
+                inserted = await db.insert_many(
+                    "users", [(2, "Bob", 25), (3, "Charlie", 30)]
+                )
+                assert inserted == 2
+                await db.update("users", "age = 26", "name = 'Bob'")
+                await db.delete("users", "name = 'Charlie'")
+                return await db.select(
+                    "users",
+                    columns=["name", "age"],
+                    where_clause="age > :age",
+                    params={"age": 0},
+                )
+
+        assert asyncio.run(scenario()) == [("Alice", 20), ("Bob", 26)]
+
+    def test_concurrent_writes_and_reads(self, tmp_path):
+        async def scenario():
+            async with AsyncSqliteDB(str(tmp_path / "async.db"), readers=2) as db:
+                await db.add_table(
+                    "sensor_data", [("id", "INTEGER"), ("data", "FLOAT")]
+                )
+                writes = [db.insert("sensor_data", (i, i * 0.1)) for i in range(50)]
+                reads = [
+                    db.select("sensor_data", columns=["COUNT(*)"]) for _ in range(10)
+                ]
+                await asyncio.gather(*writes, *reads)
+                return await db.select("sensor_data", columns=["COUNT(*)"])
+
+        assert asyncio.run(scenario()) == [(50,)]
+
+    def test_in_flight_limit(self, tmp_path):
+        active = {"now": 0, "max": 0}
+        lock = threading.Lock()
+
+        async def scenario():
+            async with AsyncSqliteDB(
+                str(tmp_path / "async.db"), readers=8, max_in_flight=3
+            ) as db:
+                original_select = db.db.select
+
+                def slow_select(*args, **kwargs):
+                    with lock:
+                        active["now"] += 1
+                        active["max"] = max(active["max"], active["now"])
+                    time.sleep(0.05)
+                    with lock:
+                        active["now"] -= 1
+                    return original_select(*args, **kwargs)
+
+                db.db.select = slow_select
+                await db.add_table("items", [("id", "INTEGER")])
+                await asyncio.gather(*[db.select("items") for _ in range(12)])
+
+        asyncio.run(scenario())
+        assert active["max"] == 3
@@ -0,0 +1,466 @@
+import pytest
+import os.path
+import sys
+import logging
+import threading
+import time
+import warnings
+
+# add the parent directory of the current file to the system path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from sqlalchemy import Column, Float, ForeignKey, Integer, String, exc, text
+from sqlalchemy.orm import joinedload, relationship
+
+from templates.databases import DBHandler, QueryCache
+from templates.databases.db_interaction import Base
+
+
+class Reading(Base):
+    __tablename__ = "readings"
+    id = Column(Integer, primary_key=True)
+    sensor = Column("sensor_name", String)
+    value = Column(Float, default=0.0)
+
+
+class Device(Base):
+    __tablename__ = "devices"
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    measurements = relationship("Measurement")
+
+
+class Measurement(Base):
+    __tablename__ = "measurements"
+    id = Column(Integer, primary_key=True)
+    device_id = Column(Integer, ForeignKey("devices.id"))
+    value = Column(Float)
+
+
+class Sample(Base):
+    __tablename__ = "samples"
+    sensor = Column(String, primary_key=True)
+    seq = Column(Integer, primary_key=True)
+    value = Column(Float)
+
+
+@pytest.fixture
+def db(tmp_path):
+    handler = DBHandler(f"sqlite:///{tmp_path / 'handler.db'}")
+    handler.add_model(Reading)
+    yield handler
+    handler.engine.dispose()
+
+
+class TestDBHandler:
+    def test_insert_and_select(self, db):
+        db.insert(Reading(sensor="a", value=1.0))
+        db.insert_many([Reading(sensor="b", value=2.0), Reading(sensor="c", value=3.0)])
+        result = db.select(Reading, Reading.value > 1.5, order_by=Reading.value)
+        assert [reading.sensor for reading in result] == ["b", "c"]
+
+    def test_bulk_insert_instances_and_dicts(self, db):
+        instances = (Reading(sensor=f"s{i}", value=float(i)) for i in range(25))
+        assert db.insert_many(instances, bulk=True, chunk_size=10) == 25
+        rows = [
+            {"sensor": "dict", "value": 1.5},
+            {"sensor": "dict"},
+            {"sensor": "dict", "value": 2.5},
+        ]
+        assert db.insert_many(rows, bulk=True, model=Reading) == 3
+        result = db.select(Reading, Reading.sensor == "dict", order_by=Reading.id)
+        # 列のデフォルト値も適用される
+        assert [reading.value for reading in result] == [1.5, 0.0, 2.5]
+        assert len(db.select(Reading)) == 28
+
+    def test_bulk_insert_return_defaults(self, db):
+        instances = [Reading(sensor="pk", value=float(i)) for i in range(3)]
+        db.insert_many(instances, bulk=True, return_defaults=True)
+        assert [instance.id for instance in instances] == [1, 2, 3]
+
+    def test_bulk_insert_dicts_requires_model(self, db):
+        with pytest.raises(ValueError):
+            db.insert_many([{"sensor": "x"}], bulk=True)
+
+    def test_select_columns_as_rows_and_dicts(self, db):
+        db.insert_many(
+            [{"sensor": "a", "value": 1.0}, {"sensor": "b", "value": 2.0}],
+            bulk=True,
+            model=Reading,
+        )
+        rows = db.select(
+            Reading,
+            Reading.value > 0,
+            order_by=Reading.value,
+            columns=[Reading.sensor, "value"],
+        )
+        assert [tuple(row) for row in rows] == [("a", 1.0), ("b", 2.0)]
+        assert rows[1].sensor == "b"
+        dicts = db.select(
+            Reading,
+            columns=["sensor"],
+            order_by=Reading.sensor.desc(),
+            limit=1,
+            as_dict=True,
+        )
+        assert dicts == [{"sensor": "b"}]
+
+    def test_paginate_keyset(self, db):
+        # 重複した値を含む列でも、全てのインスタンスを1回ずつ返す
+        rows = [{"sensor": f"s{i}", "value": float(i // 3)} for i in range(20)]
+        db.insert_many(rows, bulk=True, model=Reading)
+        pages = list(db.paginate(Reading, Reading.value, page_size=7))
+        assert [len(page) for page in pages] == [7, 7, 6]
+        ids = [reading.id for page in pages for reading in page]
+        assert sorted(ids) == list(range(1, 21))
+        values = [reading.value for page in pages for reading in page]
+        assert values == sorted(values)
+
+        pages = list(
+            db.paginate(
+                Reading,
+                "id",
+                page_size=5,
+                conditions=Reading.value >= 3,
+                descending=True,
+            )
+        )
+        assert [reading.id for page in pages for reading in page] == list(
+            range(20, 9, -1)
+        )
+
+    def test_paginate_keyset_with_nulls(self, db):
+        # ページの区切りがNULLの値の途中になる場合も、全てのインスタンスを1回ずつ返す
+        rows = [
+            {"sensor": f"s{i}", "value": None if i % 2 else float(i)} for i in range(12)
+        ]
+        db.insert_many(rows, bulk=True, model=Reading)
+        for descending in (False, True):
+            pages = list(
+                db.paginate(Reading, Reading.value, page_size=4, descending=descending)
+            )
+            readings = [reading for page in pages for reading in page]
+            assert sorted(reading.id for reading in readings) == list(range(1, 13))
+            values = [reading.value for reading in readings]
+            expected = [None] * 6 + [float(i) for i in range(0, 12, 2)]
+            assert values == (expected[::-1] if descending else expected)
+
+    def test_paginate_keyset_with_composite_primary_key(self, db):
+        # 複合主キーの全ての列を後続のキーに使い、重複した値の途中で区切っても取りこぼさない
+        db.add_model(Sample)
+        rows = [
+            {"sensor": sensor, "seq": seq, "value": float(seq % 2)}
+            for sensor in ("a", "b")
+            for seq in range(5)
+        ]
+        db.insert_many(rows, bulk=True, model=Sample)
+        for descending in (False, True):
+            pages = list(
+                db.paginate(Sample, "value", page_size=3, descending=descending)
+            )
+            keys = [
+                (sample.value, sample.sensor, sample.seq)
+                for page in pages
+                for sample in page
+            ]
+            expected = sorted((row["value"], row["sensor"], row["seq"]) for row in rows)
+            assert keys == (expected[::-1] if descending else expected)
+
+    def test_select_cache_hits_and_invalidation(self, tmp_path):
+        db = DBHandler(f"sqlite:///{tmp_path / 'cached.db'}", cache_size=2)
+        db.add_model(Reading)
+        db.insert(Reading(sensor="a", value=1.0))
+        assert len(db.select(Reading, Reading.value > 0)) == 1
+        assert len(db.select(Reading, Reading.value > 0)) == 1
+        assert db.cache_stats["hits"] == 1 and db.cache_stats["misses"] == 1
+
+        # 書き込みのコミット後は、そのテーブルのエントリが削除される
+        db.insert_many([{"sensor": "b", "value": 2.0}], bulk=True, model=Reading)
+        assert len(db.select(Reading, Reading.value > 0)) == 2
+        db.update(Reading, Reading.sensor == "a", {"value": 0.0})
+        assert [
+            row.sensor
+            for row in db.select(Reading, Reading.value > 0, columns=["sensor"])
+        ] == ["b"]
+        with db.custom_transaction() as session:
+            db.delete(Reading, Reading.sensor == "b", session)
+        assert db.select(Reading, Reading.value > 0, columns=["sensor"]) == []
+        assert db.cache_stats["invalidations"] == 3
+
+        # 最も長く使われていないエントリから削除される
+        db.select(Reading, Reading.sensor == "x")
+        db.select(Reading, Reading.sensor == "y")
+        assert db.cache_stats["evictions"] == 1 and db.cache_stats["size"] == 2
+        db.engine.dispose()
+
+    def test_select_cache_returns_copies(self, tmp_path):
+        db = DBHandler(f"sqlite:///{tmp_path / 'cached.db'}", cache_size=4)
+        db.add_model(Device)
+        with db.get_session() as session:
+            session.add(
+                Device(
+                    name="d0",
+                    measurements=[Measurement(value=1.0), Measurement(value=2.0)],
+                )
+            )
+
+        # 呼び出し元がインスタンスや辞書を変更しても、以降のキャッシュのヒットには影響しない
+        devices = db.select(Device, options=["measurements"])
+        devices[0].name = "changed"
+        devices[0].measurements[0].value = -1.0
+        devices[0].measurements.append(Measurement(value=3.0))
+        cached = db.select(Device, options=["measurements"])
+        assert db.cache_stats["hits"] == 1
+        assert cached[0] is not devices[0] and cached[0].id == devices[0].id
+        assert cached[0].name == "d0"
+        assert [m.value for m in cached[0].measurements] == [1.0, 2.0]
+
+        rows = db.select(Device, columns=["name"], as_dict=True)
+        rows[0]["name"] = "changed"
+        assert db.select(Device, columns=["name"], as_dict=True) == [{"name": "d0"}]
+        db.engine.dispose()
+
+    def test_select_cache_skips_loader_option_objects(self, tmp_path):
+        db = DBHandler(f"sqlite:///{tmp_path / 'cached.db'}", cache_size=4)
+        db.add_model(Device)
+        with db.get_session() as session:
+            session.add(Device(name="d0", measurements=[Measurement(value=1.0)]))
+
+        # 属性名で指定したoptionsはキャッシュし、ローダーオプションのオブジェクトはキャッシュしない
+        db.select(Device, options=[Device.measurements])
+        db.select(Device, options=["measurements"])
+        assert db.cache_stats["hits"] == 1
+        for _ in range(2):
+            devices = db.select(Device, options=[joinedload(Device.measurements)])
+            assert [m.value for m in devices[0].measurements] == [1.0]
+        assert db.cache_stats["hits"] == 1 and db.cache_stats["size"] == 1
+        db.engine.dispose()
+
+    def test_query_cache_ttl(self, monkeypatch):
+        cache = QueryCache(max_entries=4, ttl=10)
+        now = [100.0]
+        monkeypatch.setattr(
+            "templates.databases.query_cache.time.monotonic", lambda: now[0]
+        )
+        cache.put("key", ["readings"], [1], cache.generation)
+        assert cache.get("key") == (True, [1])
+        now[0] += 10
+        assert cache.get("key") == (False, None)
+        # 取得中に無効化された結果は保存しない
+        generation = cache.generation
+        cache.invalidate(["other"])
+        cache.put("key", ["readings"], [2], generation)
+        assert cache.stats["expirations"] == 1 and cache.stats["size"] == 0
+
+    def test_update_many_and_delete_many(self, db):
+        db.insert_many(
+            [{"sensor": f"s{i}", "value": 0.0} for i in range(10)],
+            bulk=True,
+            model=Reading,
+        )
+        mappings = [{"id": i, "value": float(i)} for i in range(1, 6)]
+        mappings.append({"id": 6, "sensor": "renamed", "value": 6.0})
+        # 存在しない主キーは更新数に含まれない
+        mappings.append({"id": 99, "value": 1.0})
+        assert db.update_many(Reading, mappings, chunk_size=3) == 6
+        rows = db.select(
+            Reading, Reading.id <= 6, order_by=Reading.id, columns=["sensor", "value"]
+        )
+        assert [row.value for row in rows] == [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]
+        assert rows[5].sensor == "renamed"
+
+        with pytest.raises(ValueError):
+            db.update_many(Reading, [{"value": 1.0}])
+        # 主キーだけの辞書は、更新されずに読み飛ばされないようにエラーにする
+        with pytest.raises(ValueError):
+            db.update_many(Reading, [{"id": 1, "value": 7.0}, {"id": 2}])
+        assert db.select(Reading, Reading.id == 1)[0].value == 1.0
+
+        assert db.delete_many(Reading, range(1, 9), chunk_size=3) == 8
+        assert db.delete_many(Reading, [1, 2]) == 0
+        assert [reading.id for reading in db.select(Reading)] == [9, 10]
+
+    def test_select_loader_options_and_n_plus_one_warning(self, tmp_path):
+        db = DBHandler(
+            f"sqlite:///{tmp_path / 'related.db'}", debug=True, n_plus_one_threshold=3
+        )
+        db.add_model(Device)
+        # 同じINSERT文が繰り返されても、N+1パターンとして警告しない
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", RuntimeWarning)
+            with db.get_session() as session:
+                for i in range(4):
+                    session.add(
+                        Device(
+                            name=f"d{i}",
+                            measurements=[
+                                Measurement(value=float(j)) for j in range(2)
+                            ],
+                        )
+                    )
+        assert db.last_statement_count > 0
+
+        # セッションの外でも、一緒に読み込んだ関連を参照できる
+        for options, loader in (
+            ([Device.measurements], "selectin"),
+            (["measurements"], "joined"),
+        ):
+            devices = db.select(
+                Device, order_by=Device.id, options=options, loader=loader
+            )
+            assert [len(device.measurements) for device in devices] == [2, 2, 2, 2]
+            assert db.last_statement_count == (2 if loader == "selectin" else 1)
+
+        with pytest.warns(RuntimeWarning, match="N\\+1"):
+            with db.get_session() as session:
+                devices = db.select(Device, session=session)
+                assert sum(len(device.measurements) for device in devices) == 8
+        assert db.last_statement_count == 5
+
+        with pytest.raises(ValueError):
+            db.select(Device, options=["measurements"], loader="lazy")
+        db.engine.dispose()
+
+    def test_pool_options_and_contention_on_sqlite_file(self, tmp_path):
+        db = DBHandler(
+            f"sqlite:///{tmp_path / 'pool.db'}",
+            pool_size=1,
+            max_overflow=0,
+            pool_timeout=0.2,
+            pool_pre_ping=True,
+        )
+        db.add_model(Reading)
+        released = threading.Event()
+
+        def hold_connection():
+            with db.get_session() as session:
+                session.execute(text("SELECT 1"))
+                released.wait()
+
+        holder = threading.Thread(target=hold_connection)
+        holder.start()
+        while db.pool_stats["checked_out"] == 0:
+            time.sleep(0.01)
+        # 空き接続がなく、pool_timeoutを過ぎるとTimeoutErrorになる
+        with pytest.raises(exc.TimeoutError):
+            db.select(Reading)
+        released.set()
+        holder.join()
+
+        db.insert(Reading(sensor="a", value=1.0))
+        stats = db.pool_stats
+        assert stats["pool"] == "QueuePool" and stats["pool_size"] == 1
+        assert stats["connects"] == 1 and stats["max_checked_out"] == 1
+        assert stats["waits"] == 1 and stats["timeouts"] == 1
+        db.engine.dispose()
+
+    def test_pool_contention_against_in_process_server(self):
+        # 共有キャッシュのインメモリデータベースを、複数の接続から使うサーバーの代わりにする
+        db = DBHandler(
+            "sqlite:///file:pool_standin?mode=memory&cache=shared&uri=true",
+            pool_size=2,
+            max_overflow=1,
+        )
+        db.add_model(Reading)
+        db.insert_many(
+            [{"sensor": "s", "value": float(i)} for i in range(10)],
+            bulk=True,
+            model=Reading,
+        )
+        barrier = threading.Barrier(6)
+        results = []
+
+        def read():
+            barrier.wait()
+            with db.get_session() as session:
+                results.append(session.query(Reading).count())
+                time.sleep(0.1)
+
+        threads = [threading.Thread(target=read) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = db.pool_stats
+        assert results == [10] * 6
+        # 同時に貸し出される接続はpool_size + max_overflowまでで、残りは空きを待つ
+        assert stats["max_checked_out"] == 3 and stats["waits"] >= 3
+        assert stats["checked_out"] == 0
+        db.engine.dispose()
+
+    def test_statement_timeout_on_sqlite(self, tmp_path):
+        db = DBHandler(f"sqlite:///{tmp_path / 'timeout.db'}", statement_timeout=0.05)
+        slow = text(
+            "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) "
+            "SELECT count(*) FROM n"
+        )
+        with pytest.raises(exc.OperationalError):
+            with db.get_session() as session:
+                session.execute(slow)
+        # 最初の行はすぐに返るが、残りの行を探す走査が続くSQL文も中断する
+        scan = text(
+            "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) "
+            "SELECT i FROM n WHERE i = 1 OR i > 20000000 LIMIT 2"
+        )
+        start = time.monotonic()
+        with pytest.raises(exc.OperationalError):
+            with db.get_session() as session:
+                session.execute(scan).fetchall()
+        assert time.monotonic() - start < 2
+        # 中断された後の接続でも、通常のSQL文は実行できる
+        with db.get_session() as session:
+            assert session.execute(text("SELECT 1")).scalar() == 1
+            # 前のSQL文の計測が残らず、時間をおいた後のSQL文やコミットも中断されない
+            time.sleep(0.1)
+            assert session.execute(text("SELECT 2")).scalar() == 2
+            time.sleep(0.1)
+        db.engine.dispose()
+
+    def test_insert_batch_isolates_rejects(self, db):
+        db.insert(Reading(id=5, sensor="existing", value=0.0))
+        rows = [{"id": i, "sensor": f"s{i}", "value": float(i)} for i in range(1, 21)]
+        # 既存の主キーと、バッチ内で重複する主キー
+        rows.insert(10, {"id": 8, "sensor": "duplicate", "value": 0.0})
+        rejects = db.insert_batch(rows, model=Reading, batch_size=8)
+        assert sorted(row["id"] for row, _ in rejects) == [5, 8]
+        assert all(isinstance(error, exc.IntegrityError) for _, error in rejects)
+        ids = [
+            row.id for row in db.select(Reading, order_by=Reading.id, columns=["id"])
+        ]
+        assert ids == list(range(1, 21))
+        assert db.select(Reading, Reading.id == 8)[0].sensor == "s8"
+
+    def test_query_stats_and_slow_query_log(self, db, caplog):
+        logger = logging.getLogger("test_query_stats")
+        query_stats = db.enable_query_stats(logger=logger, slow_threshold=0.0)
+        db.insert_many(
+            [{"sensor": f"s{i}", "value": float(i)} for i in range(5)],
+            bulk=True,
+            model=Reading,
+        )
+        with caplog.at_level(logging.WARNING, logger="test_query_stats"):
+            assert len(db.select(Reading, Reading.value >= 2)) == 3
+        assert "遅いSQL文" in caplog.text
+
+        templates = query_stats.snapshot()["templates"]
+        insert = next(
+            stats
+            for template, stats in templates.items()
+            if template.startswith("INSERT")
+        )
+        select = next(
+            stats
+            for template, stats in templates.items()
+            if template.startswith("SELECT")
+        )
+        assert insert["rows"] == 5
+        assert select["count"] == 1 and select["rows"] == 3
+        assert sum(select["histogram"].values()) == 1
+        assert select["threads"] == {threading.current_thread().name: 1}
+
+        # 無効にした後は集計されない
+        assert db.disable_query_stats() is query_stats
+        db.select(Reading)
+        assert query_stats.snapshot()["templates"] == templates
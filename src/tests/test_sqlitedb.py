@@ -1,12 +1,20 @@
 import pytest
+import gzip
+import json
 import os.path
+import sqlite3
 import sys
+import threading
+import time
+from datetime import datetime, timedelta
 
 # add the parent directory of the current file to the system path
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.append(parent_dir)
 
+from sqlalchemy import event, exc, text
+
 from templates.databases import SqliteDB
 
 DB_FILE = "test.db"
@@ -24,6 +32,13 @@ def test_db():
     os.remove(DB_FILE)
 
 
+@pytest.fixture
+def db(tmp_path):
+    db = SqliteDB(str(tmp_path / "test.db"))
+    yield db
+    db.engine.dispose()
+
+
 class TestSqliteDB:
     def test_add_table(self, test_db):
         columns = [("id", "INTEGER PRIMARY KEY"), ("name", "TEXT"), ("age", "INTEGER")]
@@ -94,3 +109,712 @@ class TestSqliteDB:
             ("Alice", "Pride and Prejudice"),
             ("Bob", "To Kill a Mockingbird"),
         ]
+
+    def test_insert_many_generator_in_chunks(self, db):
+        db.add_table("readings", [("id", "INTEGER PRIMARY KEY"), ("note", "TEXT")])
+        rows = ((i, f'it\'s "row" {i}') for i in range(1, 2501))
+        inserted = db.insert_many("readings", rows, chunk_size=1000)
+        assert inserted == 2500
+        result = db.select("readings", columns=["COUNT(*)"])
+        assert result == [(2500,)]
+        result = db.select("readings", columns=["note"], where_clause="id = 42")
+        assert result == [('it\'s "row" 42',)]
+
+    def test_insert_many_rolls_back_on_error(self, db):
+        db.add_table("readings", [("id", "INTEGER PRIMARY KEY"), ("note", "TEXT")])
+        rows = [(3001, "ok"), (3001, "duplicate")]
+        with pytest.raises(Exception):
+            db.insert_many("readings", rows)
+        result = db.select("readings", columns=["COUNT(*)"], where_clause="id = 3001")
+        assert result == [(0,)]
+
+    def test_buffered_writer_flushes_on_row_threshold(self, db):
+        db.add_table("buffered", [("id", "INTEGER"), ("value", "FLOAT")])
+        with db.buffered_writer(max_rows=10, max_delay=60) as writer:
+            for i in range(9):
+                writer.insert("buffered", (i, i * 0.5))
+            assert db.select("buffered", columns=["COUNT(*)"]) == [(0,)]
+            writer.insert("buffered", (9, 4.5))
+            assert db.select("buffered", columns=["COUNT(*)"]) == [(10,)]
+            writer.insert("buffered", (10, 5.0))
+        # close()で残りのレコードも書き込まれる
+        assert db.select("buffered", columns=["COUNT(*)"]) == [(11,)]
+        stats = writer.stats
+        assert stats["flushes"] == 2
+        assert stats["rows"] == 11
+        assert stats["max_batch_size"] == 10
+        assert stats["last_batch_size"] == 1
+        assert stats["pending"] == 0
+
+    def test_buffered_writer_rejects_bad_rows(self, tmp_path):
+        db = SqliteDB(str(tmp_path / "buffered.db"), pragmas={"busy_timeout": 0})
+        db.add_table("buffered", [("id", "INTEGER UNIQUE"), ("value", "FLOAT")])
+        writer = db.buffered_writer(max_rows=10, max_delay=60)
+        try:
+            for i in range(8):
+                writer.insert("buffered", (i, i * 0.5))
+            writer.insert("buffered", (100, 1.0, "extra"))  # 列数の誤り
+            writer.insert("buffered", (3, 1.5))  # ユニーク制約違反
+            # 原因のレコードだけを取り除き、例外を送出せずに残りを書き込む
+            assert db.select("buffered", columns=["COUNT(*)"]) == [(8,)]
+            assert [values for _, values, _ in writer.rejected] == [
+                (100, 1.0, "extra"),
+                (3, 1.5),
+            ]
+            assert writer.stats["rejected"] == 2 and writer.stats["pending"] == 0
+
+            # ロックで書き込めない場合は、レコードをバッファに戻して再試行する
+            blocker = sqlite3.connect(str(tmp_path / "buffered.db"))
+            blocker.execute("BEGIN IMMEDIATE")
+            writer.insert("buffered", (8, 4.0))
+            with pytest.raises(exc.OperationalError):
+                writer.flush()
+            assert writer.stats["pending"] == 1
+            blocker.rollback()
+            blocker.close()
+            assert writer.flush() == 1
+            assert db.select("buffered", columns=["COUNT(*)"]) == [(9,)]
+        finally:
+            writer.close()
+            db.engine.dispose()
+
+    def test_buffered_writer_rejects_rows_for_unknown_table(self, tmp_path):
+        db = SqliteDB(str(tmp_path / "buffered.db"))
+        db.add_table("buffered", [("id", "INTEGER"), ("value", "FLOAT")])
+        writer = db.buffered_writer(max_rows=10, max_delay=60)
+        try:
+            writer.insert("buffered", (1, 0.5))
+            writer.insert("typo", (2, 1.0))  # 存在しないテーブル
+            writer.insert("buffered", (3, 1.5))
+            # ロック以外のOperationalErrorは再試行せず、原因のレコードだけを取り除く
+            assert writer.flush() == 2
+            assert db.select("buffered", columns=["id"]) == [(1,), (3,)]
+            rejected = [(table, values) for table, values, _ in writer.rejected]
+            assert rejected == [("typo", (2, 1.0))]
+            assert writer.stats["pending"] == 0
+        finally:
+            writer.close()
+            db.engine.dispose()
+
+    def test_buffered_writer_flushes_on_time_threshold(self, db):
+        db.add_table("buffered_time", [("id", "INTEGER"), ("value", "FLOAT")])
+        writer = db.buffered_writer(max_rows=1000, max_delay=0.1)
+        try:
+            writer.insert("buffered_time", (1, 1.0))
+            writer.insert("buffered_time", (2, 2.0))
+            deadline = time.monotonic() + 5
+            while writer.stats["rows"] < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert db.select("buffered_time", columns=["COUNT(*)"]) == [(2,)]
+        finally:
+            writer.close()
+        with pytest.raises(RuntimeError):
+            writer.insert("buffered_time", (3, 3.0))
+
+    def test_profile_pragmas_applied(self, tmp_path):
+        db = SqliteDB(
+            str(tmp_path / "profile.db"),
+            profile="throughput",
+            pragmas={"busy_timeout": 1234},
+        )
+        with db.get_session() as session:
+            assert session.execute("PRAGMA journal_mode").scalar() == "wal"
+            assert session.execute("PRAGMA synchronous").scalar() == 1  # NORMAL
+            assert session.execute("PRAGMA temp_store").scalar() == 2  # MEMORY
+            assert session.execute("PRAGMA busy_timeout").scalar() == 1234
+        # プロファイルを指定した場合は接続を保持し、セッションごとにPRAGMAを適用し直さない
+        db.add_table("items", [("id", "INTEGER")])
+        for i in range(20):
+            db.insert("items", (i,))
+        stats = db.pool_stats
+        assert stats["pool"] == "QueuePool" and stats["connects"] == 1
+        db.engine.dispose()
+
+    def test_invalid_profile(self, tmp_path):
+        with pytest.raises(ValueError):
+            SqliteDB(str(tmp_path / "profile.db"), profile="unknown")
+
+    def test_select_with_params_reuses_statement(self, db):
+        db.add_table(
+            "users",
+            [("id", "INTEGER PRIMARY KEY"), ("name", "TEXT"), ("age", "INTEGER")],
+        )
+        db.insert_many("users", [(1, "Alice", 20), (2, "Bob", 25)])
+        before = db.query_cache_info()
+        for name in ["Alice", "Bob", "Alice"]:
+            result = db.select(
+                "users",
+                columns=["name"],
+                where_clause="name = :name",
+                params={"name": name},
+            )
+            assert result == [(name,)]
+        after = db.query_cache_info()
+        assert after.misses - before.misses <= 1
+        assert after.hits - before.hits >= 2
+
+    def test_select_iter(self, tmp_path):
+        db = SqliteDB(str(tmp_path / "iter.db"))
+        db.add_table("readings", [("id", "INTEGER PRIMARY KEY"), ("note", "TEXT")])
+        db.insert_many("readings", ((i, f"row {i}") for i in range(1, 3001)))
+        rows = db.select_iter(
+            "readings",
+            columns=["id"],
+            where_clause="id <= :max_id",
+            params={"max_id": 2500},
+            order_by="id",
+            fetch_size=300,
+        )
+        assert [row[0] for row in rows] == list(range(1, 2501))
+        db.engine.dispose()
+
+    def test_select_iter_early_stop_releases_session(self, tmp_path):
+        db = SqliteDB(str(tmp_path / "iter.db"))
+        db.add_table("readings", [("id", "INTEGER PRIMARY KEY"), ("note", "TEXT")])
+        db.insert_many("readings", ((i, f"row {i}") for i in range(1, 101)))
+        rows = db.select_iter("readings", columns=["id"], order_by="id", fetch_size=10)
+        assert [next(rows)[0] for _ in range(3)] == [1, 2, 3]
+        rows.close()
+        # セッションが解放され、書き込みがブロックされないこと
+        db.insert("readings", (5000, "after stream"))
+        assert db.select("readings", columns=["note"], where_clause="id = 5000") == [
+            ("after stream",)
+        ]
+        db.engine.dispose()
+
+    def test_select_numpy(self, db):
+        np = pytest.importorskip("numpy")
+        db.add_table(
+            "sensor_data",
+            [("timestamp", "DATETIME"), ("data", "FLOAT"), ("count", "INTEGER")],
+        )
+        db.insert_many(
+            "sensor_data",
+            ((f"2023-01-01 00:00:{i:02d}", i * 0.5, i) for i in range(25)),
+        )
+        result = db.select_numpy("sensor_data", order_by="timestamp", fetch_size=10)
+        assert result["data"].dtype == np.float64
+        assert result["count"].dtype == np.int64
+        assert result["timestamp"].dtype == object
+        np.testing.assert_array_equal(result["count"], np.arange(25))
+        np.testing.assert_allclose(result["data"], np.arange(25) * 0.5)
+
+        array = db.select_numpy(
+            "sensor_data",
+            columns=["count", "data"],
+            where_clause="count >= :low",
+            params={"low": 20},
+            dtypes={"count": "i4"},
+            structured=True,
+        )
+        assert array.dtype.names == ("count", "data")
+        assert array["count"].dtype == np.int32
+        assert array["count"].tolist() == [20, 21, 22, 23, 24]
+
+        empty = db.select_numpy(
+            "sensor_data", columns=["data"], where_clause="count < 0"
+        )
+        assert empty["data"].shape == (0,)
+
+    def test_add_table_with_indexes(self, db):
+        db.add_table(
+            "events",
+            [
+                ("id", "INTEGER PRIMARY KEY"),
+                ("sensor_id", "INTEGER"),
+                ("timestamp", "DATETIME"),
+                ("data", "FLOAT"),
+            ],
+            indexes=[
+                "timestamp",
+                ["sensor_id", "timestamp DESC"],
+                {
+                    "columns": ["sensor_id", "timestamp"],
+                    "unique": True,
+                    "name": "uq_events",
+                    "where": "data IS NOT NULL",
+                },
+            ],
+        )
+        assert db.indexes["events"] == [
+            "idx_events_timestamp",
+            "idx_events_sensor_id_timestamp",
+            "uq_events",
+        ]
+        result = db.select(
+            "sqlite_master",
+            columns=["name"],
+            where_clause="type = 'index' AND tbl_name = 'events'",
+            order_by="name",
+        )
+        assert result == [
+            ("idx_events_sensor_id_timestamp",),
+            ("idx_events_timestamp",),
+            ("uq_events",),
+        ]
+
+    def test_check_index_coverage(self, tmp_path):
+        db = SqliteDB(str(tmp_path / "coverage.db"))
+        db.add_table(
+            "events",
+            [
+                ("id", "INTEGER PRIMARY KEY"),
+                ("sensor_id", "INTEGER"),
+                ("timestamp", "DATETIME"),
+                ("data", "FLOAT"),
+            ],
+            indexes=["timestamp"],
+        )
+        db.register_query(
+            "by_time",
+            "events",
+            columns=["timestamp", "data"],
+            where_clause="timestamp > :since",
+            order_by="timestamp",
+            limit=5,
+        )
+        db.register_query(
+            "by_data", "events", columns=["id"], where_clause="data + 0 > :value"
+        )
+        db.register_query("sorted_by_data", "events", order_by="data")
+        report = db.check_index_coverage()
+        assert "by_time" not in report
+        assert any(detail.startswith("SCAN") for detail in report["by_data"])
+        assert any(
+            detail.startswith("USE TEMP B-TREE") for detail in report["sorted_by_data"]
+        )
+        db.engine.dispose()
+
+    def test_partitioned_table(self, db):
+        db.add_partitioned_table(
+            "metrics",
+            [("timestamp", "DATETIME"), ("data", "FLOAT")],
+            indexes=["timestamp"],
+        )
+        rows = [
+            (f"2023-01-{day:02d} {hour:02d}:00:00", day + hour / 100)
+            for day in (1, 2, 3)
+            for hour in (0, 12)
+        ]
+        db.insert_many("metrics", rows)
+        db.insert("metrics", (datetime(2023, 1, 4, 6), 4.06))
+        assert db.partitions("metrics") == [
+            "metrics_20230101",
+            "metrics_20230102",
+            "metrics_20230103",
+            "metrics_20230104",
+        ]
+
+        result = db.select_range(
+            "metrics",
+            start="2023-01-02 06:00:00",
+            end=datetime(2023, 1, 4),
+            columns=["timestamp", "data"],
+            order_by="timestamp",
+        )
+        assert result == [
+            ("2023-01-02 12:00:00", 2.12),
+            ("2023-01-03 00:00:00", 3.0),
+            ("2023-01-03 12:00:00", 3.12),
+        ]
+        result = db.select_range(
+            "metrics",
+            start="2023-01-01",
+            columns=["data"],
+            where_clause="data > :low",
+            params={"low": 3.1},
+            order_by="data",
+        )
+        assert result == [(3.12,), (4.06,)]
+
+        assert db.drop_partitions("metrics", before="2023-01-03 00:00:00") == [
+            "metrics_20230101",
+            "metrics_20230102",
+        ]
+        assert db.partitions("metrics") == ["metrics_20230103", "metrics_20230104"]
+        assert db.select_range("metrics", end="2023-01-03") == []
+
+        # 開き直したデータベースでも既存のパーティションを認識する
+        reopened = SqliteDB(db.db_file)
+        reopened.add_partitioned_table(
+            "metrics", [("timestamp", "DATETIME"), ("data", "FLOAT")]
+        )
+        assert reopened.partitions("metrics") == [
+            "metrics_20230103",
+            "metrics_20230104",
+        ]
+        reopened.engine.dispose()
+
+    def test_thread_pool_reuses_connection_per_thread(self, tmp_path):
+        db = SqliteDB(str(tmp_path / "pool.db"), pool="thread")
+        db.add_table("items", [("id", "INTEGER")])
+        for i in range(5):
+            db.insert("items", (i,))
+        worker = threading.Thread(target=db.select, args=("items",))
+        worker.start()
+        worker.join()
+        stats = db.pool_stats
+        # 接続はスレッドごとに1回だけ貸し出され、同じスレッドのセッションで再利用される
+        assert stats["connects"] == 2
+        assert stats["checkouts"] == 2
+        assert stats["waits"] == 0
+        db.engine.dispose()
+
+    def test_thread_pool_nested_sessions_use_separate_connections(self, tmp_path):
+        db = SqliteDB(str(tmp_path / "pool.db"), pool="thread")
+        db.add_table("items", [("id", "INTEGER")])
+        with db.get_session() as outer:
+            outer.execute(text("INSERT INTO items VALUES (1)"))
+            with pytest.raises(RuntimeError):
+                with db.get_session() as inner:
+                    inner_connection = inner.connection().connection
+                    assert inner_connection is not outer.connection().connection
+                    raise RuntimeError("inner")
+        # 内側のロールバックは外側のトランザクションに影響しない
+        assert db.select("items") == [(1,)]
+        db.engine.dispose()
+
+    def test_thread_pool_keeps_connections_in_use(self, tmp_path):
+        db = SqliteDB(str(tmp_path / "pool.db"), pool="thread", pool_size=2)
+        db.add_table("items", [("id", "INTEGER")])
+        db.insert_many("items", [(i,) for i in range(100)])
+        rows = db.select_iter("items", columns=["id"], order_by="id", fetch_size=10)
+        assert next(rows) == (0,)
+        # pool_sizeを超えるスレッドが接続しても、使用中の接続は閉じられない
+        for _ in range(4):
+            worker = threading.Thread(target=db.select, args=("items",))
+            worker.start()
+            worker.join()
+        assert [row[0] for row in rows] == list(range(1, 100))
+        # 終了したスレッドの接続は次のスレッドに引き継がれる
+        connects = db.pool_stats["connects"]
+        worker = threading.Thread(target=db.select, args=("items",))
+        worker.start()
+        worker.join()
+        assert db.pool_stats["connects"] == connects
+        db.engine.dispose()
+
+    def test_queue_pool_records_waits(self, tmp_path):
+        db = SqliteDB(
+            str(tmp_path / "pool.db"), pool="queue", pool_size=1, max_overflow=0
+        )
+        db.add_table("items", [("id", "INTEGER")])
+        db.insert_many("items", [(i,) for i in range(10)])
+        rows = db.select_iter("items", fetch_size=1)
+        next(rows)  # 唯一の接続を使用中にする
+        worker = threading.Thread(target=db.select, args=("items",))
+        worker.start()
+        time.sleep(0.2)
+        assert db.pool_stats["checked_out"] == 1
+        rows.close()
+        worker.join()
+        stats = db.pool_stats
+        assert stats["pool"] == "QueuePool"
+        assert stats["waits"] == 1
+        assert stats["max_wait_time"] >= 0.1
+        assert stats["checked_out"] == 0
+        db.engine.dispose()
+
+    def test_invalid_pool(self, tmp_path):
+        with pytest.raises(ValueError):
+            SqliteDB(str(tmp_path / "pool.db"), pool="unknown")
+
+    def test_upsert_many(self, db):
+        db.add_table(
+            "replay",
+            [("timestamp", "TEXT"), ("data", "FLOAT")],
+            indexes=[{"columns": ["timestamp"], "unique": True}],
+        )
+        db.insert_many(
+            "replay", [("2023-01-01 00:00:00", 1.0), ("2023-01-01 00:00:01", 2.0)]
+        )
+        rows = [
+            ("2023-01-01 00:00:01", 20.0),
+            ("2023-01-01 00:00:02", 3.0),
+            ("2023-01-01 00:00:03", 4.0),
+            ("2023-01-01 00:00:03", 40.0),
+        ]
+        counts = db.upsert_many(
+            "replay", rows, conflict_columns="timestamp", chunk_size=3
+        )
+        assert counts == {"inserted": 2, "updated": 2, "skipped": 0}
+        assert db.select("replay", columns=["data"], order_by="timestamp") == [
+            (1.0,),
+            (20.0,),
+            (3.0,),
+            (40.0,),
+        ]
+
+        counts = db.upsert_many(
+            "replay",
+            [("2023-01-01 00:00:00", 99.0), ("2023-01-01 00:00:04", 5.0)],
+            conflict_columns=["timestamp"],
+            do_nothing=True,
+        )
+        assert counts == {"inserted": 1, "updated": 0, "skipped": 1}
+        assert db.select(
+            "replay", columns=["data"], where_clause="timestamp = '2023-01-01 00:00:00'"
+        ) == [(1.0,)]
+
+    def test_single_writer_coalesces_writes(self, tmp_path):
+        db = SqliteDB(str(tmp_path / "writer.db"))
+        db.add_table("items", [("id", "INTEGER PRIMARY KEY"), ("value", "TEXT")])
+        executor = db.start_single_writer(readers=2, max_batch=50)
+        try:
+            # 書き込みスレッドを待たせている間に書き込みをキューに溜める
+            gate = threading.Event()
+            blocker = executor.submit(gate.wait)
+            futures = [executor.insert("items", (i, f"v{i}")) for i in range(20)]
+            duplicate = executor.insert("items", (5, "duplicate"))
+            gate.set()
+            blocker.result()
+            for future in futures:
+                future.result()
+            with pytest.raises(Exception):
+                duplicate.result()
+            assert executor.select("items", columns=["COUNT(*)"]).result() == [(20,)]
+
+            # 複数のスレッドからの書き込みも書き込みスレッドで実行される
+            workers = [
+                threading.Thread(target=db.insert, args=("items", (100 + i, "thread")))
+                for i in range(5)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            db.update("items", "value = 'updated'", "id >= 100")
+            assert db.select(
+                "items", columns=["COUNT(*)"], where_clause="value = 'updated'"
+            ) == [(5,)]
+        finally:
+            db.stop_single_writer()
+        stats = executor.stats
+        assert stats["writes"] == 26
+        assert stats["retries"] == 1
+        assert db.executor is None
+
+    def test_single_writer_routes_all_writes(self, tmp_path):
+        db = SqliteDB(str(tmp_path / "writer.db"))
+        db.add_table("items", [("id", "INTEGER PRIMARY KEY"), ("value", "TEXT")])
+        executor = db.start_single_writer()
+        try:
+            db.upsert_many("items", [(1, "a"), (2, "b")], "id")
+            db.commit_changes("items", "sync", 2)
+            with db.buffered_writer(max_rows=10, max_delay=60) as writer:
+                writer.insert("items", (3, "c"))
+            assert executor.stats["writes"] == 3
+            assert db.select("items", columns=["COUNT(*)"]) == [(3,)]
+            assert db.change_offset("items", "sync") == 2
+        finally:
+            db.stop_single_writer()
+        db.engine.dispose()
+
+    def test_reflect_schema_on_reopen(self, tmp_path):
+        db_file = str(tmp_path / "reflect.db")
+        db = SqliteDB(db_file)
+        db.add_table(
+            "users",
+            [("id", "INTEGER PRIMARY KEY"), ("name", "TEXT"), ("age", "INTEGER")],
+        )
+        db.add_table("readings", [("id", "INTEGER PRIMARY KEY"), ("note", "TEXT")])
+        db.add_table(
+            "sensor_data",
+            [("timestamp", "DATETIME"), ("data", "FLOAT"), ("count", "INTEGER")],
+        )
+        reopened = SqliteDB(db_file)
+        assert reopened.tables["users"] == [
+            ("id", "INTEGER"),
+            ("name", "TEXT"),
+            ("age", "INTEGER"),
+        ]
+        assert reopened.schema["readings"]["columns"] == ["id", "note"]
+        assert reopened.schema["sensor_data"]["affinities"] == [
+            "NUMERIC",
+            "REAL",
+            "INTEGER",
+        ]
+        # add_tableを呼び出さずに、開き直したデータベースのテーブルへ挿入できる
+        assert (
+            reopened.insert_many("readings", [(6001, "reopened"), (6002, "reopened")])
+            == 2
+        )
+        assert db.select(
+            "readings", columns=["COUNT(*)"], where_clause="note = 'reopened'"
+        ) == [(2,)]
+        with pytest.raises(ValueError):
+            reopened.insert_many("readings", [(6003, "too", "many")])
+        reopened.engine.dispose()
+        db.engine.dispose()
+
+    def test_change_feed(self, db):
+        db.add_table("feed", [("timestamp", "TEXT"), ("data", "FLOAT")])
+        # タイムスタンプが重複したレコードも取りこぼさない
+        db.insert_many("feed", [("2023-01-01 00:00:00", float(i)) for i in range(7)])
+        assert db.change_offset("feed", "sync") == 0
+
+        batch = db.read_changes("feed", "sync", limit=5, columns=["data"])
+        assert [row[1] for row in batch] == [0.0, 1.0, 2.0, 3.0, 4.0]
+        # commitするまでは同じレコードが返される
+        assert db.read_changes("feed", "sync", limit=5, columns=["data"]) == batch
+        db.commit_changes("feed", "sync", batch[-1][0])
+
+        db.insert("feed", ("2023-01-01 00:00:01", 7.0))
+        batch = db.read_changes("feed", "sync", limit=5, columns=["data"])
+        assert [row[1] for row in batch] == [5.0, 6.0, 7.0]
+        db.commit_changes("feed", "sync", batch[-1][0])
+        # 既読位置は戻らない
+        db.commit_changes("feed", "sync", 1)
+        assert db.change_offset("feed", "sync") == batch[-1][0]
+        assert db.read_changes("feed", "sync") == []
+
+        # コンシューマーごとに既読位置を持ち、開き直しても保持される
+        reopened = SqliteDB(db.db_file)
+        assert len(reopened.read_changes("feed", "archive")) == 8
+        assert reopened.read_changes("feed", "sync") == []
+        reopened.engine.dispose()
+
+    def test_query_stats_templates(self, db):
+        db.add_table("timed", [("id", "INTEGER"), ("value", "FLOAT")])
+        query_stats = db.enable_query_stats(slow_threshold=10)
+        db.insert_many("timed", [(i, float(i)) for i in range(10)])
+        for i in range(3):
+            # 値を埋め込んだWHERE句も、同じテンプレートとして集計される
+            assert (
+                len(db.select("timed", where_clause=f"id < {i + 1} AND value >= 0.0"))
+                == i + 1
+            )
+        snapshot = query_stats.snapshot()
+        select = snapshot["templates"][
+            "SELECT * FROM timed WHERE id < ? AND value >= ?"
+        ]
+        assert select["count"] == 3 and select["rows"] == 6
+        assert snapshot["slow_queries"] == 0
+        assert db.disable_query_stats() is query_stats and db.query_stats is None
+
+    def test_query_stats_include_fetch_time(self, tmp_path):
+        db = SqliteDB(str(tmp_path / "timed.db"), pool="queue", pool_size=1)
+        db.add_table("timed", [("id", "INTEGER")])
+        db.insert_many("timed", [(i,) for i in range(5)])
+
+        def slow_id(value):
+            time.sleep(0.05)
+            return value
+
+        @event.listens_for(db.engine, "connect")
+        def register_slow_id(dbapi_connection, connection_record):
+            dbapi_connection.create_function("slow_id", 1, slow_id)
+
+        db.engine.dispose()  # 保持している接続にも関数を登録するため、接続し直す
+        query_stats = db.enable_query_stats(slow_threshold=0.2)
+        # SQLiteでは2行目以降をfetchallで読み出すため、その時間も実行時間に含める
+        assert len(db.select("timed", columns=["slow_id(id)"])) == 5
+        with pytest.raises(exc.OperationalError):
+            db.select("missing")
+        snapshot = query_stats.snapshot()
+        select = snapshot["templates"]["SELECT slow_id(id) FROM timed"]
+        assert select["max_time"] >= 0.2 and select["rows"] == 5
+        assert sum(select["histogram"].values()) == 1
+        assert snapshot["slow_queries"] == 1
+        with db.get_session() as session:
+            # 失敗したSQL文の開始時刻は残らない
+            assert not session.connection().info.get("query_stats_start")
+        db.disable_query_stats()
+        db.engine.dispose()
+
+    def test_archive_old_rows(self, tmp_path):
+        np = pytest.importorskip("numpy")
+        db = SqliteDB(
+            str(tmp_path / "archive.db"), pragmas={"auto_vacuum": "INCREMENTAL"}
+        )
+        db.add_table(
+            "samples",
+            [("timestamp", "DATETIME"), ("sensor", "TEXT"), ("value", "FLOAT")],
+        )
+        base = datetime(2023, 1, 1)
+        rows = [
+            (
+                str(base + timedelta(minutes=i)),
+                f"s{i % 3}",
+                None if i % 10 == 0 else i * 0.5,
+            )
+            for i in range(3000)
+        ]
+        db.insert_many("samples", rows)
+        cutoff = base + timedelta(minutes=2500)
+
+        summary = db.archive(
+            "samples",
+            cutoff,
+            str(tmp_path / "npz"),
+            chunk_rows=1000,
+            delete_batch=300,
+            vacuum_pages=8,
+        )
+        assert summary["rows"] == summary["deleted"] == 2500
+        assert len(summary["files"]) == 3 and summary["delete_transactions"] >= 9
+        assert summary["reclaimed_pages"] > 0 and summary["freelist_pages"] == 0
+        remaining = db.select("samples", columns=["MIN(timestamp)", "COUNT(*)"])
+        assert remaining == [(str(cutoff), 500)]
+
+        with np.load(summary["files"][0]) as archive:
+            assert list(archive["rowid"][:3]) == [1, 2, 3]
+            assert list(archive["sensor"][:3]) == ["s0", "s1", "s2"]
+            assert archive["value.null"][0] and archive["value"][1] == 0.5
+        with open(tmp_path / "npz" / "samples_archive.jsonl") as f:
+            manifest = [json.loads(line) for line in f]
+        assert [entry["rows"] for entry in manifest] == [1000, 1000, 500]
+        assert manifest[0]["min_time"] == rows[0][0]
+
+        # csv.gz形式は、numpyなしで使用できる
+        summary = db.archive(
+            "samples",
+            cutoff + timedelta(minutes=100),
+            str(tmp_path / "csv"),
+            format="csv.gz",
+        )
+        assert summary["rows"] == 100
+        with gzip.open(summary["files"][0], "rt") as f:
+            lines = f.read().splitlines()
+        assert lines[0] == "rowid,timestamp,sensor,value" and len(lines) == 101
+        # rowidの上限より後ろのレコードは、期間を過ぎていても残す
+        summary = db.archive(
+            "samples",
+            cutoff + timedelta(minutes=200),
+            str(tmp_path / "csv"),
+            max_rowid=2650,
+            format="csv.gz",
+        )
+        assert summary["rows"] == 50
+        assert db.select("samples", columns=["MIN(rowid)"]) == [(2651,)]
+        db.engine.dispose()
+
+    def test_archive_keeps_newest_rowid(self, tmp_path):
+        db = SqliteDB(str(tmp_path / "archive.db"))
+        db.add_table("feed", [("timestamp", "DATETIME"), ("data", "FLOAT")])
+        db.insert_many("feed", [(f"2023-01-01 00:00:0{i}", float(i)) for i in range(5)])
+        db.commit_changes("feed", "sync", 5)
+        summary = db.archive(
+            "feed",
+            "2024-01-01",
+            str(tmp_path / "csv"),
+            max_rowid=db.change_offset("feed", "sync"),
+            format="csv.gz",
+        )
+        # 最大のrowidのレコードを残し、新しいレコードのrowidが既読位置より後ろになる
+        assert summary["rows"] == 4
+        db.insert("feed", ("2023-01-02 00:00:00", 5.0))
+        assert db.read_changes("feed", "sync") == [(6, "2023-01-02 00:00:00", 5.0)]
+
+        db.add_table(
+            "events",
+            [("id", "INTEGER PRIMARY KEY AUTOINCREMENT"), ("timestamp", "DATETIME")],
+        )
+        db.insert_many("events", [(i, "2023-01-01") for i in range(1, 4)])
+        assert (
+            db.archive("events", "2024-01-01", str(tmp_path / "csv"), format="csv.gz")[
+                "rows"
+            ]
+            == 3
+        )
+        db.engine.dispose()